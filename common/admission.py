@@ -0,0 +1,95 @@
+# vim: expandtab smarttab ts=4
+
+import os
+import time
+
+from common.configs import *
+
+def read_loadavg():
+    try:
+        with open('/proc/loadavg') as fin:
+            return float(fin.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+
+# MemAvailable in bytes
+def read_mem_available():
+    try:
+        with open('/proc/meminfo') as fin:
+            for line in fin:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+# The "some avg10" of /proc/pressure/<resource>: the percentage of the last
+# 10 seconds in which at least one task was stalled on it.
+def read_pressure(resource):
+    try:
+        with open(os.path.join('/proc/pressure', resource)) as fin:
+            for line in fin:
+                fields = line.split()
+                if fields and fields[0] == 'some':
+                    return float(fields[1].split('=')[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+# Decides whether another local command may start now (--max-load,
+# --min-mem, --max-pressure). Limits whose /proc file is missing are
+# ignored.
+class Admission:
+    def __init__(self, max_load, min_mem, max_pressure):
+        self.max_load = max_load
+        self.min_mem = min_mem
+        self.max_pressure = max_pressure
+        self.sampled_at = None
+        self.load = None
+        self.mem = None
+        self.pressure = {}
+        # Shown in the header
+        self.status = 'ok'
+
+    @staticmethod
+    def from_args(args):
+        if args.max_load <= 0 and args.min_mem <= 0 and args.max_pressure <= 0:
+            return None
+        return Admission(args.max_load, args.min_mem * (1 << 20), args.max_pressure)
+
+    def _sample(self):
+        now = time.monotonic()
+        if self.sampled_at is not None and now - self.sampled_at < ADMISSION_SAMPLE_INTERVAL:
+            return
+        self.sampled_at = now
+        if self.max_load > 0:
+            self.load = read_loadavg()
+        if self.min_mem > 0:
+            self.mem = read_mem_available()
+        if self.max_pressure > 0:
+            self.pressure = { resource: read_pressure(resource) for resource in PRESSURE_RESOURCES }
+
+    def _hold_reason(self, running):
+        if self.load is not None:
+            # The load average lags by a minute, the commands started since
+            # count as one each.
+            load = max(self.load, running)
+            if load >= self.max_load:
+                return 'load %.1f>=%g' % (load, self.max_load)
+        if self.mem is not None and self.mem < self.min_mem:
+            return 'mem %dM<%dM' % (self.mem >> 20, self.min_mem >> 20)
+        for resource, pressure in self.pressure.items():
+            if pressure is not None and pressure >= self.max_pressure:
+                return '%s pressure %.0f%%>=%g%%' % (resource, pressure, self.max_pressure)
+        return None
+
+    # Whether one more local command may start while running of them are
+    # running. One always may when none are, so a run never stalls.
+    def admit(self, running):
+        self._sample()
+        reason = self._hold_reason(running)
+        if reason is None or running == 0:
+            self.status = 'ok'
+            return True
+        self.status = 'hold, %s' % reason
+        return False
@@ -0,0 +1,241 @@
+# vim: expandtab smarttab ts=4
+
+import re
+
+from common.configs import *
+
+# Escape sequences and control characters, \t and \n excepted. group(1) and
+# group(2) are the parameters and the final byte of a CSI sequence.
+ESCAPE_RE = re.compile(
+        r'\x1b\[([0-?]*)[ -/]*([@-~])'
+        # OSC, e.g. setting the window title
+        r'|\x1b\][^\x07\x1b]*(?:\x07|\x1b\\)'
+        # DCS, SOS, PM and APC
+        r'|\x1b[PX^_][^\x1b]*\x1b\\'
+        r'|\x1b[ -/]*[0-~]'
+        r'|[\x00-\x08\x0b-\x1f\x7f-\x9f]')
+CONTROL_RE = re.compile(r'[\x00-\x08\x0b-\x1f\x7f-\x9f]')
+CONTROL_BYTES = bytes(range(0x00, 0x09)) + bytes(range(0x0b, 0x20)) + b'\x7f'
+# A sequence cut at the end of a chunk, completed by the next one
+PARTIAL_ESCAPE_RE = re.compile(r'\x1b(?:\[[0-?]*[ -/]*|\][^\x07\x1b]*\x1b?|[PX^_][^\x1b]*\x1b?|[ -/]*)\Z')
+
+# The SGR state: the attribute codes set (1 bold, 4 underline, ...) and the
+# foreground and background colors as their SGR parameters, e.g. '31' or
+# '38;5;208', None for the default.
+DEFAULT_STYLE = ((), None, None)
+SGR_FLAGS = (1, 2, 3, 4, 5, 7, 8, 9)
+# Codes turning flags off
+SGR_FLAGS_OFF = { 21: (1,), 22: (1, 2), 23: (3,), 24: (4,), 25: (5,), 27: (7,), 28: (8,), 29: (9,) }
+
+_styles = {}
+_sgrs = {}
+
+def _apply_sgr(style, params):
+    flags, fg, bg = style
+    flags = set(flags)
+    codes = []
+    for p in params.replace(':', ';').split(';'):
+        if not p.isdigit():
+            # Other sub-parameter syntaxes are not worth it
+            if p:
+                return style
+            p = '0'
+        codes.append(int(p))
+    k = 0
+    while k < len(codes):
+        code = codes[k]
+        if code == 0:
+            flags = set()
+            fg = bg = None
+        elif code in SGR_FLAGS:
+            flags.add(code)
+        elif code in SGR_FLAGS_OFF:
+            flags.difference_update(SGR_FLAGS_OFF[code])
+        elif 30 <= code <= 37 or 90 <= code <= 97:
+            fg = str(code)
+        elif 40 <= code <= 47 or 100 <= code <= 107:
+            bg = str(code)
+        elif code == 39:
+            fg = None
+        elif code == 49:
+            bg = None
+        elif code in (38, 48):
+            n = k + 1 < len(codes) and { 5: 2, 2: 4 }.get(codes[k + 1]) or 0
+            if not n or k + n >= len(codes):
+                break
+            color = ';'.join(map(str, codes[k:k + n + 1]))
+            if code == 38:
+                fg = color
+            else:
+                bg = color
+            k += n
+        k += 1
+    return (tuple(sorted(flags)), fg, bg)
+
+# The style after the SGR sequence with params, cached as programs keep
+# sending the same few ones.
+def apply_sgr(style, params):
+    key = (style, params)
+    new = _styles.get(key)
+    if new is None:
+        if len(_styles) >= ANSI_STYLE_CACHE:
+            _styles.clear()
+        new = _styles[key] = _apply_sgr(style, params)
+    return new
+
+# The sequence setting style from any state
+def sgr(style):
+    seq = _sgrs.get(style)
+    if seq is None:
+        flags, fg, bg = style
+        params = [ '0' ] + [ str(flag) for flag in flags ] + [ color for color in (fg, bg) if color is not None ]
+        seq = '\x1b[%sm' % ';'.join(params)
+        if len(_sgrs) >= ANSI_STYLE_CACHE:
+            _sgrs.clear()
+        _sgrs[style] = seq
+    return seq
+
+# The text of line in runs of (text, style). Lines from LineSplitter only hold
+# SGR sequences, anything else is dropped.
+def styled_runs(line):
+    if '\x1b' not in line:
+        return [ (line, DEFAULT_STYLE) ]
+    runs = []
+    style = DEFAULT_STYLE
+    pos = 0
+    for m in ESCAPE_RE.finditer(line):
+        if m.start() > pos:
+            runs.append((line[pos:m.start()], style))
+        if m.group(2) == 'm':
+            style = apply_sgr(style, m.group(1))
+        pos = m.end()
+    if pos < len(line):
+        runs.append((line[pos:], style))
+    return runs
+
+# Whether text holds no control character but \t and \n. Deleting them from
+# the bytes of ASCII text is much faster than searching with a regex.
+def plain_text(text):
+    if text.isascii():
+        data = text.encode('ascii')
+        return len(data.translate(None, CONTROL_BYTES)) == len(data)
+    return not CONTROL_RE.search(text)
+
+def strip(line):
+    if '\x1b' not in line:
+        return line
+    return ESCAPE_RE.sub('', line)
+
+def _reduce_color(n, colors):
+    if n < colors:
+        return n
+    if n < 16:
+        return n - 8
+    if n < 232:
+        # The 6x6x6 cube, red, green and blue are bits 0, 1 and 2 of the
+        # basic colors
+        n -= 16
+        return (n // 36 >= 3 and 1 or 0) | (n // 6 % 6 >= 3 and 2 or 0) | (n % 6 >= 3 and 4 or 0)
+    return n >= 244 and 7 or 0
+
+# The color number of an SGR color parameter on a terminal with colors
+# colors.
+def color_number(color, colors):
+    codes = [ int(p) for p in color.split(';') ]
+    if codes[0] in (38, 48):
+        if codes[1] == 5:
+            n = codes[2]
+        else:
+            r, g, b = [ min(c, 255) * 5 // 255 for c in codes[2:5] ]
+            n = 16 + 36 * r + 6 * g + b
+    else:
+        n = codes[0] % 10 + (codes[0] >= 90 and 8 or 0)
+    return _reduce_color(min(n, 255), colors)
+
+# The terminal state of the line being written, so that rewriting it with \r,
+# \b or CSI K and G keeps only what ends up visible. Text only appended is
+# kept in runs, the line is turned into cells (characters) once rewritten.
+class TermLine:
+    def __init__(self, style = DEFAULT_STYLE):
+        self.texts = []
+        self.run_styles = []
+        self.chars = None
+        self.cell_styles = None
+        self.length = 0
+        self.col = 0
+        self.style = style
+        # Some text has a style
+        self.styled = False
+
+    def __len__(self):
+        return self.length
+
+    def _to_cells(self):
+        self.chars = []
+        self.cell_styles = []
+        for text, style in zip(self.texts, self.run_styles):
+            self.chars += text
+            self.cell_styles += [ style ] * len(text)
+        self.texts = self.run_styles = None
+
+    def write(self, text):
+        n = len(text)
+        if not n:
+            return
+        if self.style != DEFAULT_STYLE:
+            self.styled = True
+        if self.chars is None and self.col == self.length:
+            self.texts.append(text)
+            self.run_styles.append(self.style)
+            self.length += n
+            self.col += n
+            return
+        if self.chars is None:
+            self._to_cells()
+        if self.col > self.length:
+            pad = self.col - self.length
+            self.chars += ' ' * pad
+            self.cell_styles += [ DEFAULT_STYLE ] * pad
+        self.chars[self.col:self.col + n] = text
+        self.cell_styles[self.col:self.col + n] = [ self.style ] * n
+        self.col += n
+        self.length = len(self.chars)
+
+    # CSI K: to the end (0), from the start (1) or all of the line (2)
+    def erase(self, mode):
+        if mode not in (0, 1, 2) or mode == 0 and self.col >= self.length:
+            return
+        if self.chars is None:
+            self._to_cells()
+        if mode == 0:
+            del self.chars[self.col:]
+            del self.cell_styles[self.col:]
+        else:
+            end = mode == 1 and min(self.col + 1, self.length) or self.length
+            self.chars[:end] = ' ' * end
+            self.cell_styles[:end] = [ DEFAULT_STYLE ] * end
+        self.length = len(self.chars)
+
+    # Whether the line is plain text with the cursor at its end
+    def plain(self):
+        return not self.styled and self.style == DEFAULT_STYLE and self.col == self.length
+
+    def render(self):
+        if self.chars is None:
+            if not self.styled:
+                return ''.join(self.texts)
+            pieces = zip(self.texts, self.run_styles)
+        else:
+            if not self.styled:
+                return ''.join(self.chars)
+            pieces = zip(self.chars, self.cell_styles)
+        out = []
+        current = DEFAULT_STYLE
+        for text, style in pieces:
+            if style != current:
+                out.append(sgr(style))
+                current = style
+            out.append(text)
+        if current != DEFAULT_STYLE:
+            out.append(sgr(DEFAULT_STYLE))
+        return ''.join(out)
@@ -2,32 +2,118 @@
 
 from common.configs import *
 
+import os
 import sys
+import shlex
 import argparse
 
+from common.sshmux import SshMux
+from common.workqueue import read_items
+from common.usage import SUMMARY_FILE, SUMMARY_SORT_KEYS
+
 def print_version():
     print(f'Para-Run version {VERSION}')
     sys.exit(0)
 
-def parse_args():
+def build_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument('cmd', nargs='*', help='Local commands. Wrap long commands with quotes(\"\").')
     parser.add_argument('-v', '--version', action='store_true', help='Show version and exit.')
     parser.add_argument('-r', '--remote-cmds', nargs=2, metavar=('REMOTE_HOSTS', 'CMD'), action='append', help='Target hosts (1-19) are allowed "," and "-", e.g. "1,3-5" is valid. Multiple -r is allowed.')
+    parser.add_argument('--ssh', help=f'The ssh command used for remote commands, "{DEFAULT_SSH_CMD}" by default.', default=DEFAULT_SSH_CMD)
+    parser.add_argument('--ssh-mux', action='store_true', help='Open one shared ssh connection (ControlMaster) per remote host before starting the commands, and reuse it for all commands on that host. sshd allows 10 sessions per connection by default (MaxSessions), see --host-jobs.')
     parser.add_argument('-l', '--log-output', action='store_true', help='Store output to logs.')
+    parser.add_argument('--log-compress', action='store_true', help='Gzip the output logs.')
+    parser.add_argument('--log-ts', choices=['abs', 'delta', 'none'], help='Timestamp of each line in the output logs: absolute time, seconds since the previous line, or nothing. "abs" by default.', default='abs')
+    parser.add_argument('--group', action='store_true', help='Show tasks with identical output in a single subwindow, titled with their hosts. Tasks leave their group as soon as their output differs.')
+    parser.add_argument('--replay', metavar='DIR', help='Show the output logs of a past run stored with -l, e.g. ".para-run/20240101-120000", instead of running commands.')
+    parser.add_argument('--detach', action='store_true', help='Run the commands in a background session that goes on after the terminal is closed, and attach to it. With --no-tui, only print the run directory of the session.')
+    parser.add_argument('--attach', nargs='?', const='', metavar='DIR', help='Show a session started with --detach, the latest one still running by default. Press d to detach, several terminals may attach to the same session.')
+    parser.add_argument('--metrics', action='store_true', help='Write runtime metrics (output rates, lock wait and hold times, render times) to metrics.json in the log directory every few seconds. Press s to show them in the TUI.')
     parser.add_argument('-w', '--subwin-height', type=int, help=f'The starting height of each subwindow, {DEFAULT_SUBPADS_SHOWN_HEIGHT} by default.', default=DEFAULT_SUBPADS_SHOWN_HEIGHT)
     parser.add_argument('-d', '--debug-level', type=int, help='Debug level, 0 by default.', default=0)
+    parser.add_argument('-j', '--jobs', type=int, help='Maximum number of commands running at the same time, 0 (unlimited) by default.', default=0)
+    parser.add_argument('--host-jobs', type=int, help='Maximum number of remote commands running on the same host at the same time, 0 (unlimited) by default.', default=0)
+    parser.add_argument('--items', metavar='FILE', help=f'Run the commands once per line of FILE ("-" for stdin) instead of once per host: {ITEM_PLACEHOLDER} in a command is replaced with the item, or the item is appended. Each host takes the next item whenever one of its slots is free, so faster hosts take more items.')
+    parser.add_argument('--slots', type=int, help='With --items, number of items each host (or local command) runs at the same time, 1 by default.', default=1)
+    parser.add_argument('--max-load', type=float, metavar='LOAD', help='Start local commands only while the 1-minute load average is below LOAD, e.g. the number of cores. Each running local command counts as a load of 1 at least, as the load average lags behind. 0 (no limit) by default.', default=0)
+    parser.add_argument('--min-mem', type=int, metavar='MB', help='Start local commands only while at least MB megabytes of memory are available. 0 (no limit) by default.', default=0)
+    parser.add_argument('--max-pressure', type=float, metavar='PCT', help='Start local commands only while tasks stalled on CPU, memory and IO less than PCT percent of the last 10 seconds (Linux pressure stall information). 0 (no limit) by default.', default=0)
+    parser.add_argument('--timeout', type=float, metavar='SEC', help=f'Kill the commands still running SEC seconds after the start of the run, and never start the pending ones. They exit with {TIMEOUT_RETCODE}. 0 (no timeout) by default.', default=0)
+    parser.add_argument('--task-timeout', type=float, metavar='SEC', help=f'Kill each command running for more than SEC seconds, it exits with {TIMEOUT_RETCODE}. Commands are killed with their children, SIGTERM first and SIGKILL {TIMEOUT_KILL_GRACE:g} seconds later. 0 (no timeout) by default.', default=0)
+    parser.add_argument('--speculate', type=float, metavar='FRACTION', help=f'Once this fraction of the hosts of a remote command have finished it, start a copy of the ones running {SPECULATE_SLOWDOWN:g} times longer than the median on hosts that are done, and keep the first of the two to finish (the copy only if it succeeds). 0 (disabled) by default.', default=0)
+    parser.add_argument('--engine', choices=['thread', 'selector'], help='How task output is read: one thread per task, or a single selector loop for all tasks. "thread" by default.', default='thread')
+    parser.add_argument('--scrollback-lines', type=int, help=f'Lines of output kept in memory for each task, older lines are spilled to disk. {DEFAULT_SCROLLBACK_LINES} by default.', default=DEFAULT_SCROLLBACK_LINES)
+    parser.add_argument('--fps', type=int, help=f'Maximum number of screen redraws per second, {DEFAULT_FPS} by default.', default=DEFAULT_FPS)
+    parser.add_argument('--no-history', dest='history', action='store_false', help=f'Do not store the duration, return code and output size of the commands in {DEFAULT_RUNTIME_DIR}{HISTORY_FILE}. Past runs give an ETA in the header, and the commands much slower than usual are reported at exit.')
+    parser.add_argument('--longest-first', action='store_true', help='With -j or --host-jobs, start the commands that took the longest in past runs first, and those never run before even earlier, so that the run ends sooner.')
+    parser.add_argument('--summary', choices=SUMMARY_SORT_KEYS + ('none',), help=f'Print a table of the wall time, CPU time, peak memory (local commands only) and output of the commands at exit, the first {SUMMARY_ROWS} of them sorted by this column. The peak memory the kernel reports for a command is never below the one of para-run when it started the command, such peaks are shown as "<=" that floor. With -l, all of them are stored in {SUMMARY_FILE} in the log directory. "wall" by default.', default='wall')
+    parser.add_argument('--no-tui', action='store_true', help='Do not start the curses interface, print the output of all commands to stdout instead, e.g. in cron jobs or pipelines. Exits with 1 if any command failed.')
+    parser.add_argument('--format', choices=['text', 'jsonl'], help='Output format of --no-tui: lines prefixed with "[host/index] ", or one JSON object per line with the timestamp, task index, host and stream of each line, plus start and exit events. "text" by default.', default='text')
+    parser.add_argument('--tree-fanout', type=int, help='With more remote hosts than this, relay the remote commands through at most this many hosts, each running para-run for its share of the hosts (recursively). 0 (disabled) by default.', default=0)
+    parser.add_argument('--relay-cmd', help=f'Command starting a relay, {{ssh}} and {{host}} are replaced with the ssh command and the relay host. "{DEFAULT_RELAY_CMD}" by default.', default=DEFAULT_RELAY_CMD)
+    # Run as a relay of a parent para-run: tasks are read from stdin and
+    # their output is framed to stdout.
+    parser.add_argument('--relay', action='store_true', help=argparse.SUPPRESS)
+    # The lines read from --items, see parse_cmds()
+    parser.set_defaults(work_items=None)
+    return parser
+
+# The options a relay starts from before applying the ones of its parent.
+def default_args():
+    return build_parser().parse_args([])
+
+def parse_args():
+    parser = build_parser()
     args = parser.parse_args()
     if args.version:
         print_version()
 
-    if not args.remote_cmds and len(args.cmd) == 0:
+    if args.fps < 1:
+        parser.error('--fps must be positive.')
+    if args.timeout < 0 or args.task_timeout < 0:
+        parser.error('Timeouts must not be negative.')
+    # A single relay would get all the hosts again, and so on
+    if args.tree_fanout == 1:
+        parser.error('--tree-fanout must be 0 or at least 2.')
+    if not 0 <= args.speculate <= 1:
+        parser.error('--speculate must be between 0 and 1.')
+    if args.slots < 1:
+        parser.error('--slots must be positive.')
+    if args.items is not None and (args.speculate or args.tree_fanout):
+        parser.error('--items cannot be used with --speculate or --tree-fanout.')
+    if args.longest_first and (args.items is not None or not args.history):
+        parser.error('--longest-first cannot be used with --items or --no-history.')
+    if args.detach and args.replay:
+        parser.error('--detach cannot be used with --replay.')
+    if args.attach is not None and (args.cmd or args.remote_cmds or args.no_tui or args.detach):
+        parser.error('--attach cannot be used with commands, --no-tui or --detach.')
+
+    if not args.remote_cmds and len(args.cmd) == 0 and not args.relay and not args.replay and args.attach is None:
         parser.print_help()
         sys.exit(0)
     return args
 
+def gen_ssh_prefix(args):
+    if not args.ssh_mux:
+        return args.ssh
+    return ' '.join([ args.ssh ] + [ shlex.quote(opt) for opt in SshMux.control_opts() ])
+
+def gen_remote_cmd(hostid, cmd, ssh_prefix = DEFAULT_SSH_CMD):
+    return '%s %s \"%s\"' % (ssh_prefix, HOST_NAME_FMT % hostid, cmd)
+
+def gen_cmd(spec, ssh_prefix = DEFAULT_SSH_CMD):
+    hostid, cmd = spec
+    if hostid is None:
+        return cmd
+    return gen_remote_cmd(hostid, cmd, ssh_prefix)
+
+# Returns the shell commands and their (hostid, cmd) specs. hostid is None for
+# local commands.
 def trans_cmds(args):
     cmds = list(args.cmd)
+    specs = [ (None, cmd) for cmd in cmds ]
+    ssh_prefix = gen_ssh_prefix(args)
     # Remote commands specified?
     if args.remote_cmds:
         illegal_hosts = []
@@ -56,7 +142,8 @@ def trans_cmds(args):
 
             hosts = list(set(hosts)) # Unique
             for hostid in hosts:
-                cmds.append('ssh n%d \"%s\"' % (hostid, cmd))
+                cmds.append(gen_remote_cmd(hostid, cmd, ssh_prefix))
+                specs.append((hostid, cmd))
 
         for remote_cmd in args.remote_cmds:
             trans_remote_cmds(remote_cmd)
@@ -65,8 +152,30 @@ def trans_cmds(args):
             sys.stderr.write('Illegal hosts: %s\033[0m\n' % ','.join(illegal_hosts))
             sys.exit(-1)
 
-    return cmds
+    return cmds, specs
+
+def read_work_items(args):
+    try:
+        if args.items != '-':
+            with open(args.items) as fin:
+                return read_items(fin)
+        items = read_items(sys.stdin)
+        # The TUI reads keys from stdin
+        if not args.no_tui:
+            fd = os.open('/dev/tty', os.O_RDONLY)
+            os.dup2(fd, 0)
+            os.close(fd)
+        return items
+    except OSError as e:
+        sys.stderr.write('Cannot read items: %s\n' % e)
+        sys.exit(-1)
 
 def parse_cmds():
     args = parse_args()
-    return args, trans_cmds(args)
+    cmds, specs = trans_cmds(args)
+    if args.items is not None:
+        args.work_items = read_work_items(args)
+        # Each command gets --slots tasks, running one item after another
+        cmds = [ cmd for cmd in cmds for k in range(args.slots) ]
+        specs = [ spec for spec in specs for k in range(args.slots) ]
+    return args, cmds, specs
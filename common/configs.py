@@ -2,8 +2,82 @@
 
 VERSION = '1.7.1'
 
-DEFAULT_SUBPADS_HEIGHT = 32767
 DEFAULT_SUBPADS_SHOWN_HEIGHT = 3
 HEADER_LINES = 2
+STATS_PANEL_LINES = 2
+DEFAULT_FPS = 30
+
+DEFAULT_SCROLLBACK_LINES = 10000
+SCROLLBACK_SEGMENT_LINES = 1000
+SCROLLBACK_CACHED_SEGMENTS = 4
+SEARCH_BLOOM_BITS = 1 << 16
 
 DEFAULT_RUNTIME_DIR = '.para-run/'
+LOG_WRITE_BATCH = 1024
+
+INGEST_READ_SIZE = 65536
+MAX_LINE_LENGTH = 65536
+# Longest escape sequence held back when a chunk ends in the middle of one
+MAX_ESCAPE_LENGTH = 256
+ANSI_STYLE_CACHE = 4096
+
+OUTPUT_BUFFER_SIZE = 1 << 20
+OUTPUT_FLUSH_INTERVAL = 1.0
+OUTPUT_GZIP_LEVEL = 6
+
+REPLAY_INDEX_STEP = 64
+REPLAY_INDEX_CHUNK = 1 << 24
+
+STREAM_BUFFER_SIZE = 1 << 16
+STREAM_FLUSH_INTERVAL = 0.2
+
+HOST_NAME_FMT = 'n%d'
+DEFAULT_SSH_CMD = 'ssh'
+SSH_MUX_WARM_TIMEOUT = 30
+
+DEFAULT_RELAY_CMD = '{ssh} {host} para-run --relay'
+RELAY_FLUSH_INTERVAL = 0.05
+RELAY_STDERR_TAIL = 5
+RELAY_FAILED_RETURNCODE = 255
+
+ITEM_PLACEHOLDER = '{}'
+
+SESSION_SOCKET = 'session.sock'
+# How long a session waits after its run for a viewer to see the results
+SESSION_LINGER = 3600
+SESSION_POLL_INTERVAL = 1.0
+# Bytes queued for a viewer before it is dropped
+SESSION_VIEWER_BACKLOG = 64 << 20
+
+ADMISSION_SAMPLE_INTERVAL = 0.5
+PRESSURE_RESOURCES = ('cpu', 'memory', 'io')
+
+# Same as timeout(1)
+TIMEOUT_RETCODE = 124
+# Same as sh for a command it cannot run
+NOT_SPAWNED_RETCODE = 127
+TIMEOUT_KILL_GRACE = 5.0
+WATCHDOG_INTERVAL = 0.2
+# Speculate on tasks running this many times longer than the median
+SPECULATE_SLOWDOWN = 1.5
+
+METRICS_RATE_INTERVAL = 1.0
+METRICS_EXPORT_INTERVAL = 5.0
+METRICS_TOP_TASKS = 3
+
+# Durations of past runs, see common/history.py
+HISTORY_FILE = 'history.db'
+HISTORY_LOCK_TIMEOUT = 5.0
+HISTORY_SAMPLES = 5
+HISTORY_MAX_AGE = 90 * 86400
+# Tasks are reported as slower than usual past both
+HISTORY_SLOWDOWN = 1.5
+HISTORY_SLOWDOWN_MIN_SECONDS = 1.0
+ETA_REFRESH_INTERVAL = 1.0
+
+# Rows of the summary table printed at exit, and width of their commands
+SUMMARY_ROWS = 20
+SUMMARY_CMD_WIDTH = 40
+# A task peaking this close to the peak RSS of para-run itself used less, see
+# TaskUsage
+RSS_FLOOR_SLACK = 1 << 20
@@ -0,0 +1,144 @@
+# vim: expandtab smarttab ts=4
+
+from common.configs import *
+
+# Tasks whose output is the same so far, stored once. chain[k] hashes the
+# first k + 1 lines, so two outputs agree up to line k iff their hashes at k
+# agree. Members may be behind the stored output, a sealed group holds the
+# whole output of a finished member and cannot grow anymore.
+class Group:
+    def __init__(self, gid, store):
+        self.gid = gid
+        self.store = store
+        self.chain = []
+        self.members = set()
+        self.sealed = False
+
+    def leader(self):
+        return min(self.members)
+
+# Groups the tasks by their output as it arrives (--group). A task leaves its
+# group when one of its lines differs or when it finishes with less output,
+# and joins another group with the same output or a new one.
+class Grouper:
+    def __init__(self, tasks_total, new_store):
+        self.new_store = new_store
+        self.next_gid = 0
+        first = self._new_group()
+        first.members = set(range(tasks_total))
+        self.groups = [ first ]
+        self.task_group = [ first ] * tasks_total
+        self.pos = [0] * tasks_total
+        # Membership changed since the last take_changed()
+        self.changed = False
+
+    def _new_group(self):
+        group = Group(self.next_gid, self.new_store(self.next_gid))
+        self.next_gid += 1
+        return group
+
+    def _hash(self, group, pos, line):
+        if pos == 0:
+            return hash(line)
+        return hash((group.chain[pos - 1], line))
+
+    def _move(self, i, group, pos):
+        old = self.task_group[i]
+        old.members.discard(i)
+        if not old.members:
+            self.groups.remove(old)
+            old.store.close()
+        if group not in self.groups:
+            self.groups.append(group)
+        group.members.add(i)
+        self.task_group[i] = group
+        self.pos[i] = pos
+        self.changed = True
+
+    # A group with the first pos lines of group, ending with a line hashed h
+    # if not None.
+    def _split(self, group, pos, h, line):
+        for other in self.groups:
+            if other is group:
+                continue
+            if h is not None and len(other.chain) > pos and other.chain[pos] == h:
+                return other
+            if h is None and len(other.chain) == pos \
+            and (pos == 0 or other.chain[pos - 1] == group.chain[pos - 1]):
+                return other
+        new = self._new_group()
+        if pos:
+            new.store.append_text('\n'.join([ group.store.get_line(k) for k in range(pos) ]) + '\n')
+        new.chain = group.chain[:pos]
+        if h is not None:
+            new.store.append_text(line)
+            new.chain.append(h)
+        return new
+
+    def _add_line(self, i, line):
+        group = self.task_group[i]
+        pos = self.pos[i]
+        h = self._hash(group, pos, line)
+        if pos < len(group.chain):
+            if group.chain[pos] == h:
+                self.pos[i] = pos + 1
+                return
+        elif not group.sealed:
+            group.chain.append(h)
+            group.store.append_text(line)
+            self.pos[i] = pos + 1
+            return
+        self._move(i, self._split(group, pos, h, line), pos + 1)
+
+    def add_lines(self, i, lines):
+        for line in lines:
+            self._add_line(i, line)
+
+    # All output of task i has been added.
+    def finish(self, i):
+        group = self.task_group[i]
+        pos = self.pos[i]
+        if pos < len(group.chain):
+            group = self._split(group, pos, None, None)
+            self._move(i, group, pos)
+        group.sealed = True
+
+    def take_changed(self):
+        changed = self.changed
+        self.changed = False
+        return changed
+
+    def ordered_groups(self):
+        return sorted(self.groups, key=lambda group: group.leader())
+
+    def close(self):
+        for group in self.groups:
+            group.store.close()
+
+# Compact names of the tasks of a group, e.g. "n[1-3,5] local[7]".
+def format_members(members, specs):
+    hosts = []
+    local = []
+    for i in sorted(members):
+        hostid = specs[i][0]
+        if hostid is None:
+            local.append(i + 1)
+        else:
+            hosts.append(hostid)
+    names = []
+    if hosts:
+        names.append(HOST_NAME_FMT.replace('%d', '[%s]' % format_ranges(sorted(set(hosts)))))
+    if local:
+        names.append('local[%s]' % format_ranges(local))
+    return ' '.join(names)
+
+def format_ranges(ids):
+    ranges = []
+    start = prev = ids[0]
+    for n in ids[1:] + [ None ]:
+        if n is not None and n == prev + 1:
+            prev = n
+            continue
+        ranges.append(start == prev and str(start) or '%d-%d' % (start, prev))
+        start = prev = n
+    return ','.join(ranges)
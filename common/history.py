@@ -0,0 +1,68 @@
+# vim: expandtab smarttab ts=4
+
+import os
+import time
+import sqlite3
+
+from common.configs import *
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    cmd TEXT NOT NULL,
+    host TEXT NOT NULL,
+    finished REAL NOT NULL,
+    duration REAL NOT NULL,
+    returncode INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    lines INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tasks_key ON tasks (cmd, host, finished);
+'''
+
+# Commands differing in whitespace only are the same
+def normalize_cmd(cmd):
+    return ' '.join(cmd.split())
+
+def host_key(hostid):
+    return hostid is None and 'local' or HOST_NAME_FMT % hostid
+
+def format_duration(seconds):
+    if seconds < 10:
+        return '%.1fs' % seconds
+    seconds = int(seconds + 0.5)
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 3600:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%dh%02dm' % (seconds // 3600, seconds % 3600 // 60)
+
+# The tasks of past runs in .para-run/history.db, keyed by their command and
+# host. Shared by the runs started from the same directory, which may run at
+# the same time.
+class History:
+    def __init__(self, path = os.path.join(DEFAULT_RUNTIME_DIR, HISTORY_FILE)):
+        os.makedirs(os.path.dirname(path), mode=0o755, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=HISTORY_LOCK_TIMEOUT, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+
+    # The median duration of the last HISTORY_SAMPLES successful runs of each
+    # (cmd, host) of keys, None if it never succeeded.
+    def expected(self, keys):
+        durations = {}
+        for cmd, host in set(keys):
+            rows = self.db.execute('SELECT duration FROM tasks WHERE cmd = ? AND host = ? AND returncode = 0 '
+                    'ORDER BY finished DESC LIMIT ?', (cmd, host, HISTORY_SAMPLES)).fetchall()
+            samples = sorted([ row[0] for row in rows ])
+            durations[(cmd, host)] = None
+            if samples:
+                durations[(cmd, host)] = samples[len(samples) // 2]
+        return durations
+
+    # rows are (cmd, host, finished, duration, returncode, bytes, lines)
+    def record(self, rows):
+        with self.db:
+            self.db.executemany('INSERT INTO tasks VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.execute('DELETE FROM tasks WHERE finished < ?', (time.time() - HISTORY_MAX_AGE,))
+
+    def close(self):
+        self.db.close()
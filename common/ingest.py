@@ -0,0 +1,148 @@
+# vim: expandtab smarttab ts=4
+
+import codecs
+
+from common.configs import *
+from common.ansi import ESCAPE_RE, PARTIAL_ESCAPE_RE, TermLine, apply_sgr, plain_text
+
+# Turns chunks of raw child output into lines. Invalid UTF-8 is replaced
+# instead of raising, sequences split across chunks are decoded correctly,
+# and lines longer than max_line_length are cut into several lines so that
+# a child printing without newlines cannot grow a line forever.
+#
+# Output with escape sequences or control characters other than \t and \n
+# goes through a TermLine instead: \r, \b and CSI K, G, C and D rewrite the
+# current line like a terminal would, SGR sequences are kept in the canonical
+# form of ansi.sgr() and every other escape sequence and control character is
+# dropped. A progress bar thus ends up as a single line holding its last
+# frame.
+class LineSplitter:
+    def __init__(self, max_line_length = MAX_LINE_LENGTH):
+        self.max_line_length = max_line_length
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.partial = ''
+        # The current line while it is not plain text
+        self.line = None
+        # An escape sequence cut at the end of the previous chunk
+        self.escape = ''
+
+    def _cut(self, line):
+        step = self.max_line_length
+        return [ line[i:i+step] + '\n' for i in range(0, len(line), step) ]
+
+    # Returns the lines completed by data, each ending with '\n'.
+    def feed(self, data):
+        text = self.escape + self.decoder.decode(data)
+        self.escape = ''
+        # Moving to the start of the line just before ending it changes
+        # nothing
+        if '\r' in text:
+            text = text.replace('\r\n', '\n')
+        if self.line is None and plain_text(text):
+            return self._feed_plain(text)
+        return self._feed_terminal(text)
+
+    def _feed_plain(self, text):
+        text = self.partial + text
+        pieces = text.split('\n')
+        self.partial = pieces.pop()
+
+        lines = []
+        for piece in pieces:
+            if len(piece) > self.max_line_length:
+                lines += self._cut(piece)
+            else:
+                lines.append(piece + '\n')
+        if len(self.partial) >= self.max_line_length:
+            cut = len(self.partial) - len(self.partial) % self.max_line_length
+            lines += self._cut(self.partial[:cut])
+            self.partial = self.partial[cut:]
+        return lines
+
+    def _feed_terminal(self, text):
+        if self.line is None:
+            self.line = TermLine()
+            self.line.write(self.partial)
+            self.partial = ''
+        m = PARTIAL_ESCAPE_RE.search(text, max(len(text) - MAX_ESCAPE_LENGTH, 0))
+        if m:
+            self.escape = text[m.start():]
+            text = text[:m.start()]
+
+        lines = []
+        pos = 0
+        for m in ESCAPE_RE.finditer(text):
+            self._write(text[pos:m.start()], lines)
+            self._control(m)
+            pos = m.end()
+        self._write(text[pos:], lines)
+        # Back to the fast path until the next control character
+        if self.line.plain():
+            self.partial = self.line.render()
+            self.line = None
+        return lines
+
+    def _end_line(self, lines):
+        lines.append(self.line.render() + '\n')
+        self.line = TermLine(self.line.style)
+
+    def _write(self, text, lines):
+        pieces = text.split('\n')
+        for k, piece in enumerate(pieces):
+            if k:
+                self._end_line(lines)
+            while piece:
+                room = self.max_line_length - self.line.col
+                if room <= 0:
+                    self._end_line(lines)
+                    continue
+                self.line.write(piece[:room])
+                piece = piece[room:]
+
+    def _control(self, m):
+        line = self.line
+        final = m.group(2)
+        if final is None:
+            ch = m.group(0)
+            if ch == '\r':
+                line.col = 0
+            elif ch == '\b':
+                line.col = max(line.col - 1, 0)
+            return
+        params = m.group(1)
+        if final == 'm':
+            line.style = apply_sgr(line.style, params)
+            return
+        n = params.isdigit() and int(params) or 0
+        if final == 'K':
+            line.erase(n)
+        elif final == 'G':
+            line.col = max(n, 1) - 1
+        elif final == 'C':
+            line.col += max(n, 1)
+        elif final == 'D':
+            line.col = max(line.col - max(n, 1), 0)
+        line.col = min(line.col, self.max_line_length - 1)
+
+    # The line being written, what a terminal would show of it now
+    def current(self):
+        if self.line is None:
+            return self.partial
+        return self.line.render()
+
+    # At EOF, returns what is left without adding a newline.
+    def flush(self):
+        rest = self.escape + self.decoder.decode(b'', final=True)
+        self.escape = ''
+        lines = []
+        if rest or self.line is not None:
+            lines = self._feed_terminal(rest)
+        # A sequence never completed
+        self.escape = ''
+        if self.line is not None and len(self.line):
+            lines.append(self.line.render())
+        elif self.partial:
+            lines.append(self.partial)
+        self.partial = ''
+        self.line = None
+        return lines
@@ -4,11 +4,18 @@ import sys
 import os
 import logging
 from datetime import datetime
+import time
+import gzip
+import queue
 import threading
 import traceback
 
 from common.configs import *
 
+# Where the outputs of the run started at start_ts are stored.
+def run_dir(start_ts):
+    return os.path.join(DEFAULT_RUNTIME_DIR, start_ts.strftime('%Y%m%d-%H%M%S'))
+
 class Logger:
     def __init__(self):
         logging.basicConfig(level = logging.INFO, format = '%(asctime)s \033[1;32m[%(tag)s]\033[0m %(message)s')
@@ -21,15 +28,17 @@ class Logger:
             self._logger.info(line, extra={'tag': tag})
 
 class FileLogger:
-    def __init__(self, path = '', mode='w', emergency_out=None):
-        if not path:
-            self._fl = None
-        else:
+    def __init__(self, path = '', mode='w', emergency_out=None, buffering=-1, compress=False):
+        self._fl = None
+        if path:
             try:
                 dn = os.path.dirname(path)
                 if not os.path.isdir(dn):
                     os.makedirs(dn, mode=0o755, exist_ok=True)
-                self._fl = open(path, mode)
+                if compress:
+                    self._fl = gzip.open(path, mode + 't', compresslevel=OUTPUT_GZIP_LEVEL)
+                else:
+                    self._fl = open(path, mode, buffering=buffering)
             except IOError as e:
                 if emergency_out:
                     emergency_out.write(''.join(traceback.format_exception(None, e, e.__traceback__)))
@@ -37,34 +46,82 @@ class FileLogger:
                     emergency_out.flush()
 
         self.mutex = threading.Lock()
+        # Set by _start_writer(): messages are formatted and written by a
+        # background thread instead of the caller.
+        self._queue = None
+        self._writer = None
 
     def _should_log(self, *args, **kwargs):
         return True
 
-    def _gen_message(self, tag, msg_line, *args, **kwargs):
+    # Cheap guard for callers that need to build expensive messages.
+    def enabled(self, *args, **kwargs):
+        return self._fl is not None and self._should_log(*args, **kwargs)
+
+    def _gen_message(self, ts, tag, msg_line, *args, **kwargs):
         # raise Exception('Abstract class method not implemented.')
-        return '%s [%s] %s\n' % (str(datetime.now()), tag, msg_line)
+        return '%s [%s] %s\n' % (str(datetime.fromtimestamp(ts)), tag, msg_line)
+
+    def _format(self, ts, tag, message, *args, **kwargs):
+        return ''.join([ self._gen_message(ts, tag, line, *args, **kwargs) for line in message.split('\n') ])
 
     def log(self, tag, message, *args, **kwargs):
-        self.mutex.acquire()
-        if not self._fl or not self._should_log(*args, **kwargs):
-            self.mutex.release()
+        if not self.enabled(*args, **kwargs):
             return
-        for line in message.split('\n'):
-            self._fl.write(self._gen_message(tag, line, *args, **kwargs))
+        if self._queue:
+            self._queue.put((time.time(), tag, message, args, kwargs))
+            return
+        self.mutex.acquire()
+        if self._fl:
+            self._fl.write(self._format(time.time(), tag, message, *args, **kwargs))
             self._fl.flush()
         self.mutex.release()
 
+    def _start_writer(self):
+        if not self._fl:
+            return
+        self._queue = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _write_loop(self):
+        running = True
+        while running:
+            batch = [ self._queue.get() ]
+            try:
+                while len(batch) < LOG_WRITE_BATCH:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            chunks = []
+            for item in batch:
+                if item is None:
+                    running = False
+                    continue
+                ts, tag, message, args, kwargs = item
+                try:
+                    chunks.append(self._format(ts, tag, message, *args, **kwargs))
+                except Exception as e:
+                    chunks.append(self._format(ts, tag, f'Bad log message {message!r}: {e}'))
+            self._fl.write(''.join(chunks))
+            self._fl.flush()
+
     def _write_gen_message(self, msg):
         return msg
 
     def write(self, msg):
+        if self._queue:
+            self._queue.put((time.time(), 'DIRECT', msg, (-1,), {}))
+            return
         self.mutex.acquire()
         if self._fl:
             self._fl.write(self._write_gen_message(msg))
         self.mutex.release()
 
     def flush(self):
+        if self._queue:
+            return
         self.mutex.acquire()
         if self._fl:
             self._fl.flush()
@@ -76,9 +133,20 @@ class FileLogger:
             return
         self.log(tag, ''.join(traceback.format_exception(None, e, e.__traceback__)))
 
+    # Waits for the background writer to drain its queue.
+    def close(self):
+        if self._writer:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+            self._queue = None
+        if self._fl:
+            self._fl.close()
+            self._fl = None
+
     def __del__(self):
         #self.mutex.acquire()
-        if self._fl:
+        if self._fl and not self._writer:
             self._fl.close()
             self._fl = None
         #self.mutex.release()
@@ -87,25 +155,111 @@ class GlobalFileLogger(FileLogger):
     def __init__(self, lvl = 0):
         super().__init__(os.path.join(DEFAULT_RUNTIME_DIR, 'run.log'), mode='a', emergency_out=sys.stderr)
         self.lvl = lvl
-        self._fl.write('\n')
-        self._fl.flush()
+        if self._fl:
+            self._fl.write('\n')
+            self._fl.flush()
+        self._start_writer()
 
     def _should_log(self, *args, **kwargs):
         lvl = (len(args) > 0) and args[0] or 0
         return lvl <= self.lvl
 
-    def _gen_message(self, tag, msg_line, *args, **kwargs):
+    # Extra arguments after the level are %-formatted into the message by the
+    # writer thread, so disabled or hot-path messages cost almost nothing.
+    def _gen_message(self, ts, tag, msg_line, *args, **kwargs):
         lvl = (len(args) > 0) and args[0] or 0
-        return '%s %d [%s] %s\n' % (str(datetime.now()), lvl, tag, msg_line)
+        return '%s %d [%s] %s\n' % (str(datetime.fromtimestamp(ts)), lvl, tag, msg_line)
+
+    def _format(self, ts, tag, message, *args, **kwargs):
+        if len(args) > 1:
+            message = message % args[1:]
+        return super()._format(ts, tag, message, *args[:1], **kwargs)
 
     def _write_gen_message(self, msg):
         return '%s -1 [DIRECT] %s\n' % (str(datetime.now()), msg)
 
+# Only written by the reader of its task, the mutex is shared with the
+# Watchdog flushing logs that went quiet. Output is buffered and flushed when
+# OUTPUT_BUFFER_SIZE is exceeded or OUTPUT_FLUSH_INTERVAL seconds passed since
+# the last flush.
 class TaskFileLogger(FileLogger):
-    def __init__(self, global_start_ts, index, emergency_out):
-        ts_str = global_start_ts.strftime('%Y%m%d-%H%M%S')
-        output_path = os.path.join(DEFAULT_RUNTIME_DIR, ts_str, f'{index}.output')
-        super().__init__(output_path, emergency_out=emergency_out)
+    def __init__(self, global_start_ts, index, emergency_out, compress=False, ts_format='abs', mode='w'):
+        output_path = os.path.join(run_dir(global_start_ts), f'{index}.output')
+        if compress:
+            output_path += '.gz'
+        super().__init__(output_path, mode=mode, emergency_out=emergency_out,
+                buffering=OUTPUT_BUFFER_SIZE, compress=compress)
+        self.ts_format = ts_format
+        self.last_ts = time.monotonic()
+        self.last_flush = self.last_ts
+        self.unflushed = False
+        self._sec = None
+        self._sec_str = ''
+        # Delta timestamps are relative to the previous line, the first one
+        # to this header.
+        if self._fl and ts_format == 'delta' and mode == 'w':
+            self._fl.write('# start %s\n' % self._abs_ts())
 
-    def _write_gen_message(self, msg):
-        return '%s: %s' % (str(datetime.now()), msg)
+    # Same format as str(datetime.now()), without building a datetime for
+    # every line.
+    def _abs_ts(self):
+        ts = time.time()
+        sec = int(ts)
+        if sec != self._sec:
+            self._sec = sec
+            self._sec_str = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(sec))
+        return '%s.%06d' % (self._sec_str, int((ts - sec) * 1000000))
+
+    def _prefix(self, now):
+        if self.ts_format == 'abs':
+            return self._abs_ts() + ': '
+        if self.ts_format == 'delta':
+            delta = now - self.last_ts
+            self.last_ts = now
+            return '+%.3f: ' % delta
+        return ''
+
+    # Lines of one batch were read at the same time and share a timestamp.
+    # The mutex is only taken by flush_stale() otherwise.
+    def write_lines(self, lines):
+        if not self._fl or not lines:
+            return
+        now = time.monotonic()
+        prefix = self._prefix(now)
+        self.mutex.acquire()
+        if self.ts_format == 'delta':
+            self._fl.write(prefix + lines[0] + ''.join([ '+0.000: ' + line for line in lines[1:] ]))
+        else:
+            self._fl.write(''.join([ prefix + line for line in lines ]))
+        self.unflushed = True
+        if now - self.last_flush >= OUTPUT_FLUSH_INTERVAL:
+            self._flush(now)
+        self.mutex.release()
+
+    def write(self, msg):
+        self.write_lines([msg])
+
+    # Must hold self.mutex
+    def _flush(self, now):
+        self._fl.flush()
+        self.last_flush = now
+        self.unflushed = False
+
+    def flush(self):
+        self.mutex.acquire()
+        if self._fl:
+            self._flush(time.monotonic())
+        self.mutex.release()
+
+    # Called periodically, so that the last lines of a task gone quiet do not
+    # wait for its next ones.
+    def flush_stale(self, now):
+        self.mutex.acquire()
+        if self._fl and self.unflushed and now - self.last_flush >= OUTPUT_FLUSH_INTERVAL:
+            self._flush(now)
+        self.mutex.release()
+
+    def close(self):
+        self.mutex.acquire()
+        super().close()
+        self.mutex.release()
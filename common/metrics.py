@@ -0,0 +1,170 @@
+# vim: expandtab smarttab ts=4
+
+import os
+import json
+import time
+import threading
+
+from common.configs import *
+from common.logger import run_dir
+
+# Durations in power of two buckets of microseconds: recording is an int
+# conversion and a list increment, percentiles are upper bounds of buckets.
+class Histogram:
+    BUCKETS = 32
+
+    def __init__(self):
+        self.counts = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        bucket = int(seconds * 1000000).bit_length()
+        self.counts[min(bucket, self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        if self.count == 0:
+            return 0.0
+        wanted = self.count * p / 100.0
+        seen = 0
+        for bucket, n in enumerate(self.counts):
+            seen += n
+            if seen >= wanted:
+                return min((1 << bucket) / 1000000.0, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.count and round(self.total * 1000 / self.count, 3) or 0.0,
+            'p50_ms': round(self.percentile(50) * 1000, 3),
+            'p99_ms': round(self.percentile(99) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+        }
+
+# A Lock recording how long acquire() waited and how long it was held.
+class TimedLock:
+    def __init__(self, wait_hist, hold_hist):
+        self._lock = threading.Lock()
+        self.wait_hist = wait_hist
+        self.hold_hist = hold_hist
+        self.acquired_at = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self.acquired_at = time.perf_counter()
+        self.wait_hist.record(self.acquired_at - start)
+        return True
+
+    def release(self):
+        self.hold_hist.record(time.perf_counter() - self.acquired_at)
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+class Metrics:
+    def __init__(self, tasks_total):
+        self.start = time.monotonic()
+        self.task_lines = [0] * tasks_total
+        self.task_chars = [0] * tasks_total
+        self.task_rates = [0.0] * tasks_total
+        self.sampled_lines = [0] * tasks_total
+        self.sampled_at = self.start
+        self.sample_mutex = threading.Lock()
+        self.lock_wait = Histogram()
+        self.lock_hold = Histogram()
+        # Time the readers spent handing output over to the sink
+        self.handoff = Histogram()
+        self.render = Histogram()
+        self.frames = 0
+        self.frames_dropped = 0
+
+    # Called with the output, the counts only need to be roughly right.
+    def add_output(self, task_id, lines):
+        self.task_lines[task_id - 1] += len(lines)
+        self.task_chars[task_id - 1] += sum(map(len, lines))
+
+    def add_frame(self, seconds, dropped):
+        self.render.record(seconds)
+        self.frames += 1
+        self.frames_dropped += dropped
+
+    # Lines per second of each task since the previous sample, at most one
+    # sample per METRICS_RATE_INTERVAL whoever asks.
+    def sample(self):
+        self.sample_mutex.acquire()
+        now = time.monotonic()
+        elapsed = now - self.sampled_at
+        if elapsed >= METRICS_RATE_INTERVAL:
+            lines = list(self.task_lines)
+            self.task_rates = [ (n - prev) / elapsed for n, prev in zip(lines, self.sampled_lines) ]
+            self.sampled_lines = lines
+            self.sampled_at = now
+        self.sample_mutex.release()
+        return self.task_rates
+
+    def top_tasks(self, n):
+        rates = self.sample()
+        busiest = sorted(range(len(rates)), key=lambda i: rates[i], reverse=True)[:n]
+        return [ (i + 1, rates[i]) for i in busiest if rates[i] > 0 ]
+
+    def snapshot(self):
+        rates = self.sample()
+        return {
+            'uptime_s': round(time.monotonic() - self.start, 3),
+            'lines': sum(self.task_lines),
+            'chars': sum(self.task_chars),
+            'lines_per_s': round(sum(rates), 1),
+            'mutex_wait': self.lock_wait.snapshot(),
+            'mutex_hold': self.lock_hold.snapshot(),
+            'handoff': self.handoff.snapshot(),
+            'handoff_total_s': round(self.handoff.total, 6),
+            'render': self.render.snapshot(),
+            'frames': self.frames,
+            'frames_dropped': self.frames_dropped,
+            'tasks': [ { 'task': i + 1, 'lines': self.task_lines[i], 'chars': self.task_chars[i],
+                    'lines_per_s': round(rates[i], 1) } for i in range(len(rates)) ],
+        }
+
+# Rewrites .para-run/<ts>/metrics.json every METRICS_EXPORT_INTERVAL and
+# once more when stopped.
+class MetricsExporter(threading.Thread):
+    def __init__(self, metrics, start_ts, gfl):
+        super().__init__(daemon=True)
+        self.metrics = metrics
+        self.path = os.path.join(run_dir(start_ts), 'metrics.json')
+        self.gfl = gfl
+        self.stopped = threading.Event()
+        self.log_tag = 'MetricsExporter'
+
+    def export(self):
+        tmp_path = self.path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(tmp_path, 'w') as fout:
+                json.dump(self.metrics.snapshot(), fout, indent=1)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            self.gfl.dump_error(self.log_tag, e)
+
+    def run(self):
+        while not self.stopped.wait(METRICS_EXPORT_INTERVAL):
+            self.export()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.export()
@@ -0,0 +1,177 @@
+# vim: expandtab smarttab ts=4
+
+import json
+import shlex
+import signal
+import threading
+import subprocess
+from collections import deque
+
+from common.configs import *
+from common import argparser
+from common.watchdog import kill_group
+from common.logger import TaskFileLogger
+
+# Relays talk to their parent with one JSON array per line on stdout:
+#   ["s", task_id]              the task started
+#   ["o", task_id, [lines]]     output lines of the task
+#   ["x", task_id, returncode]  the task exited
+#   ["n", task_id, text, event] a note of the relay about the task, see
+#                               Sink.note()
+# task_id is the id the parent gave the task in the relay request, which is
+# the first line of the relay's stdin, a JSON object:
+#   {"args": {option: value}, "tasks": [[task_id, hostid, cmd], ...]}
+# The parent keeps stdin open afterwards. The relay kills its tasks when it
+# gets EOF there, when its stdout breaks, or on SIGTERM.
+
+# Options a relay inherits from its parent.
+RELAY_ARGS = ('jobs', 'host_jobs', 'engine', 'ssh', 'ssh_mux', 'tree_fanout', 'relay_cmd',
+        'timeout', 'task_timeout', 'speculate')
+
+def encode_frame(frame):
+    return (json.dumps(frame, ensure_ascii=False, separators=(',', ':')) + '\n').encode('utf-8')
+
+def decode_frame(line):
+    return json.loads(line.decode('utf-8'))
+
+# Split the remote tasks into at most fanout groups of hosts, each run by a
+# relay on its first host. Nothing is relayed when there are few hosts.
+def plan_relays(specs, fanout):
+    if fanout <= 0:
+        return []
+    tasks_by_host = {}
+    for i, (hostid, cmd) in enumerate(specs):
+        if hostid is not None:
+            tasks_by_host.setdefault(hostid, []).append(i + 1)
+    hosts = sorted(tasks_by_host)
+    if len(hosts) <= fanout:
+        return []
+
+    groups = []
+    group_size = (len(hosts) + fanout - 1) // fanout
+    for start in range(0, len(hosts), group_size):
+        group_hosts = hosts[start:start + group_size]
+        task_ids = []
+        for hostid in group_hosts:
+            task_ids += tasks_by_host[hostid]
+        groups.append((group_hosts[0], sorted(task_ids)))
+    return groups
+
+def gen_relay_request(args, specs, task_ids):
+    return {
+        'args': { key: getattr(args, key) for key in RELAY_ARGS },
+        'tasks': [ [ task_id ] + list(specs[task_id - 1]) for task_id in task_ids ],
+    }
+
+# Starts a relay for some tasks of a sink and feeds the frames it sends back
+# into the sink as if those tasks ran here.
+class RelayTask(threading.Thread):
+    def __init__(self, sink, hostid, task_ids):
+        super().__init__()
+        self.sink = sink
+        self.hostid = hostid
+        self.task_ids = task_ids
+        self.host = HOST_NAME_FMT % hostid
+        self.log_tag = f'Relay {self.host}'
+        self.stderr_tail = deque(maxlen=RELAY_STDERR_TAIL)
+        self.proc = None
+        self.killed = False
+        # task_id -> the output log of the task with -l, written here like
+        # the ones of local tasks
+        self.sfls = {}
+
+    def _read_stderr(self, stderr):
+        for line in iter(stderr.readline, b''):
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            self.stderr_tail.append(line)
+            self.sink.gfl.log(self.log_tag, 'stderr: %s', 0, line)
+
+    def _open_log(self, task_id):
+        sink = self.sink
+        if not sink.log_output or task_id in self.sfls:
+            return
+        self.sfls[task_id] = TaskFileLogger(sink.start_ts, task_id, emergency_out=sink.gfl,
+                compress=sink.log_compress, ts_format=sink.log_ts)
+
+    def _close_log(self, task_id):
+        sfl = self.sfls.pop(task_id, None)
+        if sfl:
+            sfl.close()
+
+    def _output(self, task_id, lines):
+        self.sink.append_lines(task_id, lines)
+        self._open_log(task_id)
+        if task_id in self.sfls:
+            self.sfls[task_id].write_lines(lines)
+
+    def _dispatch(self, frame):
+        kind, task_id = frame[0], frame[1]
+        if task_id not in self.unfinished:
+            return
+        if kind == 'o':
+            self._output(task_id, frame[2])
+        elif kind == 's':
+            self._open_log(task_id)
+            self.sink.mark_started(task_id)
+        elif kind == 'n':
+            self.sink.note(task_id, frame[2], **frame[3])
+        elif kind == 'x':
+            self.unfinished.discard(task_id)
+            self._close_log(task_id)
+            self.sink.mark_finished(task_id, frame[2])
+
+    # The relay kills its tasks on SIGTERM, which reaches it when it runs
+    # here, and on EOF on its stdin, which reaches it through ssh otherwise.
+    def kill(self):
+        self.killed = True
+        if self.proc:
+            kill_group(self.proc, signal.SIGTERM)
+            self._close_stdin()
+
+    def _close_stdin(self):
+        try:
+            self.proc.stdin.close()
+        except OSError:
+            pass
+
+    def run(self):
+        args = self.sink.args
+        self.unfinished = set(self.task_ids)
+        request = gen_relay_request(args, self.sink.specs, self.task_ids)
+        cmd = args.relay_cmd.format(ssh=argparser.gen_ssh_prefix(args), host=shlex.quote(self.host))
+        self.sink.gfl.log(self.log_tag, 'Start relay for %d tasks: %s', 0, len(self.task_ids), cmd)
+
+        returncode = None
+        try:
+            proc = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+            self.proc = proc
+            if self.killed:
+                kill_group(proc, signal.SIGTERM)
+            stderr_reader = threading.Thread(target=self._read_stderr, args=(proc.stderr,), daemon=True)
+            stderr_reader.start()
+            try:
+                proc.stdin.write(json.dumps(request).encode('utf-8') + b'\n')
+                proc.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                pass
+            for line in proc.stdout:
+                try:
+                    self._dispatch(decode_frame(line))
+                except (ValueError, IndexError, TypeError) as e:
+                    self.sink.gfl.log(self.log_tag, 'Bad frame %r: %s', 0, line, e)
+            self._close_stdin()
+            returncode = proc.wait()
+            stderr_reader.join()
+        except Exception as e:
+            self.sink.gfl.dump_error(self.log_tag, e)
+
+        # Whatever the relay did not report is lost
+        reason = '\n'.join(self.stderr_tail) or 'no error output'
+        for task_id in sorted(self.unfinished):
+            if self.sink.tasks_pending_status[task_id - 1]:
+                self.sink.mark_started(task_id)
+            self._output(task_id, [ f'para-run: relay on {self.host} exited ({returncode}): {reason}\n' ])
+            self._close_log(task_id)
+            self.sink.mark_finished(task_id, RELAY_FAILED_RETURNCODE)
+        self.sink.gfl.log(self.log_tag, 'Relay exited with %s.', 0, returncode)
@@ -0,0 +1,232 @@
+# vim: expandtab smarttab ts=4
+
+import os
+import re
+import gzip
+import json
+import mmap
+import struct
+from array import array
+from itertools import accumulate
+
+from common.configs import *
+
+RUN_INFO_FILE = 'run.json'
+INDEX_MAGIC = b'PRIX'
+# magic, version, step, file size, file mtime_ns, lines, last line unterminated
+INDEX_HEADER = struct.Struct('<4sIIQQQ?')
+INDEX_VERSION = 1
+
+TS_PREFIXES = {
+    'abs': re.compile(r'\d{4}-\d\d-\d\d \d\d:\d\d:\d\d\.\d{6}: '),
+    'delta': re.compile(r'\+\d+\.\d{3}: '),
+}
+
+# run.json of a run directory, written while running with -l.
+def save_run_info(path, info):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fout:
+        json.dump(info, fout, indent=1)
+    os.replace(tmp_path, path)
+
+# Offsets of every step-th line of the file mapped in mm, the first one being
+# line 0 at offset 0. Newlines are found by bytes.split() and summing the
+# lengths of the pieces, both in C.
+def build_index(mm, step):
+    offsets = array('Q', [0])
+    size = len(mm)
+    lines = 0
+    pos = 0
+    while pos < size:
+        chunk = mm[pos:pos + REPLAY_INDEX_CHUNK]
+        pieces = chunk.split(b'\n')
+        # The last piece goes on in the next chunk
+        n = len(pieces) - 1
+        if n:
+            ends = list(accumulate(map(len, pieces[:-1])))
+            # Line lines + k + 1 starts after the k-th newline of the chunk
+            first = (-(lines + 1)) % step
+            offsets.extend([ pos + ends[k] + k + 1 for k in range(first, n, step) ])
+        lines += n
+        pos += len(chunk)
+    # Lines are counted by their end, an unterminated last line included
+    last_partial = size > 0 and mm[size - 1:size] != b'\n'
+    if last_partial:
+        lines += 1
+    return offsets, lines, last_partial
+
+# A task output log of a past run, read through mmap. Only the offsets of
+# every REPLAY_INDEX_STEP-th line are kept, in memory and in a .idx file next
+# to the log, so opening a log the second time reads nothing but the index
+# and showing a line touches only the pages around it. Same interface as
+# Scrollback for SubPad and Search.
+class MappedLog:
+    def __init__(self, path, ts_format):
+        self.path = path
+        self.step = REPLAY_INDEX_STEP
+        self.prefix = TS_PREFIXES.get(ts_format)
+        self.fin = open(path, 'rb')
+        st = os.fstat(self.fin.fileno())
+        self.mm = st.st_size and mmap.mmap(self.fin.fileno(), 0, access=mmap.ACCESS_READ) or b''
+        if not self._load_index(st):
+            self.offsets, self.total, self.partial = build_index(self.mm, self.step)
+            self._save_index(st)
+        # Delta timestamps start with a header line
+        self.first = 0
+        if ts_format == 'delta' and self.mm[:8] == b'# start ':
+            self.first = 1
+            self.total -= 1
+
+    def _index_path(self):
+        return self.path + '.idx'
+
+    def _load_index(self, st):
+        try:
+            with open(self._index_path(), 'rb') as fin:
+                header = INDEX_HEADER.unpack(fin.read(INDEX_HEADER.size))
+                magic, version, step, size, mtime_ns, lines, partial = header
+                if (magic, version, step, size, mtime_ns) != (INDEX_MAGIC, INDEX_VERSION, self.step, st.st_size, st.st_mtime_ns):
+                    return False
+                offsets = array('Q')
+                offsets.frombytes(fin.read())
+        except (OSError, struct.error, ValueError):
+            return False
+        self.offsets, self.total, self.partial = offsets, lines, partial
+        return True
+
+    def _save_index(self, st):
+        try:
+            with open(self._index_path(), 'wb') as fout:
+                fout.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, self.step,
+                        st.st_size, st.st_mtime_ns, self.total, self.partial))
+                self.offsets.tofile(fout)
+        except OSError:
+            # A read-only run directory, index again next time
+            pass
+
+    def _line_start(self, i):
+        pos = self.offsets[i // self.step]
+        for k in range(i % self.step):
+            pos = self.mm.find(b'\n', pos) + 1
+        return pos
+
+    def _strip(self, line):
+        if self.prefix:
+            m = self.prefix.match(line)
+            if m:
+                return line[m.end():]
+        return line
+
+    def line_count(self):
+        return self.total + (not self.partial and 1 or 0)
+
+    def complete_lines(self):
+        return self.total - (self.partial and 1 or 0)
+
+    def get_line(self, i):
+        if i >= self.total or i < 0:
+            return ''
+        start = self._line_start(i + self.first)
+        end = self.mm.find(b'\n', start)
+        if end < 0:
+            end = len(self.mm)
+        return self._strip(self.mm[start:end].decode('utf-8', 'replace'))
+
+    def search(self, search, start, end):
+        found = []
+        line_no = start
+        while line_no < end:
+            chunk_end = min(end, (line_no + self.first) // self.step * self.step + self.step - self.first)
+            lo = self._line_start(line_no + self.first)
+            if chunk_end < self.total:
+                hi = self._line_start(chunk_end + self.first)
+            else:
+                hi = len(self.mm)
+            lines = self.mm[lo:hi].decode('utf-8', 'replace').split('\n')[:chunk_end - line_no]
+            found += [ line_no + k for k in search.match_lines([ self._strip(line) for line in lines ]) ]
+            line_no = chunk_end
+        return found
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        self.fin.close()
+
+# A run directory written with -l: the run.json of the run if there is one,
+# otherwise whatever <idx>.output files are there.
+class ReplayRun:
+    def __init__(self, path):
+        self.path = path
+        self.info = {}
+        info_path = os.path.join(path, RUN_INFO_FILE)
+        if os.path.exists(info_path):
+            with open(info_path) as fin:
+                self.info = json.load(fin)
+        self.tasks = self.info.get('tasks') or self._scan_tasks()
+        self.ts_format = self.info.get('log_ts', 'abs')
+
+    def _scan_tasks(self):
+        ids = set()
+        for name in os.listdir(self.path):
+            m = re.match(r'(\d+)\.output(\.gz)?$', name)
+            if m:
+                ids.add(int(m.group(1)))
+        return [ { 'task': i, 'host': None, 'cmd': '(unknown)', 'returncode': None } for i in sorted(ids) ]
+
+    # A gzipped log is inflated next to it once, it cannot be mapped. The log
+    # of a run still going or that crashed has no end marker, what was
+    # flushed until then is kept.
+    def log_path(self, task_id):
+        path = os.path.join(self.path, f'{task_id}.output')
+        if os.path.exists(path):
+            return path
+        gz_path = path + '.gz'
+        raw_path = path + '.raw'
+        if not os.path.exists(gz_path):
+            return None
+        if not os.path.exists(raw_path) or os.path.getmtime(raw_path) < os.path.getmtime(gz_path):
+            tmp_path = raw_path + '.tmp'
+            try:
+                with gzip.open(gz_path, 'rb') as fin, open(tmp_path, 'wb') as fout:
+                    try:
+                        # read1() hands over what it inflated before the end
+                        chunk = fin.read1(REPLAY_INDEX_CHUNK)
+                        while chunk:
+                            fout.write(chunk)
+                            chunk = fin.read1(REPLAY_INDEX_CHUNK)
+                    except (OSError, EOFError):
+                        pass
+                os.replace(tmp_path, raw_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        return raw_path
+
+    def specs(self):
+        return [ (task['host'], task['cmd']) for task in self.tasks ]
+
+    def open_logs(self):
+        logs = []
+        for task in self.tasks:
+            path = self.log_path(task['task'])
+            logs.append(path and MappedLog(path, self.ts_format) or EmptyLog())
+        return logs
+
+# Stands in for the log of a task that wrote none.
+class EmptyLog:
+    partial = False
+
+    def line_count(self):
+        return 1
+
+    def complete_lines(self):
+        return 0
+
+    def get_line(self, i):
+        return ''
+
+    def search(self, search, start, end):
+        return []
+
+    def close(self):
+        pass
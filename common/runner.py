@@ -1,43 +1,253 @@
 # vim: expandtab smarttab ts=4
 
 import os
+import time
+import resource
 import threading
 import subprocess
+import selectors
+from collections import deque
 
 from common.logger import TaskFileLogger
+from common.ingest import LineSplitter
 from common.configs import *
 
 class Task(threading.Thread):
-    def __init__(self, cmd, window_handler, thrd_index):
+    def __init__(self, cmd, window_handler, thrd_index, copy_host = None, log_mode = 'w'):
         super().__init__()
         self.cmd = cmd
         self.wh = window_handler
         self.index = thrd_index
         self.log_tag = f'Task {self.index}'
+        self.sfl = None
+        self.subp = None
+        self.splitter = LineSplitter()
+        # A speculative copy of a straggling task on host copy_host. Its output
+        # is held back until it wins, see Sink.attempt_finished().
+        self.copy_host = copy_host
+        self.held = []
+        # Lost to another attempt of the same task, the output is dropped
+        self.discarded = False
+        # The task goes on with another command (the next --items item),
+        # appended to the same log
+        self.continued = False
+        self.log_mode = log_mode
+        self.started_at = None
+        # The unterminated line last shown, see feed_live_line()
+        self.live_line = ''
+        # Output read from the pipe, and the resource usage of the exited
+        # child, see reap()
+        self.bytes_read = 0
+        self.lines_read = 0
+        self.rusage = None
+        # The peak RSS of para-run when the child was spawned, in bytes
+        self.rss_floor = 0
+
+    # Whether the task is over for the scheduler when this attempt ends.
+    # Copies run outside of its limits.
+    def owns_slot(self):
+        return self.copy_host is None and not self.continued
 
     def run(self):
-        if not self.cmd:    return
+        try:
+            self._run()
+        finally:
+            if self.owns_slot():
+                self.wh.scheduler.task_done(self.index)
+
+    def _run(self):
+        if not self.spawn():
+            self.finish(NOT_SPAWNED_RETCODE)
+            return
+
+        fd = self.subp.stdout.fileno()
+        while True:
+            data = os.read(fd, INGEST_READ_SIZE)
+            if not data:
+                break
+            self.feed_data(data)
+        self.feed_eof()
+        self.subp.stdout.close()
+
+        self.finish(self.reap(True))
+
+    # The helpers below are shared with SelectorEngine, which drives Task
+    # objects from its own loop instead of starting them as threads.
+    def spawn(self):
+        if not self.cmd:    return False
 
         self.wh.gfl.log(self.log_tag, 'Thread start. ' + repr(self), 0)
 
-        sfl = None
         if self.wh.log_output:
-            sfl = TaskFileLogger(self.wh.start_ts, self.index, emergency_out=self.wh.gfl)
+            name = self.index
+            if self.copy_host is not None:
+                name = '%d.%s' % (self.index, HOST_NAME_FMT % self.copy_host)
+            self.sfl = TaskFileLogger(self.wh.start_ts, name, emergency_out=self.wh.gfl,
+                    compress=self.wh.log_compress, ts_format=self.wh.log_ts, mode=self.log_mode)
+
+        # In its own process group, so that a timeout kills everything the
+        # command started. Ctrl-C is handled by para-run, see Sink.kill_all().
+        self.subp = subprocess.Popen(self.cmd, shell = True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                start_new_session=True)
+        self.started_at = time.time()
+        self.rss_floor = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        self.wh.add_attempt(self)
+        return True
+
+    # Waits for the child with wait4() to get its resource usage as well.
+    # Returns its return code, None if it is still running and not block.
+    def reap(self, block):
+        try:
+            pid, status, self.rusage = os.wait4(self.subp.pid, not block and os.WNOHANG or 0)
+        except ChildProcessError:
+            return self.subp.wait()
+        if pid == 0:
+            return None
+        # Popen must not wait for it again
+        self.subp.returncode = os.waitstatus_to_exitcode(status)
+        return self.subp.returncode
 
-        subp = subprocess.Popen(self.cmd, shell = True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    def feed_data(self, data):
+        self.bytes_read += len(data)
+        self.feed(self.splitter.feed(data))
+        self.feed_live_line()
 
-        for line in iter(subp.stdout.readline, b""):
-            line = line.decode('utf-8')
-            self.wh.append_line(self.index, line)
-            if sfl:
-                sfl.write(line)
-                sfl.flush()
+    def feed_eof(self):
+        self.feed(self.splitter.flush())
+        self.feed_live_line()
 
-        returncode = subp.wait()
+    # The line a progress bar keeps rewriting is shown before it ends
+    def feed_live_line(self):
+        line = self.splitter.current()
+        if line == self.live_line or self.copy_host is not None or self.discarded:
+            return
+        self.live_line = line
+        self.wh.set_live_line(self.index, line)
 
-        self.wh.mark_finished(self.index, returncode)
+    def feed(self, lines):
+        if not lines or self.discarded:
+            return
+        self.lines_read += len(lines)
+        if self.copy_host is None:
+            self.wh.append_lines(self.index, lines)
+        else:
+            self.held += lines
+        if self.sfl:
+            self.sfl.write_lines(lines)
+
+    def finish(self, returncode):
+        if self.sfl:
+            self.sfl.close()
+        self.wh.attempt_finished(self, returncode)
 
         self.wh.gfl.log(self.log_tag, 'Thread end. ' + repr(self), 0)
 
     def __repr__(self):
         return f'[Task:idx={self.index},cmd="{self.cmd}"]'
+
+# One thread per task, each blocked in os.read() on its own pipe and handing
+# the chunks to its LineSplitter.
+class ThreadEngine:
+    def __init__(self, window_handler):
+        self.wh = window_handler
+        self.thrd_pool = deque()
+
+    def start(self):
+        pass
+
+    def spawn(self, task):
+        self.thrd_pool.append(task)
+        task.start()
+
+    # Finishing tasks may start others until the run is over
+    def join(self):
+        while self.thrd_pool:
+            self.thrd_pool.popleft().join()
+
+# A single thread multiplexing the pipes of all tasks with selectors.
+class SelectorEngine(threading.Thread):
+    # Children that closed stdout but did not exit yet are polled this often.
+    REAP_INTERVAL = 0.1
+
+    def __init__(self, window_handler):
+        super().__init__()
+        self.wh = window_handler
+        self.sel = selectors.DefaultSelector()
+        self.spawn_queue = deque()
+        self.wake_r, self.wake_w = os.pipe()
+        self.sel.register(self.wake_r, selectors.EVENT_READ, None)
+        self.reaping = []
+        self.live = 0
+        self.stopping = False
+        self.log_tag = 'SelectorEngine'
+
+    # Might be called from any thread.
+    def spawn(self, task):
+        self.spawn_queue.append(task)
+        os.write(self.wake_w, b'x')
+
+    def join(self):
+        self.stopping = True
+        os.write(self.wake_w, b'x')
+        super().join()
+
+    def _start_queued(self):
+        while self.spawn_queue:
+            task = self.spawn_queue.popleft()
+            try:
+                spawned = task.spawn()
+            except Exception as e:
+                self.wh.gfl.dump_error(self.log_tag, e)
+                spawned = False
+            if not spawned:
+                task.finish(NOT_SPAWNED_RETCODE)
+                if task.owns_slot():
+                    self.wh.scheduler.task_done(task.index)
+                continue
+            self.live += 1
+            self.sel.register(task.subp.stdout, selectors.EVENT_READ, task)
+
+    def _read(self, task):
+        data = os.read(task.subp.stdout.fileno(), INGEST_READ_SIZE)
+        if not data:
+            self.sel.unregister(task.subp.stdout)
+            task.subp.stdout.close()
+            task.feed_eof()
+            self.reaping.append(task)
+            return
+
+        task.feed_data(data)
+
+    def _reap(self):
+        still_running = []
+        for task in self.reaping:
+            returncode = task.reap(False)
+            if returncode is None:
+                still_running.append(task)
+                continue
+            self.live -= 1
+            task.finish(returncode)
+            if task.owns_slot():
+                self.wh.scheduler.task_done(task.index)
+        self.reaping = still_running
+
+    def run(self):
+        while not (self.stopping and self.live == 0 and not self.spawn_queue):
+            timeout = self.reaping and self.REAP_INTERVAL or None
+            for key, events in self.sel.select(timeout):
+                if key.data is None:
+                    os.read(self.wake_r, INGEST_READ_SIZE)
+                    self._start_queued()
+                else:
+                    self._read(key.data)
+            if self.reaping:
+                self._reap()
+
+        self.sel.close()
+        os.close(self.wake_r)
+        os.close(self.wake_w)
+
+ENGINES = {
+    'thread': ThreadEngine,
+    'selector': SelectorEngine,
+}
@@ -0,0 +1,122 @@
+# vim: expandtab smarttab ts=4
+
+import threading
+from collections import deque
+
+from common.configs import *
+
+class Scheduler:
+    def __init__(self, wh, specs, jobs = 0, host_jobs = 0, admission = None):
+        self.wh = wh
+        self.specs = specs
+        # 0 means unlimited
+        self.jobs = jobs
+        self.host_jobs = host_jobs
+        # Holds local tasks back while the machine is busy, see repump()
+        self.admission = admission
+        self.admission_status = None
+        self.pending = deque(range(1, len(specs) + 1))
+        self.running = set()
+        self.host_running = {}
+        self.local_running = 0
+        self.launcher = None
+        self.cancelled = False
+        self.mutex = threading.Lock()
+        self.log_tag = 'Scheduler'
+
+    def _host(self, task_id):
+        return self.specs[task_id - 1][0]
+
+    def _slots_full(self):
+        return self.jobs > 0 and len(self.running) >= self.jobs
+
+    # The local machine is the host of local tasks
+    def _host_full(self, host):
+        if host is None:
+            return self.admission is not None and not self.admission.admit(self.local_running)
+        return self.host_jobs > 0 and self.host_running.get(host, 0) >= self.host_jobs
+
+    # Pick every pending task that fits in the limits, keeping the queue order
+    # of the ones left behind. Must hold self.mutex.
+    def _pump(self):
+        launched = []
+        if self.cancelled or not self.launcher:
+            return launched
+
+        blocked = []
+        while self.pending and not self._slots_full():
+            task_id = self.pending.popleft()
+            host = self._host(task_id)
+            if self._host_full(host):
+                blocked.append(task_id)
+                continue
+            self.running.add(task_id)
+            if host is not None:
+                self.host_running[host] = self.host_running.get(host, 0) + 1
+            else:
+                self.local_running += 1
+            launched.append(task_id)
+        self.pending.extendleft(reversed(blocked))
+        return launched
+
+    def _launch(self, launched):
+        if self.admission and self.admission.status != self.admission_status:
+            self.admission_status = self.admission.status
+            self.wh.set_admission_status(self.admission_status)
+        for task_id in launched:
+            self.wh.gfl.log(self.log_tag, 'launch task %d', 1, task_id)
+            self.launcher(task_id)
+
+    def start(self, launcher):
+        self.mutex.acquire()
+        self.launcher = launcher
+        launched = self._pump()
+        self.mutex.release()
+        self._launch(launched)
+
+    def task_done(self, task_id):
+        self.mutex.acquire()
+        if task_id in self.running:
+            self.running.remove(task_id)
+            host = self._host(task_id)
+            if host is not None:
+                self.host_running[host] -= 1
+            else:
+                self.local_running -= 1
+        launched = self._pump()
+        self.mutex.release()
+        self._launch(launched)
+
+    # The limits of admission control change without any task exiting, so
+    # the tasks it holds back are retried periodically.
+    def repump(self):
+        self.mutex.acquire()
+        launched = self._pump()
+        self.mutex.release()
+        self._launch(launched)
+
+    # Launch the pending tasks in the order of key instead, e.g. the longest
+    # first (--longest-first). Must be called before start().
+    def sort_pending(self, key):
+        self.mutex.acquire()
+        self.pending = deque(sorted(self.pending, key=key))
+        self.mutex.release()
+
+    # Take tasks out of the queue, they are run by someone else.
+    def remove(self, task_ids):
+        self.mutex.acquire()
+        task_ids = set(task_ids)
+        self.pending = deque([ task_id for task_id in self.pending if task_id not in task_ids ])
+        self.mutex.release()
+
+    # Drop everything still queued, e.g. when the user interrupts the run.
+    def cancel(self):
+        self.mutex.acquire()
+        self.cancelled = True
+        cancelled = list(self.pending)
+        self.pending.clear()
+        self.mutex.release()
+        return cancelled
+
+    def counts(self):
+        return len(self.running), len(self.pending)
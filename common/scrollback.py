@@ -0,0 +1,127 @@
+# vim: expandtab smarttab ts=4
+
+import os
+from collections import OrderedDict
+
+from common.configs import *
+from common.search import Bloom
+from common import ansi
+
+# Per-task output store. The most recent lines are kept in memory, older ones
+# are spilled to segment files of SCROLLBACK_SEGMENT_LINES lines each and paged
+# back in on demand. Not thread-safe, callers hold WindowHandler.mutex.
+class Scrollback:
+    def __init__(self, spill_dir, index, max_lines = DEFAULT_SCROLLBACK_LINES):
+        self.spill_dir = spill_dir
+        self.index = index
+        self.segment_lines = SCROLLBACK_SEGMENT_LINES
+        self.max_lines = max(max_lines, self.segment_lines)
+        # In-memory lines are [self.mem_start, self.total)
+        self.lines = []
+        self.mem_start = 0
+        self.total = 0
+        # The last line has not been terminated by '\n' yet
+        self.partial = False
+        # The line being written but not yet terminated, shown on the line
+        # after the last one until it is appended
+        self.live_line = ''
+        self.spilled_segments = 0
+        self.cache = OrderedDict()
+        # Spilled segments searched at least once, see search()
+        self.blooms = {}
+
+    def _segment_path(self, segno):
+        return os.path.join(self.spill_dir, f'{self.index}.{segno}')
+
+    def _spill(self):
+        seg = self.lines[:self.segment_lines]
+        if self.spilled_segments == 0:
+            os.makedirs(self.spill_dir, mode=0o755, exist_ok=True)
+        with open(self._segment_path(self.spilled_segments), 'w', encoding='utf-8', newline='') as fout:
+            fout.write('\n'.join(seg))
+        del self.lines[:self.segment_lines]
+        self.mem_start += self.segment_lines
+        self.spilled_segments += 1
+
+    def _load_segment(self, segno):
+        seg = self.cache.get(segno)
+        if seg is not None:
+            self.cache.move_to_end(segno)
+            return seg
+        with open(self._segment_path(segno), encoding='utf-8', newline='') as fin:
+            seg = fin.read().split('\n')
+        self.cache[segno] = seg
+        if len(self.cache) > SCROLLBACK_CACHED_SEGMENTS:
+            self.cache.popitem(last=False)
+        return seg
+
+    def append_text(self, text):
+        if not text:
+            return
+        new_lines = text.split('\n')
+        # A trailing '\n' leaves an empty string behind
+        ends_with_newline = new_lines[-1] == ''
+        if ends_with_newline:
+            new_lines.pop()
+        if self.partial and new_lines:
+            self.lines[-1] += new_lines[0]
+            new_lines = new_lines[1:]
+        self.lines += new_lines
+        self.total += len(new_lines)
+        self.partial = not ends_with_newline
+        while len(self.lines) >= self.max_lines + self.segment_lines:
+            self._spill()
+
+    # Number of lines a viewer may scroll over. Like a terminal, a cursor is
+    # left on an empty line after a terminated line.
+    def line_count(self):
+        return self.total + (not self.partial and 1 or 0)
+
+    def complete_lines(self):
+        return self.total - (self.partial and 1 or 0)
+
+    def get_line(self, i):
+        if i == self.total and not self.partial:
+            return self.live_line
+        if i >= self.total or i < 0:
+            return ''
+        if i >= self.mem_start:
+            return self.lines[i - self.mem_start]
+        segno = i // self.segment_lines
+        return self._load_segment(segno)[i % self.segment_lines]
+
+    # Line numbers in [start, end) matched by search. A spilled segment gets a
+    # trigram bloom filter the first time it is loaded for a search, later
+    # searches only load the segments that may contain their trigrams.
+    def search(self, search, start, end):
+        found = []
+        line_no = start
+        while line_no < end:
+            if line_no >= self.mem_start:
+                chunk_end = end
+                lines = self.lines[line_no - self.mem_start:end - self.mem_start]
+            else:
+                segno = line_no // self.segment_lines
+                seg_start = segno * self.segment_lines
+                chunk_end = min(seg_start + self.segment_lines, end)
+                bloom = self.blooms.get(segno)
+                if bloom is not None and search.grams and not bloom.may_contain(search.grams):
+                    line_no = chunk_end
+                    continue
+                seg = self._load_segment(segno)
+                if bloom is None:
+                    # Of the text matched, see Search.match_lines()
+                    self.blooms[segno] = Bloom('\n'.join([ ansi.strip(line) for line in seg ]))
+                lines = seg[line_no - seg_start:chunk_end - seg_start]
+            found += [ line_no + k for k in search.match_lines(lines) ]
+            line_no = chunk_end
+        return found
+
+    def close(self):
+        for segno in range(self.spilled_segments):
+            try:
+                os.remove(self._segment_path(segno))
+            except OSError:
+                pass
+        self.cache.clear()
+        self.blooms.clear()
@@ -0,0 +1,124 @@
+# vim: expandtab smarttab ts=4
+
+import re
+from bisect import bisect_left, bisect_right
+try:
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
+from common.configs import *
+from common import ansi
+
+def _trigrams(text):
+    return set(zip(text, text[1:], text[2:]))
+
+# Lowercased trigrams every match of regex contains: the ones of the literal
+# runs at the top level of the pattern. Empty when there are none.
+def required_grams(regex):
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return set()
+    grams = set()
+    run = []
+    for op, av in list(parsed) + [ (None, None) ]:
+        if op == sre_parse.LITERAL:
+            run.append(chr(av))
+            continue
+        text = ''.join(run).lower()
+        # Lowercasing may change the length of other characters
+        if text.isascii():
+            grams |= _trigrams(text)
+        run = []
+    return grams
+
+# Trigrams of the lowercased text of a scrollback segment in a bit array.
+class Bloom:
+    def __init__(self, text):
+        bits = bytearray(SEARCH_BLOOM_BITS >> 3)
+        mask = SEARCH_BLOOM_BITS - 1
+        for gram in _trigrams(text.lower()):
+            h = hash(gram) & mask
+            bits[h >> 3] |= 1 << (h & 7)
+        self.bits = bytes(bits)
+
+    def may_contain(self, grams):
+        mask = SEARCH_BLOOM_BITS - 1
+        for gram in grams:
+            h = hash(gram) & mask
+            if not self.bits[h >> 3] & (1 << (h & 7)):
+                return False
+        return True
+
+# The matches of a regex in scrollbacks. update() only looks at the lines
+# added since its previous call on the same scrollback, so the counts follow
+# the output as it arrives.
+class Search:
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.regex = re.compile(pattern)
+        # Rules out a whole chunk of lines joined with '\n' at once. \A and
+        # \Z would only match at the ends of the chunk.
+        self.chunk_regex = None
+        if '\\A' not in pattern and '\\Z' not in pattern:
+            self.chunk_regex = re.compile(pattern, re.MULTILINE)
+        self.grams = required_grams(self.regex)
+        # Scrollback -> [matching line numbers, lines scanned, whether the
+        # unterminated last line matches (it is scanned again next time)]
+        self.results = {}
+
+    # Colors are not part of the text searched
+    def match_lines(self, lines):
+        text = '\n'.join(lines)
+        if '\x1b' in text:
+            lines = [ ansi.strip(line) for line in lines ]
+            text = '\n'.join(lines)
+        if self.chunk_regex and not self.chunk_regex.search(text):
+            return []
+        return [ i for i, line in enumerate(lines) if self.regex.search(line) ]
+
+    def update(self, store):
+        result = self.results.setdefault(store, [ [], 0, False ])
+        complete = store.complete_lines()
+        if complete > result[1]:
+            result[0] += store.search(self, result[1], complete)
+            result[1] = complete
+        result[2] = store.partial and bool(self.regex.search(ansi.strip(store.get_line(complete))))
+
+    def line_numbers(self, store):
+        result = self.results.get(store)
+        if result is None:
+            return []
+        if result[2]:
+            return result[0] + [ result[1] ]
+        return result[0]
+
+    def count(self, store):
+        result = self.results.get(store)
+        if result is None:
+            return 0
+        return len(result[0]) + (result[2] and 1 or 0)
+
+    # The match after (direction 1) or before (-1) line line_no of
+    # stores[i], going on with the next stores and wrapping around. Returns
+    # (index in stores, line number), None if no match.
+    def next(self, stores, i, line_no, direction):
+        n = len(stores)
+        for step in range(n + 1):
+            index = (i + direction * step) % n
+            lines = self.line_numbers(stores[index])
+            if not lines:
+                continue
+            if step == 0:
+                if direction > 0:
+                    k = bisect_right(lines, line_no)
+                else:
+                    k = bisect_left(lines, line_no) - 1
+                if 0 <= k < len(lines):
+                    return index, lines[k]
+                continue
+            if direction > 0:
+                return index, lines[0]
+            return index, lines[-1]
+        return None
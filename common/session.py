@@ -0,0 +1,230 @@
+# vim: expandtab smarttab ts=4
+
+import os
+import glob
+import socket
+import threading
+from collections import deque
+
+from common.configs import *
+from common.relay import encode_frame, decode_frame
+
+# A session (--detach) runs the tasks in a background process, viewers
+# (--attach) talk to it over a Unix socket with the frames of the relays, one
+# JSON array per line. The session sends a snapshot when a viewer connects,
+# then every change:
+#   ["h", {"specs": ..., "cmds": ..., "items": bool}]  first frame, the run
+#   ["t", task_id, state]       the state of the task, see Sink.task_state()
+#   ["o", task_id, [lines]]     output lines of the task
+#   ["l", task_id, line]        the unterminated line of the task
+#   ["a", status]               the admission status
+#   ["w", [completed, failed, remaining]]  the items of --items
+# Viewers send:
+#   ["k"]                       kill the tasks
+
+def session_path(path):
+    return os.path.join(path, SESSION_SOCKET)
+
+# One connected viewer of a session. Frames are queued by send() and written
+# by a thread of their own, a viewer too slow to keep up is dropped and has
+# to attach again.
+class Viewer:
+    def __init__(self, conn, on_frame, on_closed):
+        self.conn = conn
+        self.on_frame = on_frame
+        self.on_closed = on_closed
+        self.queue = deque()
+        self.queued = 0
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def start(self):
+        threading.Thread(target=self._write_loop, daemon=True).start()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    # Might be called from any thread.
+    def send(self, data):
+        self.cond.acquire()
+        if not self.closed:
+            self.queue.append(data)
+            self.queued += len(data)
+            if self.queued > SESSION_VIEWER_BACKLOG:
+                self.closed = True
+                self.queue.clear()
+            self.cond.notify()
+        self.cond.release()
+
+    def _write_loop(self):
+        while True:
+            self.cond.acquire()
+            while not self.queue and not self.closed:
+                self.cond.wait()
+            data = b''.join(self.queue)
+            self.queue.clear()
+            self.queued = 0
+            conn = not self.closed and self.conn or None
+            self.cond.release()
+            if conn is None:
+                break
+            try:
+                conn.sendall(data)
+            except OSError:
+                break
+        self.close()
+
+    def _read_loop(self):
+        try:
+            for line in self.conn.makefile('rb'):
+                try:
+                    self.on_frame(self, decode_frame(line))
+                except (ValueError, IndexError, TypeError):
+                    pass
+        except OSError:
+            pass
+        self.close()
+
+    def close(self):
+        self.cond.acquire()
+        self.closed = True
+        conn = self.conn
+        self.conn = None
+        self.cond.notify()
+        self.cond.release()
+        if conn is None:
+            return
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        conn.close()
+        self.on_closed(self)
+
+# Accepts the viewers of a session on the socket in its run directory.
+class SessionServer(threading.Thread):
+    def __init__(self, sink, path):
+        super().__init__(daemon=True)
+        self.sink = sink
+        self.path = path
+        self.sock = None
+        self.log_tag = 'SessionServer'
+
+    def listen(self):
+        os.makedirs(os.path.dirname(self.path), mode=0o755, exist_ok=True)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.path)
+        # Whoever may connect may kill the tasks
+        os.chmod(self.path, 0o600)
+        self.sock.listen()
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                break
+            self.sink.gfl.log(self.log_tag, 'viewer attached', 1)
+            self.sink.attach_viewer(Viewer(conn, self.sink.viewer_frame, self.sink.detach_viewer))
+
+    def close(self):
+        if self.sock is None:
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.sock = None
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+# The items counts of a session, shown by the viewers instead of those of a
+# WorkQueue.
+class SessionQueue:
+    def __init__(self):
+        self.value = (0, 0, 0)
+
+    def counts(self):
+        return self.value
+
+# The viewer side: feeds the frames of a session into a sink as if its tasks
+# ran here.
+class SessionClient(threading.Thread):
+    def __init__(self, sock, path):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.path = path
+        self.fin = sock.makefile('rb')
+        frame = decode_frame(self.fin.readline() or b'null')
+        if not isinstance(frame, list) or frame[:1] != [ 'h' ]:
+            raise ValueError('not a para-run session')
+        self.hello = frame[1]
+        self.queue = SessionQueue()
+        self.sink = None
+        self.detached = False
+        self.log_tag = 'SessionClient'
+
+    # target is a run directory or a socket, the latest session still
+    # running if empty.
+    @staticmethod
+    def connect(target):
+        if not target:
+            paths = sorted(glob.glob(session_path(os.path.join(DEFAULT_RUNTIME_DIR, '*'))), reverse=True)
+        elif os.path.isdir(target):
+            paths = [ session_path(target) ]
+        else:
+            paths = [ target ]
+        error = OSError('no session found in %s' % DEFAULT_RUNTIME_DIR)
+        for path in paths:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(path)
+                return SessionClient(sock, path)
+            except (OSError, ValueError) as e:
+                sock.close()
+                error = e
+        raise error
+
+    def _dispatch(self, frame):
+        kind = frame[0]
+        if kind == 'o':
+            self.sink.append_lines(frame[1], frame[2])
+        elif kind == 'l':
+            self.sink.set_live_line(frame[1], frame[2])
+        elif kind == 't':
+            self.sink.set_task_state(frame[1], frame[2])
+        elif kind == 'a':
+            self.sink.set_admission_status(frame[1])
+        elif kind == 'w':
+            self.queue.value = tuple(frame[1])
+
+    def start_feeding(self, sink):
+        self.sink = sink
+        self.start()
+
+    def run(self):
+        try:
+            for line in self.fin:
+                try:
+                    self._dispatch(decode_frame(line))
+                except (ValueError, IndexError, TypeError) as e:
+                    self.sink.gfl.log(self.log_tag, 'Bad frame %r: %s', 0, line, e)
+        except OSError as e:
+            self.sink.gfl.dump_error(self.log_tag, e)
+        if not self.detached:
+            self.sink.session_ended()
+
+    def kill(self):
+        try:
+            self.sock.sendall(encode_frame([ 'k' ]))
+        except OSError:
+            pass
+
+    def close(self):
+        self.detached = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,837 @@
+# vim: expandtab smarttab ts=4
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from datetime import datetime
+
+from common.configs import *
+from common.runner import ENGINES, Task
+from common.scheduler import Scheduler
+from common import relay
+from common import argparser
+from common.metrics import Metrics, MetricsExporter, TimedLock
+from common.logger import run_dir
+from common.replay import RUN_INFO_FILE, save_run_info
+from common.watchdog import Watchdog
+from common.workqueue import Item, WorkQueue, fill_item
+from common.admission import Admission
+from common.scrollback import Scrollback
+from common.session import SessionServer, session_path
+from common.usage import SUMMARY_FILE, TaskUsage, format_summary, save_summary
+from common.history import History, normalize_cmd, host_key, format_duration
+
+# Owns the task state and the engine running the tasks. Subclasses decide
+# where the output goes (the curses TUI, a relay stream, ...) through the
+# _on_* hooks, which are called with self.mutex held.
+class Sink:
+    def __init__(self, cmds, specs, gfl, args):
+        self.gfl = gfl
+        self.args = args
+        self.cmds = cmds
+        self.specs = specs
+        self.tasks_total = len(cmds)
+        self.tasks_running_status = [True] * self.tasks_total
+        self.tasks_pending_status = [True] * self.tasks_total
+        self.tasks_retcode = [0] * self.tasks_total
+        # time.time() of the start and exit of each task
+        self.tasks_started_at = [None] * self.tasks_total
+        self.tasks_finished_at = [None] * self.tasks_total
+        self.tasks_timed_out = [False] * self.tasks_total
+        self.tasks_usage = [ TaskUsage() for i in range(self.tasks_total) ]
+        # The usual duration of each task in past runs, None if unknown. Slots
+        # of --items take as long as their items do.
+        self.tasks_expected = [None] * self.tasks_total
+        self.use_history = args.history and args.work_items is None
+        self.history = None
+        # task_id -> the runner.Task objects running it: the task itself and
+        # its speculative copy if any
+        self.attempts = {}
+        self.watchdog = None
+        # With --items, every task is a slot running items one after another
+        self.work_queue = None
+        if args.work_items is not None:
+            self.work_queue = WorkQueue(args.work_items)
+        self.slot_items = [None] * self.tasks_total
+        self.slot_done = [0] * self.tasks_total
+        self.slot_retcode = [0] * self.tasks_total
+        self.tasks_finished = 0
+        self.tasks_pending = self.tasks_total
+        self.all_finished = threading.Event()
+        if self.tasks_total == 0:
+            self.all_finished.set()
+        self.metrics = Metrics(self.tasks_total)
+        self.mutex = TimedLock(self.metrics.lock_wait, self.metrics.lock_hold)
+        self.metrics_exporter = None
+        self.log_output = args.log_output
+        self.log_compress = args.log_compress
+        self.log_ts = args.log_ts
+        self.engine_name = args.engine
+        self.start_ts = datetime.now()
+        self.scheduler = Scheduler(self, specs, args.jobs, args.host_jobs, Admission.from_args(args))
+        self.admission_status = None
+        # Remote tasks handed to relays instead of being run from here
+        self.relay_groups = relay.plan_relays(specs, args.tree_fanout)
+        self.relays = []
+        self.log_tag = 'Sink'
+
+    def _on_output(self, task_id, lines):
+        pass
+
+    def _on_started(self, task_id):
+        pass
+
+    def _on_finished(self, task_id, returncode):
+        pass
+
+    def _on_item_started(self, task_id, item):
+        pass
+
+    def _on_admission(self, status):
+        pass
+
+    def _on_item_finished(self, task_id, item):
+        pass
+
+    def _on_note(self, task_id, text, event):
+        pass
+
+    def append_lines(self, task_id, lines):
+        start = time.perf_counter()
+        self.mutex.acquire()
+        self.metrics.add_output(task_id, lines)
+        self._on_output(task_id, lines)
+        self.mutex.release()
+        self.metrics.handoff.record(time.perf_counter() - start)
+
+    # What para-run itself tells about a task, shown along its output but
+    # never part of it. event are the fields of the jsonl record, if any.
+    def note(self, task_id, text, **event):
+        self.mutex.acquire()
+        self.gfl.log(self.log_tag, 'note %d: %s', 1, task_id, text)
+        self._on_note(task_id, text, event)
+        self.mutex.release()
+
+    # The unterminated last line of the task, called without the mutex
+    def set_live_line(self, task_id, line):
+        pass
+
+    def mark_started(self, task_id):
+        self.mutex.acquire()
+        if self.tasks_pending_status[task_id - 1]:
+            self.tasks_pending -= 1
+        self.tasks_pending_status[task_id - 1] = False
+        self.tasks_started_at[task_id - 1] = time.time()
+        self.tasks_usage[task_id - 1].start()
+        self.gfl.log(self.log_tag, 'mark_started %d', 3, task_id)
+        self._on_started(task_id)
+        self.mutex.release()
+
+    def mark_finished(self, task_id, returncode):
+        self.mutex.acquire()
+        if self.tasks_running_status[task_id - 1]:
+            self.tasks_finished += 1
+            self.tasks_usage[task_id - 1].finish()
+        self.tasks_running_status[task_id - 1] = False
+        if self.tasks_timed_out[task_id - 1]:
+            returncode = TIMEOUT_RETCODE
+        self.tasks_retcode[task_id - 1] = returncode
+        self.tasks_finished_at[task_id - 1] = time.time()
+        self.gfl.log(self.log_tag, 'mark_finished %d returncode %d', 3, task_id, returncode)
+        self._on_finished(task_id, returncode)
+        if self.tasks_finished == self.tasks_total:
+            self.all_finished.set()
+        self.mutex.release()
+
+    def set_admission_status(self, status):
+        self.mutex.acquire()
+        self.admission_status = status
+        self.gfl.log(self.log_tag, 'admission: %s', 1, status)
+        self._on_admission(status)
+        self.mutex.release()
+
+    def add_attempt(self, task):
+        self.mutex.acquire()
+        late = self.tasks_finished_at[task.index - 1] is not None
+        if late:
+            task.discarded = True
+        else:
+            self.attempts.setdefault(task.index, []).append(task)
+        self.mutex.release()
+        if late:
+            self.watchdog.kill(task.subp)
+
+    # The first attempt of a task to exit decides how it ends, except that a
+    # speculative copy only does if it succeeds. The others are killed.
+    def attempt_finished(self, task, returncode):
+        task_id = task.index
+        self.mutex.acquire()
+        attempts = self.attempts.get(task_id, [])
+        if task in attempts:
+            attempts.remove(task)
+        won = not task.discarded and self.tasks_finished_at[task_id - 1] is None \
+                and (task.copy_host is None or returncode == 0 or not attempts)
+        losers = []
+        if won:
+            self.tasks_usage[task_id - 1].add(task, self.specs[task_id - 1][0] is None)
+            losers = attempts
+            self.attempts.pop(task_id, None)
+            for t in losers:
+                t.discarded = True
+        elif not attempts:
+            self.attempts.pop(task_id, None)
+        self.mutex.release()
+
+        for t in losers:
+            self.watchdog.kill(t.subp)
+        if not won:
+            return
+        if task.copy_host is not None:
+            host = HOST_NAME_FMT % task.copy_host
+            self.note(task_id, 'the copy on %s finished first' % host, event='copy_won', copy_host=host)
+            self.append_lines(task_id, task.held)
+        if self.work_queue is not None:
+            returncode = self._item_finished(task, returncode)
+            if returncode is None:
+                return
+        self.mark_finished(task_id, returncode)
+
+    def _start_item(self, task_id, item, log_mode):
+        hostid, cmd = self.specs[task_id - 1]
+        self.mutex.acquire()
+        self.slot_items[task_id - 1] = item
+        self._on_item_started(task_id, item)
+        self.mutex.release()
+        self.note(task_id, 'item %d: %s' % (item.seq, item.value))
+        cmd = argparser.gen_cmd((hostid, fill_item(cmd, item.value)), argparser.gen_ssh_prefix(self.args))
+        self.engine.spawn(Task(cmd, self, task_id, log_mode=log_mode))
+
+    # The item run by task has exited. The slot goes on with the next item if
+    # there is one and returns None, otherwise returns its return code: the
+    # one of its last failed item, 0 if none failed.
+    def _item_finished(self, task, returncode):
+        i = task.index - 1
+        self.mutex.acquire()
+        if self.tasks_timed_out[i]:
+            returncode = TIMEOUT_RETCODE
+        item = self.slot_items[i]
+        self.work_queue.done(item, returncode)
+        self.slot_done[i] += 1
+        if returncode != 0:
+            self.slot_retcode[i] = returncode
+        self.slot_items[i] = None
+        self._on_item_finished(task.index, item)
+        # A timeout of the run stops the slot, the one of an item does not
+        item = None
+        if not self.scheduler.cancelled:
+            item = self.work_queue.take()
+        if item is not None:
+            self.tasks_timed_out[i] = False
+            task.continued = True
+        self.mutex.release()
+        if item is None:
+            return self.slot_retcode[i]
+        self._start_item(task.index, item, 'a')
+        return None
+
+    # Runs a copy of a straggling task on another host of the same command.
+    def launch_copy(self, task_id, hostid):
+        cmd = argparser.gen_remote_cmd(hostid, self.specs[task_id - 1][1], argparser.gen_ssh_prefix(self.args))
+        host = HOST_NAME_FMT % hostid
+        self.note(task_id, 'straggling, started a copy on %s' % host, event='copy_start', copy_host=host)
+        self.engine.spawn(Task(cmd, self, task_id, hostid))
+
+    # A task that never started because the run timed out.
+    def skip_task(self, task_id):
+        self.mutex.acquire()
+        self.tasks_timed_out[task_id - 1] = True
+        self.mutex.release()
+        self.mark_started(task_id)
+        self.mark_finished(task_id, TIMEOUT_RETCODE)
+
+    # Nothing starts anymore and the running tasks are killed, e.g. when the
+    # user quits or interrupts the run.
+    def kill_all(self):
+        cancelled = self.scheduler.cancel()
+        if cancelled:
+            self.gfl.log(self.log_tag, 'Cancelled pending tasks: %s' % ','.join(map(str, cancelled)))
+        self.mutex.acquire()
+        procs = [ task.subp for attempts in self.attempts.values() for task in attempts ]
+        self.mutex.release()
+        if self.watchdog:
+            for proc in procs:
+                self.watchdog.kill(proc)
+        for t in self.relays:
+            t.kill()
+
+    # What session viewers are sent of task i, see common/session.py
+    def task_state(self, i):
+        item = self.slot_items[i]
+        return {
+            'pending': self.tasks_pending_status[i],
+            'running': self.tasks_running_status[i],
+            'returncode': self.tasks_retcode[i],
+            'started': self.tasks_started_at[i],
+            'finished': self.tasks_finished_at[i],
+            'timed_out': self.tasks_timed_out[i],
+            'item': item is not None and [ item.seq, item.value ] or None,
+            'done': self.slot_done[i],
+            'usage': self.tasks_usage[i].to_dict(),
+            'expected': self.tasks_expected[i],
+        }
+
+    # The viewer side of task_state()
+    def set_task_state(self, task_id, state):
+        i = task_id - 1
+        self.mutex.acquire()
+        if self.tasks_pending_status[i] and not state['pending']:
+            self.tasks_pending -= 1
+        finished = self.tasks_running_status[i] and not state['running']
+        if finished:
+            self.tasks_finished += 1
+        self.tasks_pending_status[i] = state['pending']
+        self.tasks_running_status[i] = state['running']
+        self.tasks_retcode[i] = state['returncode']
+        self.tasks_started_at[i] = state['started']
+        self.tasks_finished_at[i] = state['finished']
+        self.tasks_timed_out[i] = state['timed_out']
+        self.slot_items[i] = state['item'] and Item(*state['item']) or None
+        self.slot_done[i] = state['done']
+        self.tasks_usage[i].load(state['usage'])
+        self.tasks_expected[i] = state['expected']
+        if finished:
+            self._on_finished(task_id, state['returncode'])
+        else:
+            self._on_started(task_id)
+        if self.tasks_finished == self.tasks_total:
+            self.all_finished.set()
+        self.mutex.release()
+
+    def task_duration(self, i):
+        if self.tasks_usage[i].wall is not None:
+            return self.tasks_usage[i].wall
+        if self.tasks_started_at[i] is None or self.tasks_finished_at[i] is None:
+            return None
+        return self.tasks_finished_at[i] - self.tasks_started_at[i]
+
+    # What --replay needs to show the output logs of this run again.
+    def _run_info(self):
+        tasks = []
+        for i, (hostid, cmd) in enumerate(self.specs):
+            returncode = None
+            if self.tasks_finished_at[i] is not None:
+                returncode = self.tasks_retcode[i]
+            tasks.append({
+                'task': i + 1,
+                'host': hostid,
+                'cmd': cmd,
+                'returncode': returncode,
+                'started': self.tasks_started_at[i],
+                'finished': self.tasks_finished_at[i],
+                'timed_out': self.tasks_timed_out[i],
+            })
+        return {
+            'version': VERSION,
+            'start': str(self.start_ts),
+            'log_ts': self.log_ts,
+            'log_compress': self.log_compress,
+            'tasks': tasks,
+        }
+
+    def save_run_info(self):
+        if not self.log_output:
+            return
+        path = run_dir(self.start_ts)
+        try:
+            os.makedirs(path, exist_ok=True)
+            save_run_info(os.path.join(path, RUN_INFO_FILE), self._run_info())
+        except OSError as e:
+            self.gfl.dump_error(self.log_tag, e)
+
+    # One row per task for the summary table and summary.json
+    def usage_rows(self):
+        rows = []
+        for i, (hostid, cmd) in enumerate(self.specs):
+            usage = self.tasks_usage[i]
+            returncode = None
+            if self.tasks_finished_at[i] is not None:
+                returncode = self.tasks_retcode[i]
+            rows.append({
+                'task': i + 1,
+                'host': hostid,
+                'cmd': cmd,
+                'returncode': returncode,
+                'wall': self.task_duration(i),
+                'cpu': usage.cpu(),
+                'user': usage.user,
+                'sys': usage.sys,
+                'maxrss': usage.maxrss,
+                'rss_floor': usage.rss_floor,
+                'bytes': usage.bytes,
+                'lines': usage.lines,
+            })
+        return rows
+
+    # The table printed at exit, empty with --summary none
+    def summary_table(self):
+        if self.args.summary == 'none' or not self.tasks_total:
+            return ''
+        return format_summary(self.usage_rows(), self.args.summary)
+
+    # The tasks that succeeded but took much longer than in past runs
+    def regression_report(self):
+        lines = []
+        for i, (hostid, cmd) in enumerate(self.specs):
+            expected = self.tasks_expected[i]
+            duration = self.task_duration(i)
+            if expected is None or duration is None or self.tasks_running_status[i] or self.tasks_retcode[i] != 0:
+                continue
+            if duration > expected * HISTORY_SLOWDOWN and duration - expected >= HISTORY_SLOWDOWN_MIN_SECONDS:
+                lines.append('  task %d (%s): %s, usually %s: %s\n' % (i + 1, host_key(hostid),
+                        format_duration(duration), format_duration(expected), cmd.replace('\n', ' ')[:SUMMARY_CMD_WIDTH]))
+        if not lines:
+            return ''
+        return 'Slower than in past runs:\n' + ''.join(lines)
+
+    def exit_report(self):
+        return self.summary_table() + self.regression_report()
+
+    # Seconds until all tasks are done going by their past runs, None if some
+    # never ran before. Must hold self.mutex.
+    def eta(self):
+        now = time.time()
+        remaining = []
+        pending = 0.0
+        for i in range(self.tasks_total):
+            if not self.tasks_running_status[i]:
+                continue
+            expected = self.tasks_expected[i]
+            if expected is None:
+                return None
+            if self.tasks_pending_status[i]:
+                pending += expected
+            else:
+                remaining.append(max(expected - (now - self.tasks_started_at[i]), 0.0))
+        unfinished = self.tasks_total - self.tasks_finished
+        if not unfinished:
+            return None
+        width = self.args.jobs > 0 and min(self.args.jobs, unfinished) or unfinished
+        return max(max(remaining, default=0.0), (sum(remaining) + pending) / width)
+
+    def _load_history(self):
+        if not self.use_history:
+            return
+        keys = [ (normalize_cmd(cmd), host_key(hostid)) for hostid, cmd in self.specs ]
+        try:
+            self.history = History()
+            expected = self.history.expected(keys)
+        except (OSError, sqlite3.Error) as e:
+            self.gfl.dump_error(self.log_tag, e)
+            self.history = None
+            return
+        self.mutex.acquire()
+        self.tasks_expected = [ expected[key] for key in keys ]
+        self.mutex.release()
+        if self.args.longest_first:
+            # Those never seen before might be the longest
+            self.scheduler.sort_pending(lambda task_id: (self.tasks_expected[task_id - 1] is not None,
+                    -(self.tasks_expected[task_id - 1] or 0)))
+
+    def _save_history(self):
+        if self.history is None:
+            return
+        rows = []
+        for i, (hostid, cmd) in enumerate(self.specs):
+            duration = self.task_duration(i)
+            if duration is None:
+                continue
+            usage = self.tasks_usage[i]
+            rows.append((normalize_cmd(cmd), host_key(hostid), self.tasks_finished_at[i], duration,
+                    self.tasks_retcode[i], usage.bytes, usage.lines))
+        try:
+            self.history.record(rows)
+        except sqlite3.Error as e:
+            self.gfl.dump_error(self.log_tag, e)
+        self.history.close()
+        self.history = None
+
+    def save_summary(self):
+        if not self.log_output:
+            return
+        path = run_dir(self.start_ts)
+        try:
+            os.makedirs(path, exist_ok=True)
+            save_summary(os.path.join(path, SUMMARY_FILE), self.usage_rows())
+        except OSError as e:
+            self.gfl.dump_error(self.log_tag, e)
+
+    # Hosts this para-run connects to itself, the others are behind relays.
+    def direct_hosts(self):
+        relayed = set()
+        hosts = set()
+        for relay_hostid, task_ids in self.relay_groups:
+            relayed.update(task_ids)
+            hosts.add(relay_hostid)
+        for i, (hostid, cmd) in enumerate(self.specs):
+            if hostid is not None and i + 1 not in relayed:
+                hosts.add(hostid)
+        return sorted(hosts)
+
+    def _launch_task(self, task_id):
+        self.mark_started(task_id)
+        if self.work_queue is None:
+            self.engine.spawn(Task(self.cmds[task_id - 1], self, task_id))
+            return
+        item = self.work_queue.take()
+        if item is None:
+            # More slots than items
+            self.mark_finished(task_id, 0)
+            self.scheduler.task_done(task_id)
+            return
+        self._start_item(task_id, item, 'w')
+
+    def start_worker_threads(self, cmds):
+        self.save_run_info()
+        if self.args.metrics:
+            self.metrics_exporter = MetricsExporter(self.metrics, self.start_ts, self.gfl)
+            self.metrics_exporter.start()
+        for relay_hostid, task_ids in self.relay_groups:
+            self.scheduler.remove(task_ids)
+        self._load_history()
+        self.engine = ENGINES[self.engine_name](self)
+        self.engine.start()
+        self.watchdog = Watchdog(self)
+        self.watchdog.start()
+        # Tasks beyond the limits stay PENDING until a running one finishes.
+        self.scheduler.start(self._launch_task)
+        for relay_hostid, task_ids in self.relay_groups:
+            t = relay.RelayTask(self, relay_hostid, task_ids)
+            self.relays.append(t)
+            t.start()
+        return True
+
+    def join_worker_threads(self):
+        if not hasattr(self, 'engine'):
+            return
+
+        # Never launch queued tasks once we are shutting down.
+        cancelled = self.scheduler.cancel()
+        if cancelled:
+            self.gfl.log(self.log_tag, 'Cancelled pending tasks: %s' % ','.join(map(str, cancelled)))
+
+        self.engine.join()
+        for t in self.relays:
+            t.join()
+
+    def close(self):
+        self.save_run_info()
+        if hasattr(self, 'engine'):
+            self.save_summary()
+        self._save_history()
+        if self.watchdog:
+            self.watchdog.stop()
+            self.watchdog = None
+        if self.metrics_exporter:
+            self.metrics_exporter.stop()
+            self.metrics_exporter = None
+
+# Writes the output of all tasks, interleaved line by line, to a binary
+# stream. Writes are buffered by out and flushed every flush_interval.
+class StreamSink(Sink):
+    flush_interval = STREAM_FLUSH_INTERVAL
+
+    def __init__(self, cmds, specs, gfl, args, out):
+        super().__init__(cmds, specs, gfl, args)
+        self.out = out
+        self.out_dirty = False
+        self.out_broken = False
+        self.format = args.format
+        self.labels = [ (hostid is None and 'local' or HOST_NAME_FMT % hostid) for hostid, cmd in specs ]
+        self.prefixes = [ ('[%s/%d] ' % (label, i + 1)).encode('utf-8') for i, label in enumerate(self.labels) ]
+        self.log_tag = 'StreamSink'
+
+    def _write(self, data):
+        if self.out_broken:
+            return
+        try:
+            self.out.write(data)
+            self.out_dirty = True
+        except OSError as e:
+            # Keep running the tasks even if nobody listens anymore
+            self.out_broken = True
+            self.gfl.dump_error(self.log_tag, e)
+
+    def _record(self, task_id, **fields):
+        record = { 'ts': round(time.time(), 6), 'task': task_id, 'host': self.labels[task_id - 1] }
+        record.update(fields)
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+
+    def _on_output(self, task_id, lines):
+        if self.format == 'jsonl':
+            # The runner merges stderr into stdout
+            data = ''.join([ self._record(task_id, stream='stdout', line=line.rstrip('\n')) for line in lines ])
+            self._write(data.encode('utf-8'))
+            return
+        prefix = self.prefixes[task_id - 1]
+        chunks = []
+        for line in lines:
+            chunks.append(prefix)
+            chunks.append(line.encode('utf-8'))
+            if not line.endswith('\n'):
+                chunks.append(b'\n')
+        self._write(b''.join(chunks))
+
+    def _on_started(self, task_id):
+        if self.format == 'jsonl':
+            self._write(self._record(task_id, event='start', cmd=self.specs[task_id - 1][1]).encode('utf-8'))
+
+    def _on_finished(self, task_id, returncode):
+        if self.format == 'jsonl':
+            self._write(self._record(task_id, event='exit', returncode=returncode).encode('utf-8'))
+
+    def _on_item_started(self, task_id, item):
+        if self.format == 'jsonl':
+            self._write(self._record(task_id, event='item_start', item=item.seq, value=item.value).encode('utf-8'))
+
+    def _on_item_finished(self, task_id, item):
+        if self.format == 'jsonl':
+            self._write(self._record(task_id, event='item_exit', item=item.seq, returncode=item.returncode).encode('utf-8'))
+
+    # Only as events, the text output is the one of the commands
+    def _on_note(self, task_id, text, event):
+        if self.format == 'jsonl' and event:
+            self._write(self._record(task_id, **event).encode('utf-8'))
+
+    def _flush(self):
+        self.mutex.acquire()
+        if self.out_dirty and not self.out_broken:
+            try:
+                self.out.flush()
+            except OSError:
+                self.out_broken = True
+            self.out_dirty = False
+        self.mutex.release()
+
+    def run(self):
+        self.start_worker_threads(self.cmds)
+        try:
+            while not self.all_finished.wait(self.flush_interval):
+                self._flush()
+        except KeyboardInterrupt:
+            self.gfl.log(self.log_tag, 'Interrupted.')
+            self.kill_all()
+        self.join_worker_threads()
+        self._flush()
+        self.close()
+
+    def failed_tasks(self):
+        return [ i + 1 for i, returncode in enumerate(self.tasks_retcode)
+                if returncode != 0 or self.tasks_running_status[i] ]
+
+# Runs the tasks a parent para-run sent in a relay request and frames their
+# output to out, see common/relay.py.
+class RelaySink(StreamSink):
+    flush_interval = RELAY_FLUSH_INTERVAL
+
+    def __init__(self, cmds, specs, parent_task_ids, gfl, args, out):
+        super().__init__(cmds, specs, gfl, args, out)
+        self.parent_task_ids = parent_task_ids
+        # Kept by the parent para-run
+        self.use_history = False
+        self.orphaned = False
+        self.log_tag = 'RelaySink'
+
+    @staticmethod
+    def from_request(request, gfl, out):
+        args = argparser.default_args()
+        for key, value in request['args'].items():
+            if key in relay.RELAY_ARGS:
+                setattr(args, key, value)
+        parent_task_ids = [ task[0] for task in request['tasks'] ]
+        specs = [ (task[1], task[2]) for task in request['tasks'] ]
+        ssh_prefix = argparser.gen_ssh_prefix(args)
+        cmds = [ argparser.gen_cmd(spec, ssh_prefix) for spec in specs ]
+        return RelaySink(cmds, specs, parent_task_ids, gfl, args, out)
+
+    # Kills the tasks once stdin, kept open by the parent, is closed
+    def watch_parent(self, fin):
+        threading.Thread(target=self._wait_eof, args=(fin,), daemon=True).start()
+
+    def _wait_eof(self, fin):
+        try:
+            while fin.read(INGEST_READ_SIZE):
+                pass
+        except OSError:
+            pass
+        self.parent_gone('stdin closed')
+
+    def parent_gone(self, reason):
+        if self.orphaned:
+            return
+        self.orphaned = True
+        self.gfl.log(self.log_tag, 'Parent gone (%s), killing the tasks.' % reason)
+        self.kill_all()
+
+    # Unlike --no-tui, nobody is left to run the tasks for
+    def _flush(self):
+        super()._flush()
+        if self.out_broken:
+            self.parent_gone('stdout broken')
+
+    def _emit(self, kind, task_id, *payload):
+        self._write(relay.encode_frame([ kind, self.parent_task_ids[task_id - 1] ] + list(payload)))
+
+    def _on_output(self, task_id, lines):
+        self._emit('o', task_id, lines)
+
+    def _on_started(self, task_id):
+        self._emit('s', task_id)
+
+    def _on_finished(self, task_id, returncode):
+        self._emit('x', task_id, returncode)
+
+    def _on_note(self, task_id, text, event):
+        self._emit('n', task_id, text, event)
+
+# Runs the tasks in the background (--detach) and keeps their state and output
+# for the viewers attaching to its socket, see common/session.py. It goes on
+# when they detach, and exits once the run is over and a viewer has seen the
+# end, or after SESSION_LINGER seconds without any.
+class SessionSink(Sink):
+    def __init__(self, cmds, specs, gfl, args):
+        super().__init__(cmds, specs, gfl, args)
+        self.path = run_dir(self.start_ts)
+        self.server = SessionServer(self, session_path(self.path))
+        # Apart from the scrollbacks of a viewer started in the same second
+        self.spill_dir = os.path.join(self.path, 'session-scrollback')
+        self.scrollbacks = [ Scrollback(self.spill_dir, i + 1, args.scrollback_lines) for i in range(self.tasks_total) ]
+        self.live_lines = [ '' ] * self.tasks_total
+        self.viewers = []
+        self.viewers_changed = threading.Event()
+        # A viewer killed the tasks, nobody has to see the end
+        self.killed = False
+        self.log_tag = 'SessionSink'
+
+    def listen(self):
+        self.server.listen()
+        return self.path
+
+    def _broadcast(self, frame):
+        data = relay.encode_frame(frame)
+        for viewer in self.viewers:
+            viewer.send(data)
+
+    def _on_output(self, task_id, lines):
+        self.scrollbacks[task_id - 1].append_text(''.join(lines))
+        self._broadcast([ 'o', task_id, lines ])
+
+    # Viewers show it as output, see WindowHandler._on_note()
+    def _on_note(self, task_id, text, event):
+        self._on_output(task_id, [ 'para-run: %s\n' % text ])
+
+    def set_live_line(self, task_id, line):
+        self.mutex.acquire()
+        self.live_lines[task_id - 1] = line
+        self._broadcast([ 'l', task_id, line ])
+        self.mutex.release()
+
+    def _on_started(self, task_id):
+        self._broadcast([ 't', task_id, self.task_state(task_id - 1) ])
+
+    def _on_finished(self, task_id, returncode):
+        self._on_started(task_id)
+
+    def _on_item_started(self, task_id, item):
+        self._on_started(task_id)
+
+    def _on_item_finished(self, task_id, item):
+        self._broadcast([ 'w', self.work_queue.counts() ])
+        self._on_started(task_id)
+
+    def _on_admission(self, status):
+        self._broadcast([ 'a', status ])
+
+    # Must hold self.mutex. The last --scrollback-lines lines of each task.
+    def _snapshot(self):
+        frames = [ [ 'h', { 'version': VERSION, 'specs': self.specs, 'cmds': self.cmds,
+                'items': self.work_queue is not None } ] ]
+        frames += [ [ 't', i + 1, self.task_state(i) ] for i in range(self.tasks_total) ]
+        for i, store in enumerate(self.scrollbacks):
+            start = max(store.total - self.args.scrollback_lines, 0)
+            lines = [ store.get_line(k) + '\n' for k in range(start, store.total) ]
+            if lines and store.partial:
+                lines[-1] = lines[-1][:-1]
+            if lines:
+                frames.append([ 'o', i + 1, lines ])
+            if self.live_lines[i]:
+                frames.append([ 'l', i + 1, self.live_lines[i] ])
+        if self.admission_status is not None:
+            frames.append([ 'a', self.admission_status ])
+        if self.work_queue is not None:
+            frames.append([ 'w', self.work_queue.counts() ])
+        return b''.join([ relay.encode_frame(frame) for frame in frames ])
+
+    def attach_viewer(self, viewer):
+        self.mutex.acquire()
+        viewer.send(self._snapshot())
+        self.viewers.append(viewer)
+        self.mutex.release()
+        viewer.start()
+        self.viewers_changed.set()
+
+    def detach_viewer(self, viewer):
+        self.mutex.acquire()
+        if viewer in self.viewers:
+            self.viewers.remove(viewer)
+        self.mutex.release()
+        self.gfl.log(self.log_tag, 'viewer detached', 1)
+        self.viewers_changed.set()
+
+    def viewer_frame(self, viewer, frame):
+        if frame[0] == 'k':
+            self.gfl.log(self.log_tag, 'Killed by a viewer.')
+            self.killed = True
+            self.kill_all()
+
+    def _linger(self):
+        deadline = time.time() + SESSION_LINGER
+        seen = False
+        while True:
+            self.viewers_changed.clear()
+            self.mutex.acquire()
+            attached = len(self.viewers)
+            self.mutex.release()
+            if attached:
+                seen = True
+            elif seen or time.time() >= deadline:
+                break
+            self.viewers_changed.wait(SESSION_POLL_INTERVAL)
+
+    def run(self):
+        self.server.start()
+        self.start_worker_threads(self.cmds)
+        while not self.all_finished.wait(SESSION_POLL_INTERVAL):
+            pass
+        if not self.killed:
+            self._linger()
+        self.join_worker_threads()
+        self.close()
+
+    def close(self):
+        super().close()
+        self.server.close()
+        self.mutex.acquire()
+        viewers = list(self.viewers)
+        self.mutex.release()
+        for viewer in viewers:
+            viewer.close()
+        for store in self.scrollbacks:
+            store.close()
+        # Leave no empty directories behind
+        for path in (self.spill_dir, self.path):
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
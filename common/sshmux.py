@@ -0,0 +1,71 @@
+# vim: expandtab smarttab ts=4
+
+import os
+import time
+import shlex
+import tempfile
+import subprocess
+
+from common.configs import *
+
+# One multiplexed ssh master connection per host (OpenSSH ControlMaster).
+# Remote tasks connect with ControlMaster=auto through the same ControlPath,
+# so they reuse the warmed master instead of doing their own handshake, and
+# still work if warming a host failed.
+class SshMux:
+    def __init__(self, gfl, ssh_cmd = DEFAULT_SSH_CMD):
+        self.gfl = gfl
+        self.ssh_argv = shlex.split(ssh_cmd)
+        self.control_dir = os.path.join(DEFAULT_RUNTIME_DIR, 'ssh')
+        self.log_tag = 'SshMux'
+        self.masters = []
+
+    @staticmethod
+    def control_opts():
+        return [ '-o', 'ControlMaster=auto',
+                 '-o', 'ControlPath=' + os.path.join(DEFAULT_RUNTIME_DIR, 'ssh', '%C') ]
+
+    # stderr goes to a file and not a pipe: a master going to the background
+    # (-f) keeps it open, nobody would ever read EOF on a pipe.
+    def _run_all(self, hosts, extra_args, timeout):
+        procs = {}
+        for host in hosts:
+            argv = self.ssh_argv + self.control_opts() + extra_args + [ host ]
+            err = tempfile.TemporaryFile()
+            try:
+                procs[host] = (subprocess.Popen(argv, stdin=subprocess.DEVNULL,
+                        stdout=subprocess.DEVNULL, stderr=err), err)
+            except OSError as e:
+                err.close()
+                self.gfl.log(self.log_tag, 'Run %s failed: %s', 0, ' '.join(argv), e)
+
+        succeeded = []
+        deadline = time.monotonic() + timeout
+        for host, (proc, err) in procs.items():
+            try:
+                proc.wait(timeout=max(deadline - time.monotonic(), 0))
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+            if proc.returncode == 0:
+                succeeded.append(host)
+            else:
+                err.seek(0)
+                self.gfl.log(self.log_tag, '%s %s failed (%s): %s', 0, ' '.join(extra_args), host,
+                        proc.returncode, err.read().decode('utf-8', 'replace').strip())
+            err.close()
+        return succeeded
+
+    # Start the masters of all hosts in parallel and wait until they are up.
+    def warm(self, hosts):
+        os.makedirs(self.control_dir, mode=0o700, exist_ok=True)
+        self.masters = self._run_all(hosts,
+                [ '-o', 'ControlPersist=yes', '-f', '-N' ], SSH_MUX_WARM_TIMEOUT)
+        self.gfl.log(self.log_tag, 'Warmed %d/%d ssh masters.', 0, len(self.masters), len(hosts))
+        return self.masters
+
+    def teardown(self):
+        if self.masters:
+            self._run_all(self.masters, [ '-O', 'exit' ], SSH_MUX_WARM_TIMEOUT)
+            self.gfl.log(self.log_tag, 'Closed %d ssh masters.', 0, len(self.masters))
+        self.masters = []
@@ -0,0 +1,155 @@
+# vim: expandtab smarttab ts=4
+
+import os
+import json
+import time
+
+from common.configs import *
+
+SUMMARY_FILE = 'summary.json'
+# --summary keys, the largest first except for the task number
+SUMMARY_SORT_KEYS = ('task', 'wall', 'cpu', 'rss', 'bytes', 'lines')
+
+def format_size(n):
+    for unit in ('', 'K', 'M', 'G'):
+        if n < 1024:
+            break
+        n /= 1024.0
+    if unit and n < 10:
+        return '%.1f%s' % (n, unit)
+    return '%d%s' % (n, unit)
+
+# What a task used: the wall time from its start to its exit, the CPU time
+# and peak RSS of its process (local tasks only, those of ssh say nothing
+# about the remote command) and the output read from its pipe. A slot of
+# --items adds up its items, the peak RSS being the largest of them.
+#
+# The peak RSS from wait4() is never below the one of para-run when the child
+# was spawned: Linux counts the memory the child shares with para-run until
+# exec. Peaks up to that floor only tell that the task used at most as much,
+# see rss_known().
+class TaskUsage:
+    def __init__(self):
+        self.started = None
+        self.wall = None
+        self.user = None
+        self.sys = None
+        self.maxrss = None
+        self.rss_floor = 0
+        self.bytes = 0
+        self.lines = 0
+
+    def start(self):
+        self.started = time.monotonic()
+
+    def finish(self):
+        if self.started is not None:
+            self.wall = time.monotonic() - self.started
+
+    # The attempt that won, see Sink.attempt_finished()
+    def add(self, task, local):
+        self.bytes += task.bytes_read
+        self.lines += task.lines_read
+        rusage = task.rusage
+        if not local or rusage is None:
+            return
+        self.user = (self.user or 0.0) + rusage.ru_utime
+        self.sys = (self.sys or 0.0) + rusage.ru_stime
+        # In kilobytes on Linux
+        self.maxrss = max(self.maxrss or 0, rusage.ru_maxrss * 1024)
+        self.rss_floor = max(self.rss_floor, task.rss_floor)
+
+    def cpu(self):
+        if self.user is None:
+            return None
+        return self.user + self.sys
+
+    def rss_known(self):
+        return self.maxrss is not None and self.maxrss > self.rss_floor + RSS_FLOOR_SLACK
+
+    def describe(self):
+        pieces = []
+        if self.user is not None:
+            pieces.append('cpu %.1fs rss %s' % (self.cpu(), format_rss(self.maxrss, self.rss_floor)))
+        pieces.append('out %s/%dl' % (format_size(self.bytes), self.lines))
+        return ' '.join(pieces)
+
+    def to_dict(self):
+        return {
+            'wall': self.wall,
+            'user': self.user,
+            'sys': self.sys,
+            'maxrss': self.maxrss,
+            'rss_floor': self.rss_floor,
+            'bytes': self.bytes,
+            'lines': self.lines,
+        }
+
+    def load(self, state):
+        self.wall = state['wall']
+        self.user = state['user']
+        self.sys = state['sys']
+        self.maxrss = state['maxrss']
+        self.rss_floor = state['rss_floor']
+        self.bytes = state['bytes']
+        self.lines = state['lines']
+
+# A peak RSS up to the floor is shown as "<=floor"
+def format_rss(maxrss, floor):
+    if maxrss > floor + RSS_FLOOR_SLACK:
+        return format_size(maxrss)
+    return '<=' + format_size(max(maxrss, floor))
+
+def _sort_value(row, key):
+    rss = row['maxrss']
+    if rss is not None and rss <= row['rss_floor'] + RSS_FLOOR_SLACK:
+        rss = 0
+    value = { 'wall': row['wall'], 'cpu': row['cpu'], 'rss': rss,
+            'bytes': row['bytes'], 'lines': row['lines'] }[key]
+    return value is None and -1 or value
+
+def sort_rows(rows, key):
+    if key == 'task':
+        return list(rows)
+    return sorted(rows, key=lambda row: _sort_value(row, key), reverse=True)
+
+def _cell(value, fmt):
+    if value is None:
+        return '-'
+    return fmt(value)
+
+# The summary table printed at exit, the first limit rows of rows sorted by
+# key.
+def format_summary(rows, key, limit = SUMMARY_ROWS):
+    header = ('TASK', 'HOST', 'EXIT', 'WALL', 'CPU', 'USER', 'SYS', 'MAXRSS', 'BYTES', 'LINES', 'CMD')
+    table = [ header ]
+    rows = sort_rows(rows, key)
+    for row in rows[:limit]:
+        table.append((
+            str(row['task']),
+            row['host'] is None and 'local' or HOST_NAME_FMT % row['host'],
+            _cell(row['returncode'], str),
+            _cell(row['wall'], lambda v: '%.1fs' % v),
+            _cell(row['cpu'], lambda v: '%.1fs' % v),
+            _cell(row['user'], lambda v: '%.1fs' % v),
+            _cell(row['sys'], lambda v: '%.1fs' % v),
+            _cell(row['maxrss'], lambda v: format_rss(v, row['rss_floor'])),
+            format_size(row['bytes']),
+            str(row['lines']),
+            row['cmd'].replace('\n', ' ')[:SUMMARY_CMD_WIDTH],
+        ))
+    widths = [ max([ len(line[k]) for line in table ]) for k in range(len(header)) ]
+    out = []
+    for line in table:
+        cells = [ line[0].rjust(widths[0]), line[1].ljust(widths[1]) ]
+        cells += [ cell.rjust(width) for cell, width in zip(line[2:-1], widths[2:-1]) ]
+        out.append('  '.join(cells + [ line[-1] ]).rstrip() + '\n')
+    if len(rows) > limit:
+        out.append('... %d more tasks\n' % (len(rows) - limit))
+    return ''.join(out)
+
+def save_summary(path, rows):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fout:
+        json.dump(rows, fout, indent=1)
+    os.replace(tmp_path, path)
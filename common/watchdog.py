@@ -0,0 +1,158 @@
+# vim: expandtab smarttab ts=4
+
+import os
+import time
+import signal
+import threading
+
+from common.configs import *
+
+# Every task runs in its own process group (see Task.spawn), so killing the
+# group also gets whatever the command started.
+def kill_group(proc, sig):
+    try:
+        os.killpg(proc.pid, sig)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+# Kills the tasks running past --timeout or --task-timeout, SIGTERM first and
+# SIGKILL TIMEOUT_KILL_GRACE seconds later, and starts speculative copies of
+# stragglers (--speculate).
+class Watchdog(threading.Thread):
+    def __init__(self, sink):
+        super().__init__(daemon=True)
+        self.sink = sink
+        args = sink.args
+        self.deadline = None
+        if args.timeout > 0:
+            self.deadline = time.time() + args.timeout
+        self.task_timeout = args.task_timeout
+        self.speculate = args.speculate
+        # Equivalent tasks: the same remote command on several hosts, e.g. one
+        # -r option. Relayed tasks are speculated on by their relay.
+        relayed = set()
+        for relay_hostid, task_ids in sink.relay_groups:
+            relayed.update(task_ids)
+        self.classes = {}
+        for i, (hostid, cmd) in enumerate(sink.specs):
+            if hostid is not None and i + 1 not in relayed:
+                self.classes.setdefault(cmd, []).append(i + 1)
+        # task_id -> host of its speculative copy, one per task at most
+        self.speculated = {}
+        # Killed process -> when it gets SIGKILL if still there
+        self.killing = {}
+        self.relays_killed = False
+        self.mutex = threading.Lock()
+        self.stopped = threading.Event()
+        self.log_tag = 'Watchdog'
+
+    # Might be called from any thread.
+    def kill(self, proc):
+        self.mutex.acquire()
+        if proc not in self.killing:
+            kill_group(proc, signal.SIGTERM)
+            self.killing[proc] = time.time() + TIMEOUT_KILL_GRACE
+        self.mutex.release()
+
+    def _escalate(self, now):
+        self.mutex.acquire()
+        for proc, kill_at in list(self.killing.items()):
+            if proc.returncode is not None:
+                del self.killing[proc]
+            elif now >= kill_at:
+                kill_group(proc, signal.SIGKILL)
+                del self.killing[proc]
+        self.mutex.release()
+
+    def _expired(self, now):
+        sink = self.sink
+        if self.deadline is not None and now >= self.deadline:
+            return list(sink.attempts)
+        if self.task_timeout <= 0:
+            return []
+        # Since the start of the attempt: with --items, of the current item
+        return [ task_id for task_id, attempts in sink.attempts.items()
+                if now - attempts[0].started_at >= self.task_timeout ]
+
+    def _check_timeouts(self, now):
+        sink = self.sink
+        deadline_passed = self.deadline is not None and now >= self.deadline
+        # Nothing starts after the deadline, and the relays got the same
+        # --timeout but are cut off if they do not report in time.
+        if deadline_passed:
+            for task_id in sink.scheduler.cancel():
+                sink.skip_task(task_id)
+            if not self.relays_killed and now >= self.deadline + 2 * TIMEOUT_KILL_GRACE:
+                self.relays_killed = True
+                for t in sink.relays:
+                    t.kill()
+
+        sink.mutex.acquire()
+        procs = []
+        for task_id in self._expired(now):
+            if not sink.tasks_timed_out[task_id - 1]:
+                sink.gfl.log(self.log_tag, 'task %d timed out', 0, task_id)
+            sink.tasks_timed_out[task_id - 1] = True
+            procs += [ task.subp for task in sink.attempts[task_id] ]
+        sink.mutex.release()
+        for proc in procs:
+            self.kill(proc)
+
+    def _speculate(self, now):
+        sink = self.sink
+        launches = []
+        sink.mutex.acquire()
+        # Hosts with nothing left to do, where all tasks succeeded
+        busy = set(self.speculated.values())
+        for i, (hostid, cmd) in enumerate(sink.specs):
+            if hostid is not None and (sink.tasks_running_status[i] or sink.tasks_retcode[i] != 0):
+                busy.add(hostid)
+        for cmd, task_ids in self.classes.items():
+            durations = sorted([ sink.task_duration(task_id - 1) for task_id in task_ids
+                    if sink.tasks_finished_at[task_id - 1] is not None ])
+            if not durations or len(durations) < self.speculate * len(task_ids):
+                continue
+            spares = sorted(set([ sink.specs[task_id - 1][0] for task_id in task_ids ]) - busy)
+            median = durations[len(durations) // 2]
+            stragglers = [ task_id for task_id in task_ids if task_id in sink.attempts
+                    and task_id not in self.speculated and not sink.tasks_timed_out[task_id - 1]
+                    and now - sink.tasks_started_at[task_id - 1] >= median * SPECULATE_SLOWDOWN ]
+            # The slowest ones first
+            stragglers.sort(key=lambda task_id: sink.tasks_started_at[task_id - 1])
+            for task_id, hostid in zip(stragglers, spares):
+                self.speculated[task_id] = hostid
+                busy.add(hostid)
+                launches.append((task_id, hostid))
+        sink.mutex.release()
+        for task_id, hostid in launches:
+            sink.gfl.log(self.log_tag, 'speculate task %d on host %d', 0, task_id, hostid)
+            sink.launch_copy(task_id, hostid)
+
+    # The output logs of the running tasks, written by their readers
+    def _flush_logs(self):
+        sink = self.sink
+        if not sink.log_output:
+            return
+        sink.mutex.acquire()
+        sfls = [ task.sfl for attempts in sink.attempts.values() for task in attempts if task.sfl ]
+        sink.mutex.release()
+        for t in sink.relays:
+            sfls += list(t.sfls.values())
+        now = time.monotonic()
+        for sfl in sfls:
+            sfl.flush_stale(now)
+
+    def run(self):
+        while not self.stopped.wait(WATCHDOG_INTERVAL):
+            now = time.time()
+            self._flush_logs()
+            self._check_timeouts(now)
+            if self.sink.scheduler.admission:
+                self.sink.scheduler.repump()
+            if self.speculate > 0 and not self.sink.scheduler.cancelled:
+                self._speculate(now)
+            self._escalate(now)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -0,0 +1,54 @@
+# vim: expandtab smarttab ts=4
+
+import shlex
+import threading
+
+from common.configs import *
+
+class Item:
+    def __init__(self, seq, value):
+        self.seq = seq
+        self.value = value
+        self.returncode = None
+
+# The items of --items, handed out one at a time to whichever slot is free
+# first, so faster hosts take more of them.
+class WorkQueue:
+    def __init__(self, values):
+        self.items = [ Item(k + 1, value) for k, value in enumerate(values) ]
+        self.next = 0
+        self.completed = 0
+        self.failed = 0
+        self.mutex = threading.Lock()
+
+    def take(self):
+        self.mutex.acquire()
+        item = None
+        if self.next < len(self.items):
+            item = self.items[self.next]
+            self.next += 1
+        self.mutex.release()
+        return item
+
+    def done(self, item, returncode):
+        self.mutex.acquire()
+        item.returncode = returncode
+        self.completed += 1
+        if returncode != 0:
+            self.failed += 1
+        self.mutex.release()
+
+    # Items completed, failed among them, and not completed yet
+    def counts(self):
+        return self.completed, self.failed, len(self.items) - self.completed
+
+# One item per non-empty line
+def read_items(fin):
+    return [ line.rstrip('\n') for line in fin if line.strip() ]
+
+# The command of a slot for an item: the item replaces {}, or is appended if
+# there is no {}.
+def fill_item(cmd, value):
+    if ITEM_PLACEHOLDER in cmd:
+        return cmd.replace(ITEM_PLACEHOLDER, shlex.quote(value))
+    return '%s %s' % (cmd, shlex.quote(value))
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+# vim: expandtab smarttab ts=4
+
+# End-to-end benchmark of the TUI: M synthetic tasks print K lines/s each
+# (0: as fast as possible) and WindowHandler draws them on an in-memory fake
+# curses screen. Every case runs in its own process so that peak RSS and CPU
+# time are its own.
+#   python3 test/bench.py [-m 10,100] [-k 0,1000] [-n 2000] [-L 80] [-e thread,selector] [-o out.json]
+#   python3 test/bench.py --slow-terminal 200     (laggy terminal)
+#   python3 test/bench.py --compare old.json new.json
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import itertools
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+from common.configs import *
+
+SCREEN_HEIGHT = 50
+SCREEN_WIDTH = 160
+GEN_TICK = 0.01
+GEN_BURST = 256
+
+# Prints count lines starting with the time they were printed, and records
+# how long the writes blocked on the pipe.
+def generate(rate, length, count, stats_path):
+    out = sys.stdout.buffer
+    pad = 'x' * max(length - 20, 0)
+    per_tick = rate and rate * GEN_TICK or GEN_BURST
+    seq = 0
+    carry = 0.0
+    stall = 0.0
+    max_stall = 0.0
+    next_tick = time.monotonic()
+    while seq < count:
+        carry += per_tick
+        n = min(int(carry), count - seq)
+        carry -= n
+        if n:
+            now = time.monotonic()
+            data = ''.join([ '%.6f %d %s\n' % (now, seq + i, pad) for i in range(n) ]).encode()
+            out.write(data)
+            out.flush()
+            blocked = time.monotonic() - now
+            stall += blocked
+            max_stall = max(max_stall, blocked)
+            seq += n
+        if rate:
+            next_tick += GEN_TICK
+            time.sleep(max(next_tick - time.monotonic(), 0))
+    with open(stats_path, 'w') as fout:
+        json.dump({ 'lines': seq, 'stall_s': stall, 'max_stall_s': max_stall }, fout)
+
+class NullLogger:
+    def log(self, *args, **kwargs):
+        pass
+
+    def enabled(self, lvl):
+        return False
+
+    def dump_error(self, tag, e):
+        raise e
+
+# Just enough of curses for WindowHandler, SubPad and Renderer. Rows copied to
+# the screen by pads are checked for new timestamps at every doupdate().
+class FakeWindow:
+    def __init__(self, screen, height, width):
+        self.screen = screen
+        self.height = height
+        self.width = width
+        self.rows = [''] * height
+
+    def getmaxyx(self):
+        return self.height, self.width
+
+    def erase(self):
+        self.rows = [''] * self.height
+
+    def clear(self):
+        self.erase()
+
+    def move(self, y, x):
+        pass
+
+    def addstr(self, *args):
+        if len(args) >= 3 and isinstance(args[0], int):
+            y, x, text = args[:3]
+            if not 0 <= y < self.height:
+                raise FakeCurses.error('addstr out of window')
+            self.rows[y] = text
+
+    def noutrefresh(self, *args):
+        if len(args) == 6:
+            pminrow, pmincol, sminrow, smincol, smaxrow, smaxcol = args
+            for i in range(smaxrow - sminrow + 1):
+                self.screen.put(sminrow + i, self.rows[pminrow + i])
+
+# stdscr, with the virtual screen of curses (what noutrefresh() copied) and
+# what the terminal shows, which doupdate() brings up to date by writing the
+# rows that differ, or all of them after clear().
+class FakeScreen(FakeWindow):
+    def __init__(self, height, width, update_delay = 0.0):
+        super().__init__(self, height, width)
+        # Time a doupdate() takes, e.g. writing to a laggy ssh session
+        self.update_delay = update_delay
+        self.virtual = [''] * height
+        self.shown = [''] * height
+        self.touched = set()
+        self.cleared = False
+        self.rows_written = 0
+        self.seen = set()
+        self.latencies = []
+
+    def erase(self):
+        super().erase()
+        self.touched = set(range(self.height))
+
+    def clear(self):
+        self.erase()
+        self.cleared = True
+
+    def addstr(self, *args):
+        super().addstr(*args)
+        if len(args) >= 3 and isinstance(args[0], int):
+            self.touched.add(args[0])
+
+    def noutrefresh(self, *args):
+        for y in self.touched:
+            self.put(y, self.rows[y])
+        self.touched.clear()
+
+    def put(self, y, text):
+        if 0 <= y < self.height:
+            self.virtual[y] = text
+
+    def doupdate(self):
+        if self.update_delay:
+            time.sleep(self.update_delay)
+        now = time.monotonic()
+        changed = [ y for y in range(self.height) if self.cleared or self.virtual[y] != self.shown[y] ]
+        self.cleared = False
+        self.rows_written += len(changed)
+        for y in changed:
+            self.shown[y] = self.virtual[y]
+            fields = self.shown[y].split(' ', 2)
+            if len(fields) < 2:
+                continue
+            try:
+                printed = float(fields[0])
+            except ValueError:
+                continue
+            key = (fields[0], fields[1])
+            if key not in self.seen:
+                self.seen.add(key)
+                self.latencies.append(now - printed)
+
+class FakeCurses:
+    class error(Exception):
+        pass
+
+    COLOR_WHITE, COLOR_BLUE, COLOR_GREEN, COLOR_RED, COLOR_BLACK, COLOR_YELLOW = range(6)
+    KEY_RESIZE = -1
+
+    def __init__(self, screen):
+        self.screen = screen
+
+    def has_colors(self):
+        return True
+
+    def init_pair(self, *args):
+        pass
+
+    def color_pair(self, n):
+        return n
+
+    def newpad(self, height, width):
+        return FakeWindow(self.screen, height, width)
+
+    def doupdate(self):
+        self.screen.doupdate()
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * p / 100), len(values) - 1)]
+
+def run_case(case):
+    from common import argparser
+    import tui.WindowHandler
+    import tui.SubPad
+    import tui.Renderer
+
+    screen = FakeScreen(SCREEN_HEIGHT, SCREEN_WIDTH, case.get('update_delay_ms', 0) / 1000.0)
+    fake = FakeCurses(screen)
+    for module in (tui.WindowHandler, tui.SubPad, tui.Renderer):
+        module.curses = fake
+
+    # Scrollback spills go to .para-run/ under the current directory
+    workdir = tempfile.mkdtemp(prefix='para-run-bench-')
+    os.chdir(workdir)
+    bench = os.path.abspath(__file__)
+    cmds = [ '%s %s --gen %d %d %d %d.json' % (sys.executable, bench, case['rate'], case['length'], case['lines'], i + 1)
+            for i in range(case['tasks']) ]
+    specs = [ (None, cmd) for cmd in cmds ]
+
+    args = argparser.default_args()
+    args.engine = case['engine']
+    args.fps = case['fps']
+    handler = tui.WindowHandler.WindowHandler(cmds, specs, NullLogger(), args)
+    handler.init_all(screen)
+    renderer = tui.Renderer.Renderer(handler, handler.fps)
+
+    ru_start = resource.getrusage(resource.RUSAGE_SELF)
+    t_start = time.monotonic()
+    renderer.start()
+    handler.start_worker_threads(cmds)
+    handler.all_finished.wait()
+    wall = time.monotonic() - t_start
+    # Let the last output reach the screen
+    time.sleep(3.0 / handler.fps)
+    renderer.stop()
+    handler.join_worker_threads()
+    ru_end = resource.getrusage(resource.RUSAGE_SELF)
+
+    stats = []
+    for i in range(case['tasks']):
+        with open('%d.json' % (i + 1)) as fin:
+            stats.append(json.load(fin))
+    lines = sum([ s['lines'] for s in stats ])
+    stored = sum([ store.line_count() - 1 for store in handler.scrollbacks ])
+    handler.close()
+    shutil.rmtree(workdir)
+    assert stored == lines, 'lost output: %d of %d lines stored' % (stored, lines)
+
+    result = dict(case)
+    result.update({
+        'wall_s': round(wall, 3),
+        'ingest_lines_per_s': int(lines / wall),
+        'latency_p50_ms': None,
+        'latency_p99_ms': None,
+        'latency_max_ms': None,
+        'latency_samples': len(screen.latencies),
+        'rows_written': screen.rows_written,
+        'stall_total_s': round(sum([ s['stall_s'] for s in stats ]), 3),
+        'stall_max_ms': round(max([ s['max_stall_s'] for s in stats ]) * 1000, 2),
+        'handoff_total_s': round(handler.metrics.handoff.total, 6),
+        'cpu_s': round(ru_end.ru_utime - ru_start.ru_utime + ru_end.ru_stime - ru_start.ru_stime, 3),
+        'peak_rss_kb': ru_end.ru_maxrss,
+    })
+    for name, p in (('p50', 50), ('p99', 99), ('max', 100)):
+        value = percentile(screen.latencies, p)
+        if value is not None:
+            result['latency_%s_ms' % name] = round(value * 1000, 2)
+    return result
+
+COLUMNS = (
+    ('engine', '%-9s', '%-9s'),
+    ('tasks', '%6s', '%6d'),
+    ('rate', '%6s', '%6d'),
+    ('wall_s', '%8s', '%8.3f'),
+    ('ingest_lines_per_s', '%10s', '%10d'),
+    ('latency_p50_ms', '%8s', '%8s'),
+    ('latency_p99_ms', '%8s', '%8s'),
+    ('stall_total_s', '%8s', '%8.3f'),
+    ('rows_written', '%9s', '%9d'),
+    ('cpu_s', '%8s', '%8.3f'),
+    ('peak_rss_kb', '%9s', '%9d'),
+)
+COLUMN_TITLES = ('engine', 'tasks', 'rate', 'wall(s)', 'lines/s', 'p50(ms)', 'p99(ms)', 'stall(s)', 'rows', 'cpu(s)', 'rss(KB)')
+
+def print_header():
+    print(' '.join([ fmt % title for (key, fmt, vfmt), title in zip(COLUMNS, COLUMN_TITLES) ]))
+
+def print_row(r):
+    print(' '.join([ (r[key] is None and fmt % '-' or vfmt % r[key]) for key, fmt, vfmt in COLUMNS ]), flush=True)
+
+def case_key(r):
+    return (r['engine'], r['tasks'], r['rate'], r['lines'], r['length'], r['fps'], r.get('update_delay_ms', 0))
+
+# Relative change of each metric of the cases present in both files.
+def compare(old_path, new_path):
+    with open(old_path) as fin:
+        old = { case_key(r): r for r in json.load(fin)['results'] }
+    with open(new_path) as fin:
+        new = json.load(fin)['results']
+    metrics = ('ingest_lines_per_s', 'latency_p99_ms', 'stall_total_s', 'rows_written', 'cpu_s', 'peak_rss_kb')
+    print('%-9s %6s %6s ' % ('engine', 'tasks', 'rate') + ' '.join([ '%18s' % m for m in metrics ]))
+    for r in new:
+        base = old.get(case_key(r))
+        if base is None:
+            continue
+        changes = []
+        for m in metrics:
+            if base[m] and r[m] is not None:
+                changes.append('%+17.1f%%' % ((r[m] - base[m]) * 100.0 / base[m]))
+            else:
+                changes.append('%18s' % '-')
+        print('%-9s %6d %6d ' % (r['engine'], r['tasks'], r['rate']) + ' '.join(changes))
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', '-C', ROOT, 'rev-parse', '--short', 'HEAD'],
+                stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    if len(sys.argv) == 6 and sys.argv[1] == '--gen':
+        generate(*map(int, sys.argv[2:5]), sys.argv[5])
+        return
+    if len(sys.argv) == 3 and sys.argv[1] == '--case':
+        print(json.dumps(run_case(json.loads(sys.argv[2]))))
+        return
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--tasks', default='10,100', help='Comma separated task counts.')
+    parser.add_argument('-k', '--rate', default='0,1000', help='Comma separated lines/s printed by each task, 0 for as fast as possible.')
+    parser.add_argument('-n', '--lines', type=int, default=2000, help='Lines printed by each task.')
+    parser.add_argument('-L', '--length', type=int, default=80, help='Length of the printed lines.')
+    parser.add_argument('-e', '--engine', default='thread,selector', help='Comma separated engines.')
+    parser.add_argument('--fps', type=int, default=DEFAULT_FPS)
+    parser.add_argument('--slow-terminal', type=int, default=0, metavar='MS', help='Make every screen update take MS milliseconds.')
+    parser.add_argument('-o', '--output', help='Store the results as JSON.')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='Compare two stored results and exit.')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    results = []
+    print_header()
+    for engine, tasks, rate in itertools.product(args.engine.split(','),
+            map(int, args.tasks.split(',')), map(int, args.rate.split(','))):
+        case = { 'engine': engine, 'tasks': tasks, 'rate': rate, 'lines': args.lines,
+                'length': args.length, 'fps': args.fps, 'update_delay_ms': args.slow_terminal }
+        out = subprocess.check_output([ sys.executable, os.path.abspath(__file__), '--case', json.dumps(case) ])
+        results.append(json.loads(out))
+        print_row(results[-1])
+
+    if args.output:
+        with open(args.output, 'w') as fout:
+            json.dump({
+                'version': VERSION,
+                'revision': git_revision(),
+                'python': platform.python_version(),
+                'machine': platform.machine(),
+                'cpus': os.cpu_count(),
+                'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'results': results,
+            }, fout, indent=2)
+
+if __name__ == '__main__':
+    main()
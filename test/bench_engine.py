@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# vim: expandtab smarttab ts=4
+
+# Compare the thread-per-task engine with the selector engine without curses:
+#   python3 test/bench_engine.py [-n 10,100,1000] [-l 1000]
+
+import os
+import sys
+import time
+import argparse
+import resource
+import threading
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.runner import ENGINES, Task
+from common.scheduler import Scheduler
+
+class NullLogger:
+    def log(self, *args, **kwargs):
+        pass
+
+    def dump_error(self, tag, e):
+        raise e
+
+class BenchHandler:
+    def __init__(self, cmds):
+        self.gfl = NullLogger()
+        self.cmds = cmds
+        self.log_output = False
+        self.log_compress = False
+        self.log_ts = 'abs'
+        self.start_ts = datetime.now()
+        self.scheduler = Scheduler(self, [ (None, cmd) for cmd in cmds ])
+        self.mutex = threading.Lock()
+        self.lines = 0
+        self.finished = 0
+        self.all_done = threading.Event()
+        self.peak_threads = 0
+
+    def append_lines(self, task_id, lines):
+        self.mutex.acquire()
+        self.lines += len(lines)
+        self.mutex.release()
+
+    def set_live_line(self, task_id, line):
+        pass
+
+    def mark_started(self, task_id):
+        pass
+
+    def add_attempt(self, task):
+        pass
+
+    def attempt_finished(self, task, returncode):
+        self.mark_finished(task.index, returncode)
+
+    def mark_finished(self, task_id, returncode):
+        self.mutex.acquire()
+        self.finished += 1
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+        if self.finished == len(self.cmds):
+            self.all_done.set()
+        self.mutex.release()
+
+def bench(engine_name, ntasks, nlines):
+    cmds = [ f'seq 1 {nlines}' ] * ntasks
+    handler = BenchHandler(cmds)
+    ru_start = resource.getrusage(resource.RUSAGE_SELF)
+    t_start = time.perf_counter()
+
+    engine = ENGINES[engine_name](handler)
+    engine.start()
+    handler.scheduler.start(lambda task_id: engine.spawn(Task(cmds[task_id - 1], handler, task_id)))
+    handler.all_done.wait()
+    engine.join()
+
+    wall = time.perf_counter() - t_start
+    ru_end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (ru_end.ru_utime - ru_start.ru_utime) + (ru_end.ru_stime - ru_start.ru_stime)
+    assert handler.lines == ntasks * nlines
+    return {
+        'engine': engine_name,
+        'tasks': ntasks,
+        'lines': handler.lines,
+        'wall_s': round(wall, 3),
+        'cpu_s': round(cpu, 3),
+        'lines_per_s': int(handler.lines / wall),
+        'peak_threads': handler.peak_threads,
+    }
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--tasks', default='10,100,1000', help='Comma separated task counts.')
+    parser.add_argument('-l', '--lines', type=int, default=1000, help='Lines printed by each task.')
+    args = parser.parse_args()
+
+    print('%-9s %6s %9s %8s %8s %12s %8s' % ('engine', 'tasks', 'lines', 'wall(s)', 'cpu(s)', 'lines/s', 'threads'))
+    for ntasks in map(int, args.tasks.split(',')):
+        for engine_name in ENGINES:
+            r = bench(engine_name, ntasks, args.lines)
+            print('%-9s %6d %9d %8.3f %8.3f %12d %8d' % (r['engine'], r['tasks'], r['lines'],
+                    r['wall_s'], r['cpu_s'], r['lines_per_s'], r['peak_threads']))
+
+if __name__ == '__main__':
+    main()
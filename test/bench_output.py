@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# vim: expandtab smarttab ts=4
+
+# Throughput of the per-task output logs (-l), plain and gzipped:
+#   python3 test/bench_output.py [-n LINES] [-b BATCH]
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from common.logger import TaskFileLogger, run_dir
+
+# What para-run did before: lock, timestamp, write and flush every line.
+def bench_unbuffered(path, lines):
+    mutex = threading.Lock()
+    with open(path, 'w') as fout:
+        for line in lines:
+            mutex.acquire()
+            fout.write('%s: %s' % (str(datetime.now()), line))
+            mutex.release()
+            mutex.acquire()
+            fout.flush()
+            mutex.release()
+    return path
+
+def bench_task_logger(start_ts, lines, batch, compress, ts_format):
+    sfl = TaskFileLogger(start_ts, 1, emergency_out=sys.stderr, compress=compress, ts_format=ts_format)
+    for i in range(0, len(lines), batch):
+        sfl.write_lines(lines[i:i+batch])
+    sfl.close()
+    return os.path.join(run_dir(start_ts), '1.output' + (compress and '.gz' or ''))
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--lines', type=int, default=1000000)
+    parser.add_argument('-b', '--batch', type=int, default=64, help='Lines per write_lines() call.')
+    args = parser.parse_args()
+
+    # Outputs go to .para-run/ under the current directory
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='para-run-bench-')
+    os.chdir(workdir)
+    lines = [ 'line %08d %s\n' % (i, 'x' * 64) for i in range(args.lines) ]
+
+    cases = [ ('per-line flush', lambda ts: bench_unbuffered('old.output', lines)) ]
+    for compress in (False, True):
+        for ts_format in ('abs', 'delta', 'none'):
+            name = '%s/%s' % (compress and 'gzip' or 'plain', ts_format)
+            cases.append((name, lambda ts, c=compress, f=ts_format: bench_task_logger(ts, lines, args.batch, c, f)))
+
+    print('%-16s %9s %12s %12s' % ('mode', 'wall(s)', 'lines/s', 'size(KB)'))
+    for i, (name, fn) in enumerate(cases):
+        start_ts = datetime(2000, 1, 1, 0, 0, i)
+        t_start = time.perf_counter()
+        path = fn(start_ts)
+        wall = time.perf_counter() - t_start
+        print('%-16s %9.3f %12d %12d' % (name, wall, args.lines / wall, os.path.getsize(path) // 1024))
+
+    os.chdir(cwd)
+    shutil.rmtree(workdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+# vim: expandtab smarttab ts=4
+
+# A local stand-in for ssh: runs the remote command with sh on this box after
+# sleeping FAKE_SSH_HANDSHAKE seconds (0.3 by default) to mimic a handshake.
+# ControlMaster/ControlPath/-O exit are emulated with plain files, so
+# connections through a warmed master skip the handshake:
+#   para-run --ssh 'python3 test/fake-ssh.py' --ssh-mux -r 1-8 'hostname'
+
+import os
+import sys
+import time
+
+OPTS_WITH_ARG = set('BbcDEeFIiJLlmOoPpQRSWw')
+
+def main():
+    argv = sys.argv[1:]
+    opts = {}
+    ctl_cmd = None
+    no_cmd = False
+    while argv and argv[0].startswith('-'):
+        opt = argv.pop(0)
+        for i, flag in enumerate(opt[1:]):
+            if flag in OPTS_WITH_ARG:
+                val = opt[i+2:] or argv.pop(0)
+                if flag == 'o':
+                    key, _, v = val.partition('=')
+                    opts[key.lower()] = v
+                elif flag == 'O':
+                    ctl_cmd = val
+                break
+            if flag == 'N':
+                no_cmd = True
+
+    host = argv.pop(0)
+    cmd = ' '.join(argv)
+    handshake = float(os.environ.get('FAKE_SSH_HANDSHAKE', '0.3'))
+    control_path = opts.get('controlpath', '').replace('%C', 'fake-' + host).replace('%h', host)
+    master = opts.get('controlmaster', 'no')
+    has_master = control_path and os.path.exists(control_path)
+
+    if ctl_cmd == 'exit':
+        if has_master:
+            os.remove(control_path)
+            return 0
+        sys.stderr.write('Control socket connect(%s): No such file or directory\n' % control_path)
+        return 255
+    if no_cmd:
+        if master in ('yes', 'auto') and control_path:
+            time.sleep(handshake)
+            open(control_path, 'w').close()
+        return 0
+
+    if not has_master:
+        time.sleep(handshake)
+    os.environ['FAKE_SSH_HOST'] = host
+    os.execvp('sh', [ 'sh', '-c', cmd ])
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,14 @@
+#!/bin/bash
+
+printf "\033[1mDownloading\033[0m\n"
+for i in $(seq 0 5 100); do
+    printf "\r%3d%% [\033[32m%-20s\033[0m]" $i "$(printf '#%.0s' $(seq 0 $((i / 5))))"
+    sleep 0.1
+done
+echo
+printf "\033[33mwarning:\033[0m spinner next\n"
+for c in '|' '/' '-' '\' '|' '/' '-' '\'; do
+    printf "\r\033[Kworking %s" "$c"
+    sleep 0.2
+done
+printf "\r\033[K\033[1;31merror:\033[0m done\n"
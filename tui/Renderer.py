@@ -0,0 +1,37 @@
+# vim: expandtab smarttab ts=4
+
+import time
+import threading
+
+class Renderer(threading.Thread):
+    def __init__(self, wh, fps):
+        super().__init__(daemon=True)
+        self.wh = wh
+        self.frame_interval = 1.0 / fps
+        self.stopped = threading.Event()
+        self.log_tag = 'Renderer'
+
+    def run(self):
+        while not self.stopped.is_set():
+            frame_start = time.monotonic()
+            self.wh.mutex.acquire()
+            render_start = time.monotonic()
+            drawn = False
+            try:
+                drawn = self.wh._render_frame()
+            except Exception as e:
+                self.wh.gfl.log(self.log_tag, 'Render frame failed.')
+                self.wh.gfl.dump_error(self.log_tag, e)
+            finally:
+                render_end = time.monotonic()
+                self.wh.mutex.release()
+            elapsed = time.monotonic() - frame_start
+            if drawn:
+                # Frames missed because this one, waiting for the mutex
+                # included, took longer than frame_interval
+                self.wh.metrics.add_frame(render_end - render_start, int(elapsed // self.frame_interval))
+            self.stopped.wait(max(self.frame_interval - elapsed, 0))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
@@ -3,8 +3,62 @@
 import curses
 import traceback
 import time
+import unicodedata
 
 from common.configs import *
+from common.grouping import format_members
+from common import ansi
+
+def _char_width(ch):
+    if ch < ' ':
+        # curses shows control characters as ^X
+        return 2
+    if unicodedata.combining(ch):
+        return 0
+    return unicodedata.east_asian_width(ch) in ('W', 'F') and 2 or 1
+
+# Split a line into screen rows of at most width columns.
+def split_rows(line, width):
+    line = line.expandtabs(8)
+    if line.isascii() and line.isprintable():
+        return [ line[i:i+width] for i in range(0, len(line), width) ] or ['']
+    rows = []
+    row_start = 0
+    cols = 0
+    for i, ch in enumerate(line):
+        w = _char_width(ch)
+        if cols + w > width:
+            rows.append(line[row_start:i])
+            row_start = i
+            cols = 0
+        cols += w
+    rows.append(line[row_start:])
+    return rows
+
+# Split a line with SGR sequences into screen rows of at most width columns,
+# each a list of (text, style).
+def split_styled_rows(line, width):
+    rows = [ [] ]
+    cols = 0
+    for text, style in ansi.styled_runs(line):
+        piece = []
+        for ch in text:
+            if ch == '\t':
+                ch = ' ' * (8 - cols % 8)
+                w = len(ch)
+            else:
+                w = _char_width(ch)
+            if cols + w > width and cols:
+                if piece:
+                    rows[-1].append((''.join(piece), style))
+                    piece = []
+                rows.append([])
+                cols = 0
+            piece.append(ch)
+            cols += w
+        if piece:
+            rows[-1].append((''.join(piece), style))
+    return rows
 
 class SubPad:
     def __init__(self, wh, index):
@@ -12,142 +66,280 @@ class SubPad:
         self.index = index
         self.log_tag = 'SubPad(%d)' % self.index
         # Allow a separation line between tasks
-        self.shown_pos_offset = index * (wh.subpads_shown_height + 2) + HEADER_LINES
+        self.shown_pos_offset = index * (wh.subpads_shown_height + 2) + wh.header_lines
         self.shown_height = wh.subpads_shown_height
         self.watching_at_end = True
+        # Positions are line numbers in the task's scrollback
         self.visible_pos = 0
         self.cursor_pos = 0
-        self.pad = curses.newpad(DEFAULT_SUBPADS_HEIGHT, wh.width)
-        self.pad.scrollok(True)
-        #self._swap_buffer(wh.output_buffer[index])
+        self.store = wh.store_of(index)
+        # With --group: the group shown by this subpad, and its position in
+        # WindowHandler.subpads (None while hidden).
+        self.group = None
+        self.slot = index
+        # Only as large as the shown area and only while the subpad is in the
+        # viewport, filled from self.store.
+        self.pad = None
+        self.pad_stale = True
+        self.rendered_pos = 0
+        self.title = None
+        # What was last copied to the screen, see _refresh_title() and
+        # _refresh_content()
+        self.title_drawn = None
+        self.pad_drawn = None
 
-    def _swap_buffer(self, buffered_lines):
-        self.pad.addstr(buffered_lines)
+    # New lines were appended to self.store
+    def _follow_output(self):
         if self.watching_at_end:
-            y, x = self.pad.getyx()
-            self.cursor_pos = y
-        self._maybe_update_visible_pos()
-        self._refresh()
-        #self.wh.stdscr.refresh()
+            self.cursor_pos = self.store.line_count() - 1
 
-    def _refresh(self):
+    def release(self):
+        self.pad = None
+        self.pad_drawn = None
+
+    def set_store(self, store):
+        self.store = store
+        self.pad_stale = True
+        self.visible_pos = 0
+        self.watching_at_end = True
+        self._follow_output()
+
+    def _rows(self, line_no):
+        return len(split_rows(ansi.strip(self.store.get_line(line_no)), self.wh.width))
+
+    def _render_pad(self):
+        if self.pad is None or self.pad.getmaxyx() != (self.shown_height, self.wh.width):
+            self.pad = curses.newpad(self.shown_height, self.wh.width)
+        self.pad.erase()
+        self.rendered_pos = self.visible_pos
+        row = 0
+        line_no = self.visible_pos
+        line_count = self.store.line_count()
+        while row < self.shown_height and line_no < line_count:
+            line = self.store.get_line(line_no)
+            if '\x1b' in line:
+                row = self._render_styled(row, line)
+                line_no += 1
+                continue
+            for text in split_rows(line, self.wh.width):
+                if row >= self.shown_height:
+                    break
+                try:
+                    self.pad.addstr(row, 0, text)
+                except curses.error:
+                    # Writing the bottom-right cell fails to advance the cursor
+                    pass
+                row += 1
+            line_no += 1
+
+    # Same as above for a line with colors and attributes
+    def _render_styled(self, row, line):
+        for runs in split_styled_rows(line, self.wh.width):
+            if row >= self.shown_height:
+                break
+            self.pad.move(row, 0)
+            for text, style in runs:
+                try:
+                    self.pad.addstr(text, self.wh.style_attr(style))
+                except curses.error:
+                    pass
+            row += 1
+        return row
+
+    def _task_state_str(self, i, with_retcode):
+        if self.wh.tasks_pending_status[i]:
+            return 'PENDING'
+        if self.wh.tasks_running_status[i]:
+            return 'RUNNING'
+        if self.wh.tasks_timed_out[i]:
+            return 'TIMEOUT'
+        if not with_retcode:
+            return 'STOPPED'
+        retcode = self.wh.tasks_retcode[i]
+        return 'STOPPED:%s' % (retcode is None and '?' or retcode)
+
+    def _members(self):
+        if self.group is None:
+            return [ self.index ]
+        return sorted(self.group.members)
+
+    def _state_str(self, with_retcode):
+        counts = {}
+        for i in self._members():
+            state = self._task_state_str(i, with_retcode)
+            counts[state] = counts.get(state, 0) + 1
+        if len(counts) == 1:
+            if self.group is None and self.wh.task_duration(self.index) is not None:
+                usage = self.wh.tasks_usage[self.index]
+                # Replayed runs only have their timestamps
+                if usage.wall is None:
+                    return '%s %.1fs' % (state, self.wh.task_duration(self.index))
+                return '%s %.1fs %s' % (state, usage.wall, usage.describe())
+            return state
+        return ' '.join([ '%s x%d' % item for item in counts.items() ])
+
+    def _state_color(self):
+        members = self._members()
+        if any([ self.wh.tasks_running_status[i] and not self.wh.tasks_pending_status[i] for i in members ]):
+            return 2
+        if any([ self.wh.tasks_pending_status[i] for i in members ]):
+            return 4
+        return 3
+
+    def _name(self):
+        if self.group is None:
+            return 'PROC %d' % (self.index+1)
+        return '%s (%d)' % (format_members(self.group.members, self.wh.specs), len(self.group.members))
+
+    def _cmd(self):
+        if self.group is not None:
+            return self.wh.specs[self.index][1]
+        if self.wh.work_queue is None:
+            return self.wh.cmds[self.index]
+        # A slot of --items
+        item = self.wh.slot_items[self.index]
+        if item is not None:
+            return 'item %d: %s | %s' % (item.seq, item.value, self.wh.cmds[self.index])
+        return '%d items | %s' % (self.wh.slot_done[self.index], self.wh.cmds[self.index])
+
+    def _matches_str(self):
+        if self.wh.search is None:
+            return ''
+        return ' [%d matches]' % self.wh.search.count(self.store)
+
+    # The title and its color pair, rebuilt after invalidate_title()
+    def _title(self):
+        if self.title is None or self.title[2] != self.wh.width:
+            title = '[%s] (%s)%s %s' % (self._name(), self._state_str(self.wh.color_available),
+                    self._matches_str(), self._cmd())
+            if len(title) < self.wh.width:
+                title += ' ' * (self.wh.width - len(title))
+            else:
+                title = title[:self.wh.width]
+            self.title = (title, self._state_color(), self.wh.width)
+        return self.title
+
+    def invalidate_title(self):
+        self.title = None
+
+    # The output shown has changed
+    def invalidate_pad(self):
+        self.pad_stale = True
+
+    # Only updates the virtual screen, the caller is responsible for
+    # curses.doupdate(). Rows already showing the right thing since the last
+    # erase of the screen are left alone.
+    def _refresh_title(self):
         assert(self.wh.mutex.locked())
 
-        # pad subtitle
         pad_title_pos = self.shown_pos_offset + self.wh.user_control_offset
-        if HEADER_LINES <= pad_title_pos < self.wh.height - 1:
+        if not self.wh.header_lines <= pad_title_pos < self.wh.height - 1:
+            return
+        title, color, width = self._title()
+        drawn = (self.wh.screen_epoch, pad_title_pos, title, color)
+        if drawn == self.title_drawn:
+            return
+        self.title_drawn = drawn
+        self.wh.gfl.log(self.log_tag, 'refresh pad_title_pos %d %d %s', 5, pad_title_pos, self.wh.width, title)
+        try:
             if self.wh.color_available:
-                #title = '[PROC %d] %s' % (self.index+1, self.wh.cmds[self.index])
-                title = '[PROC %d] (%s) %s' % (self.index+1,
-                        (self.wh.tasks_running_status[self.index] \
-                            and 'RUNNING' or f'STOPPED:{self.wh.tasks_retcode[self.index]}'),
-                        self.wh.cmds[self.index])
-                self.wh.gfl.log(self.log_tag, 'refresh pad_title_pos ' + str(pad_title_pos) + f' {self.wh.width} ' + title, 5)
-                if len(title) < self.wh.width:
-                    title += ' ' * (self.wh.width - len(title))
-                else:
-                    title = title[:self.wh.width]
-
-                try:
-                    self.wh.stdscr.addstr(pad_title_pos, 0, title,
-                        curses.color_pair(self.wh.tasks_running_status[self.index] and 2 or 3))
-                except Exception as e:
-                    self.wh.gfl.log(self.log_tag, 'ncurses.pad.refresh error. Might because we are resizing the screen size when the pad is refreshing.')
-                    self.wh.gfl.dump_error(self.log_tag, e)
-
-                #if not True in self.wh.tasks_running_status:
-                #    if self.index == 0:
-                #        time.sleep(2)
-                #    else:
-                #        time.sleep(1)
+                self.wh.stdscr.addstr(pad_title_pos, 0, title, curses.color_pair(color))
             else:
-                title = '[PROC %d] (%s) %s' % (self.index+1,
-                        (self.wh.tasks_running_status[self.index] \
-                            and 'RUNNING' or 'STOPPED'),
-                        self.wh.cmds[self.index])
-                if len(title) < self.wh.width:
-                    title += ' ' * (self.wh.width - len(title))
-                else:
-                    title = title[:self.wh.width]
-                self.wh.gfl.log(self.log_tag, 'refresh pad_title_pos ' + str(pad_title_pos) + title, 5)
                 self.wh.stdscr.addstr(pad_title_pos, 0, title)
+        except Exception as e:
+            self.wh.gfl.log(self.log_tag, 'ncurses.pad.refresh error. Might because we are resizing the screen size when the pad is refreshing.')
+            self.wh.gfl.dump_error(self.log_tag, e)
+
+    def _refresh_content(self):
+        assert(self.wh.mutex.locked())
 
         # pad area: pad_render_offset_start ~ pad_render_offset_end
-        # window area: 2 ~ self.wh.height
+        # window area: header_lines ~ self.wh.height
         pad_render_offset_start = self.shown_pos_offset + self.wh.user_control_offset + 1
         pad_render_offset_end = pad_render_offset_start + self.shown_height - 1
-        render_offset_start = max(pad_render_offset_start, HEADER_LINES)
+        render_offset_start = max(pad_render_offset_start, self.wh.header_lines)
         render_offset_end = min(pad_render_offset_end, self.wh.height - 1)
         if render_offset_start >= self.wh.height \
-        or render_offset_end < HEADER_LINES:
+        or render_offset_end < self.wh.header_lines:
             return
 
-        render_height = render_offset_end - render_offset_start + 1
-
-        #y, x = self.pad.getyx()
-        #if self.watching_at_end:
-        #    if render_offset_start == HEADER_LINES:
-        #        self.visible_pos = max(max(y, self.shown_height) - render_height, 0)
-        #    else:
-        #        self.visible_pos = max(y - self.shown_height, 0)
-            #self.visible_pos = max(y - render_height + 1, 0)
-
-        #if not True in self.wh.tasks_running_status:
-        #    self.wh.stdscr.addstr(0, 0, f'Subpad {self.index}')
-        #    self.wh.stdscr.refresh()
-        #    time.sleep(1)
+        self._maybe_update_visible_pos()
+        rendered = self.pad_stale or self.pad is None or self.visible_pos != self.rendered_pos \
+                or self.pad.getmaxyx() != (self.shown_height, self.wh.width)
+        if rendered:
+            self._render_pad()
+            self.pad_stale = False
 
-        # +2 is magic number, haha
-        # This is because we reserve a line at the bottom
+        region = (render_offset_start - pad_render_offset_start, 0,
+                render_offset_start, 0, render_offset_end, self.wh.width - 1)
+        drawn = (self.wh.screen_epoch, region)
+        if not rendered and drawn == self.pad_drawn:
+            return
+        self.pad_drawn = drawn
         try:
-            self.pad.refresh(self.visible_pos, 0,
-                            render_offset_start, 0,
-                            render_offset_end, self.wh.width - 1)
+            self.pad.noutrefresh(*region)
         except Exception as e:
             self.wh.gfl.log(self.log_tag, 'ncurses.pad.refresh error. Might because we are resizing the screen size when the pad is refreshing.')
             self.wh.gfl.dump_error(self.log_tag, e)
 
-        self.wh.gfl.log(self.log_tag,
-                'refresh ' + repr(self) + f' region w={self.wh.width},h={self.wh.height},rs={render_offset_start},re={render_offset_end}', 3)
-        #traceback.print_stack(file=self.wh.gfl._fl)
+        if self.wh.gfl.enabled(3):
+            self.wh.gfl.log(self.log_tag, 'refresh %s region w=%d,h=%d,rs=%d,re=%d', 3,
+                    repr(self), self.wh.width, self.wh.height, render_offset_start, render_offset_end)
 
-        self.wh.gfl.log(self.log_tag, 'refresh ' + repr(self) + ' finish.', 5)
-        self.wh.stdscr.refresh()
+    def _refresh(self):
+        self._refresh_title()
+        self._refresh_content()
 
     def refresh(self):
         self.wh.mutex.acquire()
         self._refresh()
+        self.wh.show_cursor(True)
         self.wh.mutex.release()
 
+    # Rows taken on screen by the lines from self.visible_pos to line_no
+    def _rows_before(self, line_no):
+        return sum([ self._rows(i) for i in range(self.visible_pos, line_no) ])
+
     def _maybe_update_visible_pos(self):
         if self.cursor_pos < self.visible_pos:
             self.visible_pos = max(self.cursor_pos, 0)
             return True
-        elif self.cursor_pos >= self.visible_pos + self.shown_height:
+        old_visible_pos = self.visible_pos
+        # Every line takes at least one row
+        if self.cursor_pos >= self.visible_pos + self.shown_height:
             self.visible_pos = self.cursor_pos - self.shown_height + 1
-            return True
-        return False
+        while self.visible_pos < self.cursor_pos \
+        and self._rows_before(self.cursor_pos) + 1 > self.shown_height:
+            self.visible_pos += 1
+        return self.visible_pos != old_visible_pos
 
     def move_cursor(self, direction):
         self.cursor_pos += direction
-        y, x = self.pad.getyx()
+        last_line = self.store.line_count() - 1
         self.watching_at_end = False
         if self.cursor_pos < 0:
             self.cursor_pos = 0
-        elif self.cursor_pos > y:
-            self.cursor_pos = y
+        elif self.cursor_pos >= last_line:
+            self.cursor_pos = last_line
             self.watching_at_end = True
 
         if self._maybe_update_visible_pos():
             self.refresh()
+        else:
+            self.wh.show_cursor(True)
 
-        self.wh.show_cursor()
+    def jump_to(self, line_no):
+        self.cursor_pos = line_no
+        self.watching_at_end = line_no >= self.store.line_count() - 1
+        self._maybe_update_visible_pos()
+        self.refresh()
 
     def get_cursor_posy(self):
-        return self.shown_pos_offset + 1 + self.cursor_pos \
-                + self.wh.user_control_offset - self.visible_pos
+        return self.shown_pos_offset + 1 + self._rows_before(self.cursor_pos) \
+                + self.wh.user_control_offset
 
     def adjust_height(self, size):
+        self.pad_stale = True
         new_height = max(self.shown_height + size, 1)
         real_adjust_size = new_height - self.shown_height
         self.shown_height = new_height
@@ -155,6 +347,5 @@ class SubPad:
         return real_adjust_size
 
     def __repr__(self):
-        y, x = self.pad.getyx()
-        return f'WindowHandler.SubPad(h={self.shown_height},v={self.visible_pos},o={self.shown_pos_offset},y={y},x={x})'
+        return f'WindowHandler.SubPad(h={self.shown_height},v={self.visible_pos},o={self.shown_pos_offset},c={self.cursor_pos},n={self.store.line_count()})'
 
@@ -3,36 +3,93 @@
 from common.configs import *
 
 import os
-import threading
+import re
+import time
 import curses
-from datetime import datetime
+from collections import deque
 
 from tui.SubPad import SubPad
-from common.runner import Task
-
-class WindowHandler:
-    def __init__(self, cmds, gfl, args):
-        self.gfl = gfl
-        self.cmds = cmds
-        self.tasks_total = len(cmds)
-        self.tasks_running_status = [True] * self.tasks_total
-        self.tasks_retcode = [0] * self.tasks_total
-        self.output_buffer = [''] * self.tasks_total
-        self.mutex = threading.Lock()
+from tui.Renderer import Renderer
+from common.sink import Sink
+from common.scrollback import Scrollback
+from common.logger import run_dir
+from common.search import Search
+from common.grouping import Grouper
+from common.history import format_duration
+from common import ansi
+
+class WindowHandler(Sink):
+    # Color pairs 1 to 4 are the ones of init_all(), the colors of the output
+    # get the next ones. A chtype has 8 bits for the pair.
+    STYLE_PAIR_FIRST = 5
+    STYLE_PAIR_LAST = 255
+    SGR_ATTRS = { 1: 'A_BOLD', 2: 'A_DIM', 3: 'A_ITALIC', 4: 'A_UNDERLINE', 5: 'A_BLINK', 7: 'A_REVERSE' }
+
+    def __init__(self, cmds, specs, gfl, args):
+        super().__init__(cmds, specs, gfl, args)
+        self.log_tag = 'WindowHandler'
+        # Filled by the readers without the mutex and drained by the
+        # Renderer, so a slow terminal never keeps them from reading pipes.
+        self.inbox = [ deque() for i in range(self.tasks_total) ]
+        self.inbox_pending = False
+        self.live_lines = [ '' ] * self.tasks_total
+        # ansi style -> curses attribute, (fg, bg) -> color pair
+        self.style_attrs = {}
+        self.style_pairs = {}
         self.subpads_shown_height = args.subwin_height
-        self.log_output = args.log_output
-        self.start_ts = datetime.now()
+        self.fps = args.fps
+        self.spill_dir = os.path.join(run_dir(self.start_ts), 'scrollback')
+        self.scrollback_lines = args.scrollback_lines
+        # With --group, tasks with the same output share the scrollback of
+        # their group instead of having their own.
+        self.grouper = None
+        self.finished_to_group = []
+        if args.group:
+            self.scrollbacks = []
+            self.grouper = Grouper(self.tasks_total, self._new_group_store)
+        else:
+            self.scrollbacks = [ Scrollback(self.spill_dir, i + 1, args.scrollback_lines) for i in range(self.tasks_total) ]
         self.user_control_offset = 0
+        # Rows above the subpads: the header, the stats panel if shown and an
+        # empty line
+        self.header_lines = HEADER_LINES
+        self.stats_shown = False
+        self.stats_drawn_at = 0.0
+        # Subpads [visible_first, visible_last) intersect the viewport
+        self.visible_first = 0
+        self.visible_last = 0
         self.cursor_in_subpad = 0
         self.flag_refresh = False
         self.has_update = False
+        self.header_dirty = False
+        # Tasks whose output (dirty_subpads) or state (dirty_titles) changed
+        self.dirty_subpads = set()
+        self.dirty_titles = set()
+        # Bumped whenever the screen is erased, what was drawn before has to
+        # be drawn again
+        self.screen_epoch = 0
+        self.header_drawn = None
+        # When the header last showed an ETA, None if it did not
+        self.eta_drawn_at = None
+        self.full_clear = False
         self.inited = False
+        # Shown on the bottom line: the search being typed, or a message until
+        # the next key
+        self.prompt = None
+        self.message = None
+        self.search = None
+        # The ReplayRun shown instead of running the commands (--replay)
+        self.replay = None
+        # The SessionClient of the session shown (--attach), and whether it
+        # has ended
+        self.session = None
+        self.session_over = False
 
     def _init_size(self):
         self.height, self.width = self.stdscr.getmaxyx()
         #self.stdscr.erase()
         #self.stdscr.refresh()
-        self.gfl.log('WindowHandler', f'Screen size resized to {self.height} * {self.width}', 1)
+        self.gfl.log('WindowHandler', 'Screen size resized to %d * %d', 1, self.height, self.width)
 
     # Must be called after curses.initscr()
     def init_all(self, stdscr):
@@ -43,49 +100,301 @@ class WindowHandler:
             curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_BLUE)
             curses.init_pair(2, curses.COLOR_WHITE, curses.COLOR_GREEN)
             curses.init_pair(3, curses.COLOR_WHITE, curses.COLOR_RED)
+            curses.init_pair(4, curses.COLOR_BLACK, curses.COLOR_YELLOW)
 
         self.mutex.acquire()
         self._init_size()
         self._refresh_header()
-        self.subpads = [SubPad(self, i) for i in range(self.tasks_total)]
+        # Every task has a subpad, self.subpads are the ones shown
+        self.task_subpads = [SubPad(self, i) for i in range(self.tasks_total)]
+        self.subpads = self.task_subpads
+        if self.grouper:
+            self._relayout()
         self.inited = True
+        self.flag_refresh = True
         self.mutex.release()
 
-    def append_line(self, task_id, line):
-        self.mutex.acquire()
-        self.gfl.log('WindowHandler', 'append_line %d %s' % (task_id, line), 2)
-        self.output_buffer[task_id - 1] += line
-        self.has_update = True
-        self._update_buffers()
-        self.mutex.release()
+    # Shows the logs of a past run instead of running anything. Must be
+    # called before init_all().
+    def load_replay(self, run):
+        self.replay = run
+        self.scrollbacks = run.open_logs()
+        for i, task in enumerate(run.tasks):
+            self.tasks_pending_status[i] = False
+            self.tasks_running_status[i] = False
+            self.tasks_retcode[i] = task.get('returncode')
+            self.tasks_started_at[i] = task.get('started')
+            self.tasks_finished_at[i] = task.get('finished')
+            self.tasks_timed_out[i] = task.get('timed_out', False)
+        self.tasks_pending = 0
+        self.tasks_finished = self.tasks_total
+        self.all_finished.set()
+
+    # The curses attribute showing an ansi style. Must hold self.mutex.
+    def style_attr(self, style):
+        attr = self.style_attrs.get(style)
+        if attr is None:
+            attr = self.style_attrs[style] = self._make_style_attr(style)
+        return attr
+
+    def _make_style_attr(self, style):
+        flags, fg, bg = style
+        attr = 0
+        for flag in flags:
+            if flag in self.SGR_ATTRS:
+                attr |= getattr(curses, self.SGR_ATTRS[flag], 0)
+        if not self.color_available or (fg is None and bg is None):
+            return attr
+        colors = (curses.COLOR_WHITE, curses.COLOR_BLACK)
+        if fg is not None:
+            colors = (ansi.color_number(fg, curses.COLORS), colors[1])
+        if bg is not None:
+            colors = (colors[0], ansi.color_number(bg, curses.COLORS))
+        pair = self.style_pairs.get(colors)
+        if pair is None:
+            pair = self.STYLE_PAIR_FIRST + len(self.style_pairs)
+            if pair > min(self.STYLE_PAIR_LAST, curses.COLOR_PAIRS - 1):
+                # Out of pairs, the attributes are still shown
+                return attr
+            curses.init_pair(pair, *colors)
+            self.style_pairs[colors] = pair
+        return attr | curses.color_pair(pair)
+
+    # Shows a session running in the background instead of running the
+    # commands. Must be called before init_all().
+    def attach_session(self, client):
+        self.session = client
+        if self.work_queue is not None:
+            self.work_queue = client.queue
+
+    def start_worker_threads(self, cmds):
+        if self.replay:
+            return True
+        if self.session:
+            self.session.start_feeding(self)
+            return True
+        return super().start_worker_threads(cmds)
+
+    def kill_all(self):
+        if self.session:
+            self.session.kill()
+            return
+        super().kill_all()
+
+    # Called by the SessionClient once the session is gone
+    def session_ended(self):
+        self.session_over = True
+        if not self.all_finished.is_set():
+            self.show_message('The session ended before its tasks, press q to quit.')
+
+    def _new_group_store(self, gid):
+        return Scrollback(self.spill_dir, 'g%d' % gid, self.scrollback_lines)
+
+    def store_of(self, i):
+        if self.grouper:
+            return self.grouper.task_group[i].store
+        return self.scrollbacks[i]
+
+    # The subpad showing the output of task i
+    def _subpad_of(self, i):
+        if self.grouper:
+            return self.task_subpads[self.grouper.task_group[i].leader()]
+        return self.task_subpads[i]
+
+    # Shows one subpad per group, the one of its first task. Must hold
+    # self.mutex.
+    def _relayout(self):
+        current = self.subpads[self.cursor_in_subpad].index
+        for subpad in self.subpads:
+            subpad.release()
+            subpad.invalidate_title()
+            subpad.group = None
+            subpad.slot = None
+        shown = []
+        offset = self.header_lines
+        for group in self.grouper.ordered_groups():
+            subpad = self.task_subpads[group.leader()]
+            subpad.group = group
+            subpad.invalidate_title()
+            if subpad.store is not group.store:
+                subpad.set_store(group.store)
+            subpad.slot = len(shown)
+            subpad.shown_pos_offset = offset
+            offset += subpad.shown_height + 2
+            shown.append(subpad)
+        self.subpads = shown
+        self.cursor_in_subpad = self._subpad_of(current).slot
+        self.visible_first = self.visible_last = 0
+        self.gfl.log('WindowHandler', 'relayout: %d groups', 2, len(shown))
+
+    # Must hold self.mutex. Tasks are sealed in their group only after
+    # their last output, which may still be queued when they finish.
+    def _regroup(self):
+        for i in self.finished_to_group:
+            self._swap_buffer(i)
+            self.grouper.finish(i)
+        self.finished_to_group = []
+        if self.grouper.take_changed():
+            self._relayout()
+            return True
+        return False
+
+    # Readers only queue output here, the Renderer draws it with the next
+    # frame. Each task has a single reader, deque.append() needs no lock.
+    def append_lines(self, task_id, lines):
+        start = time.perf_counter()
+        self.gfl.log('WindowHandler', 'append_lines %d %r', 2, task_id, lines)
+        self.metrics.add_output(task_id, lines)
+        self.inbox[task_id - 1].append(lines)
+        self.inbox_pending = True
+        self.metrics.handoff.record(time.perf_counter() - start)
+
+    # An empty batch has the Renderer pick the line up. Groups only show
+    # terminated lines.
+    def set_live_line(self, task_id, line):
+        if self.grouper:
+            return
+        self.live_lines[task_id - 1] = line
+        self.inbox[task_id - 1].append([])
+        self.inbox_pending = True
+
+    # Must hold self.mutex. Cleared before looking so that output queued
+    # meanwhile sets it again for the next frame.
+    def _drain_inbox(self):
+        if not self.inbox_pending:
+            return
+        self.inbox_pending = False
+        for i, queue in enumerate(self.inbox):
+            if queue:
+                self.dirty_subpads.add(i)
+                self.has_update = True
 
     def _update_buffers(self):
         self.gfl.log('WindowHandler', '_update_buffers', 10)
-        for i in range(self.tasks_total):
-            if self.output_buffer[i]:
-                self.subpads[i]._swap_buffer(self.output_buffer[i])
-                self.output_buffer[i] = ''
+        if self.header_dirty:
+            self._refresh_header()
+            self.stdscr.noutrefresh()
+            self.header_dirty = False
+        for i in self.dirty_subpads:
+            self._swap_buffer(i)
+        if self.grouper and self._regroup():
+            self._refresh_all()
+            return
+        for i in self.dirty_titles:
+            self._subpad_of(i).invalidate_title()
+        refreshed = set()
+        for i in self.dirty_subpads:
+            subpad = self._subpad_of(i)
+            if self.visible_first <= subpad.slot < self.visible_last and subpad not in refreshed:
+                subpad._refresh()
+                refreshed.add(subpad)
+        for i in self.dirty_titles:
+            subpad = self._subpad_of(i)
+            if self.visible_first <= subpad.slot < self.visible_last and subpad not in refreshed:
+                subpad._refresh_title()
+                refreshed.add(subpad)
+        self.dirty_subpads.clear()
+        self.dirty_titles.clear()
         self.show_cursor(True)
         self.has_update = False
 
-    def mark_finished(self, task_id, returncode):
-        self.mutex.acquire()
-        self.tasks_running_status[task_id - 1] = False
-        self.tasks_retcode[task_id - 1] = returncode
-        self.gfl.log('WindowHandler', 'mark_finished %d returncode %d' % (task_id, returncode), 3)
-        if self.inited:
+    def _swap_buffer(self, i):
+        queue = self.inbox[i]
+        if not queue:
+            return
+        chunks = []
+        while queue:
+            chunks += queue.popleft()
+        if self.grouper:
+            self.grouper.add_lines(i, chunks)
+        else:
+            self.scrollbacks[i].append_text(''.join(chunks))
+            # Read after the queue is emptied, a newer one queues another
+            # batch
+            self.scrollbacks[i].live_line = self.live_lines[i]
+        store = self.store_of(i)
+        subpad = self._subpad_of(i)
+        if self.search:
+            self.search.update(store)
+            # The match count is in the title
+            subpad.invalidate_title()
+        if subpad.store is store:
+            subpad.invalidate_pad()
+            subpad._follow_output()
+
+    # Called by the Renderer with the mutex held, once per frame.
+    def _render_frame(self):
+        if not self.inited:
+            return False
+        self._drain_inbox()
+        if self.flag_refresh:
             self._refresh_all()
-        self.mutex.release()
+            return True
+        if self.stats_shown and time.monotonic() - self.stats_drawn_at >= METRICS_RATE_INTERVAL:
+            self.header_dirty = True
+            self.has_update = True
+        # The ETA counts down
+        if self.eta_drawn_at is not None and time.monotonic() - self.eta_drawn_at >= ETA_REFRESH_INTERVAL:
+            self.header_dirty = True
+            self.has_update = True
+        if self.has_update:
+            self._update_buffers()
+            return True
+        return False
+
+    # Only the header and the title of the task have to be drawn again
+    def _on_started(self, task_id):
+        self.header_dirty = True
+        self.dirty_titles.add(task_id - 1)
+        self.has_update = True
+
+    def _on_finished(self, task_id, returncode):
+        if self.grouper:
+            self.finished_to_group.append(task_id - 1)
+        self.header_dirty = True
+        self.dirty_titles.add(task_id - 1)
+        self.has_update = True
+
+    def _on_admission(self, status):
+        self.header_dirty = True
+        self.has_update = True
 
-    def _gen_header(self, finished, total):
+    def _on_item_started(self, task_id, item):
+        self._on_started(task_id)
+
+    def _on_item_finished(self, task_id, item):
+        self._on_started(task_id)
+
+    # Queued after the output read so far, not counted as output
+    def _on_note(self, task_id, text, event):
+        self.inbox[task_id - 1].append([ 'para-run: %s\n' % text ])
+        self.inbox_pending = True
+
+    def _gen_header(self, running, pending, finished, total):
         title = 'PARA-RUN V%s' % VERSION
-        finish_prompt = 'Finished: %d / %d' % (finished, total)
-        process_prompt = '%d%%' % (finished * 100 // total)
+        finish_prompt = 'Running: %d  Pending: %d  Finished: %d / %d' % (running, pending, finished, total)
+        short_finish_prompt = 'R:%d P:%d F:%d/%d' % (running, pending, finished, total)
+        if self.work_queue is not None:
+            completed, failed, remaining = self.work_queue.counts()
+            finish_prompt = 'Slots: %d  Items done: %d (%d failed)  Left: %d' % (running, completed, failed, remaining)
+            short_finish_prompt = 'S:%d D:%d F:%d L:%d' % (running, completed, failed, remaining)
+        eta = self.eta()
+        self.eta_drawn_at = eta is not None and time.monotonic() or None
+        if eta is not None:
+            finish_prompt += '  ETA: %s' % format_duration(eta)
+            short_finish_prompt += ' E:%s' % format_duration(eta)
+        if self.admission_status is not None:
+            finish_prompt += '  Admission: %s' % self.admission_status
+            short_finish_prompt += ' A:%s' % self.admission_status
+        done, of = self._progress(finished, total)
+        process_prompt = '%d%%' % (done * 100 // of)
 
         len_title = len(title)
-        len_finish_prompt = len(finish_prompt)
         len_process_prompt = len(process_prompt)
         width = self.width
+        if width < len_title + 2 + 2 * len(finish_prompt):
+            finish_prompt = short_finish_prompt
+        len_finish_prompt = len(finish_prompt)
 
         header = ''
         if width >= len_title + 2 + 2 * len_finish_prompt:
@@ -100,54 +409,171 @@ class WindowHandler:
             header += ' ' * (width - len(header))
         return header
 
-    def _refresh_header(self):
-        finished = sum([ 1 for stat in self.tasks_running_status if not stat ])
-        total = len(self.tasks_running_status)
-        header = self._gen_header(finished, total)
+    # Tasks finished, or items done with --items, out of how many
+    def _progress(self, finished, total):
+        if self.work_queue is None:
+            return finished, total
+        completed, failed, remaining = self.work_queue.counts()
+        if completed + remaining == 0:
+            return 1, 1
+        return completed, completed + remaining
 
-        if self.color_available:
-            highlighted_len = self.width * finished // total
+    def _refresh_header(self):
+        finished = self.tasks_finished
+        pending = self.tasks_pending
+        total = self.tasks_total
+        running = total - finished - pending
+        header = self._gen_header(running, pending, finished, total)
+        done, of = self._progress(finished, total)
+        highlighted_len = self.width * done // of
+
+        drawn = (self.screen_epoch, header, highlighted_len)
+        if drawn == self.header_drawn:
+            pass
+        elif self.color_available:
             self.stdscr.addstr(0, 0, header[:highlighted_len], curses.color_pair(1))
             self.stdscr.addstr(header[highlighted_len:])
         else:
             self.stdscr.addstr(0, 0, header)
+        self.header_drawn = drawn
+        if self.stats_shown:
+            self._refresh_stats()
+
+    def _gen_stats(self):
+        m = self.metrics
+        wait, hold, render = m.lock_wait, m.lock_hold, m.render
+        busiest = '  '.join([ '#%d %d/s' % (task_id, rate) for task_id, rate in m.top_tasks(METRICS_TOP_TASKS) ])
+        return [
+            'mutex wait p99 %.3fms max %.3fms  hold p99 %.3fms max %.3fms  render p99 %.3fms max %.3fms  frames %d dropped %d' % (
+                wait.percentile(99) * 1000, wait.max * 1000, hold.percentile(99) * 1000, hold.max * 1000,
+                render.percentile(99) * 1000, render.max * 1000, m.frames, m.frames_dropped),
+            'lines %d (%d/s)  handoff max %.3fms  busiest: %s' % (sum(m.task_lines), sum(m.task_rates),
+                m.handoff.max * 1000, busiest or '-'),
+        ]
+
+    def _refresh_stats(self):
+        for row, text in enumerate(self._gen_stats()[:STATS_PANEL_LINES]):
+            text = text[:self.width]
+            self.stdscr.addstr(1 + row, 0, text + ' ' * (self.width - len(text)))
+        self.stats_drawn_at = time.monotonic()
+
+    def toggle_stats(self):
+        self.mutex.acquire()
+        self.stats_shown = not self.stats_shown
+        delta = self.stats_shown and STATS_PANEL_LINES or -STATS_PANEL_LINES
+        self.header_lines += delta
+        for subpad in self.subpads:
+            subpad.shown_pos_offset += delta
+        self._refresh_all()
+        self.mutex.release()
 
     def get_cursor_posy(self):
         return self.subpads[self.cursor_in_subpad].get_cursor_posy()
 
+    def _draw_bottom_line(self, text):
+        # Keep off the bottom-right cell, curses fails writing it
+        text = text[-(self.width - 1):]
+        self.stdscr.addstr(self.height - 1, 0, text + ' ' * (self.width - 1 - len(text)))
+        return len(text)
+
     def show_cursor(self, refresh_stdscr = False):
+        if self.prompt is not None:
+            self.stdscr.move(self.height - 1, self._draw_bottom_line(self.prompt))
+            self.stdscr.noutrefresh()
+            if refresh_stdscr:
+                curses.doupdate()
+            return
+        if self.message is not None:
+            self._draw_bottom_line(self.message)
+
         pos_y = self.get_cursor_posy()
 
-        if pos_y < HEADER_LINES:
-            pos_y = HEADER_LINES
+        if pos_y < self.header_lines:
+            pos_y = self.header_lines
         elif pos_y >= self.height:
             pos_y = self.height - 1
         #curses.setsyx(pos_y, 0)
         self.stdscr.move(pos_y, 0)
+        self.stdscr.noutrefresh()
         if refresh_stdscr:
-            self.stdscr.refresh()
+            curses.doupdate()
 
-        self.gfl.log('WindowHandler', f'show cursor ({pos_y},0)', 5)
+        self.gfl.log('WindowHandler', 'show cursor (%d,0)', 5, pos_y)
 
+    # Draws everything again. Erasing rather than clearing lets curses send
+    # only the cells that differ from what the terminal shows, clear() is
+    # kept for Ctrl-L.
     def _refresh_all(self):
         if not self.inited:
             return
-        self.stdscr.clear()
+        if self.full_clear:
+            self.stdscr.clear()
+            self.full_clear = False
+        else:
+            self.stdscr.erase()
+        self.screen_epoch += 1
         self._refresh_header()
-        self.stdscr.refresh()
-        for subpad in self.subpads:
-            subpad._refresh()
-        self.show_cursor()
-        self.stdscr.refresh()
+        self.stdscr.noutrefresh()
+        self._drain_inbox()
+        for i in self.dirty_subpads:
+            self._swap_buffer(i)
+        if self.grouper:
+            self._regroup()
+        self._update_viewport()
+        for i in range(self.visible_first, self.visible_last):
+            self.subpads[i]._refresh()
+        self.show_cursor(True)
+        self.flag_refresh = False
+        self.has_update = False
+        self.header_dirty = False
+        self.dirty_subpads.clear()
+        self.dirty_titles.clear()
+
+    # First subpad whose bottom line is at or below the logical row
+    def _subpad_at(self, row):
+        lo, hi = 0, len(self.subpads)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            subpad = self.subpads[mid]
+            if subpad.shown_pos_offset + subpad.shown_height < row:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    # Only subpads in the viewport hold a curses pad, the others are released
+    # and rebuilt from their scrollback when they get scrolled into view.
+    def _update_viewport(self):
+        first = self._subpad_at(self.header_lines - self.user_control_offset)
+        last = self._subpad_at(self.height - self.user_control_offset) + 1
+        last = min(last, len(self.subpads))
+        for i in range(self.visible_first, self.visible_last):
+            if not first <= i < last:
+                self.subpads[i].release()
+        self.visible_first, self.visible_last = first, last
+        self.gfl.log('WindowHandler', 'viewport subpads [%d, %d)', 5, first, last)
+
+    def logical_height(self):
+        if not self.subpads:
+            return self.header_lines
+        last = self.subpads[-1]
+        return last.shown_pos_offset + last.shown_height + 2
 
     def refresh_all(self):
         self.mutex.acquire()
         self._refresh_all()
         self.mutex.release()
 
+    # Ctrl-L, e.g. after another program wrote to the terminal
+    def redraw(self):
+        self.mutex.acquire()
+        self.full_clear = True
+        self._refresh_all()
+        self.mutex.release()
+
     def maybe_move_cursor(self):
         cursor_posy = self.get_cursor_posy()
-        while cursor_posy < HEADER_LINES:
+        while cursor_posy < self.header_lines:
             if self.cursor_in_subpad < len(self.subpads) - 1:
                 self.cursor_in_subpad += 1
                 cursor_posy = self.get_cursor_posy()
@@ -165,48 +591,135 @@ class WindowHandler:
         pos_y = self.get_cursor_posy()
 
         # We don't show cursor here:
-        if pos_y < HEADER_LINES:
-            self.user_control_offset += HEADER_LINES - pos_y
+        if pos_y < self.header_lines:
+            self.user_control_offset += self.header_lines - pos_y
             self.refresh_all()
-            self.gfl.log('WindowHandler', f'maybe_move_viewport uco set to {self.user_control_offset}', 5)
+            self.gfl.log('WindowHandler', 'maybe_move_viewport uco set to %d', 5, self.user_control_offset)
         elif pos_y >= self.height:
             self.user_control_offset -= pos_y - self.height + 1
             self.refresh_all()
-            self.gfl.log('WindowHandler', f'maybe_move_viewport uco set to {self.user_control_offset}', 5)
+            self.gfl.log('WindowHandler', 'maybe_move_viewport uco set to %d', 5, self.user_control_offset)
         else:
-            self.show_cursor()
+            self.show_cursor(True)
 
     def move_cursor_in_pad(self, direction):
         self.subpads[self.cursor_in_subpad].move_cursor(direction)
         self.maybe_move_viewport()
 
-    def adjust_subpad_height(self, size):
+    def set_prompt(self, prompt):
         self.mutex.acquire()
-        real_adjust_size = self.subpads[self.cursor_in_subpad].adjust_height(size)
-        for i in range(self.cursor_in_subpad + 1, len(self.subpads)):
-            self.subpads[i].shown_pos_offset += real_adjust_size
-        self._refresh_all()
+        self.prompt = prompt
+        if prompt is None:
+            self._refresh_all()
+        else:
+            self.show_cursor(True)
         self.mutex.release()
 
-    def start_worker_threads(self, cmds):
-        tasks_acc = 1
-        tasks_total = len(cmds)
-        self.thrd_pool = []
+    def show_message(self, message):
+        self.mutex.acquire()
+        self.message = message
+        self.show_cursor(True)
+        self.mutex.release()
 
-        for cmd in cmds:
-            t = Task(cmd, self, tasks_acc)
-            t.start()
-            self.thrd_pool.append(t)
-            tasks_acc += 1
+    def clear_message(self):
+        self.mutex.acquire()
+        self.message = None
+        self._refresh_all()
+        self.mutex.release()
 
-        return True
+    # Reads a line on the bottom line. None if cancelled with ESC.
+    def read_prompt(self, prefix):
+        text = ''
+        while True:
+            self.set_prompt(prefix + text)
+            try:
+                ch = self.stdscr.get_wch()
+            except curses.error:
+                continue
+            if ch in ('\n', '\r') or ch == curses.KEY_ENTER:
+                break
+            elif ch == '\x1b':
+                text = None
+                break
+            elif ch in ('\x7f', '\b') or ch == curses.KEY_BACKSPACE:
+                text = text[:-1]
+            elif ch == curses.KEY_RESIZE:
+                self._init_size()
+                self.refresh_all()
+            elif isinstance(ch, str) and ch.isprintable():
+                text += ch
+        self.set_prompt(None)
+        return text
+
+    def start_search(self, pattern):
+        self.mutex.acquire()
+        try:
+            search = Search(pattern)
+        except re.error as e:
+            self.message = 'Bad pattern: %s' % e
+            self.show_cursor(True)
+            self.mutex.release()
+            return
+        self.search = search
+        for subpad in self.task_subpads:
+            subpad.invalidate_title()
+        counts = []
+        for subpad in self.subpads:
+            search.update(subpad.store)
+            counts.append(search.count(subpad.store))
+        total = sum(counts)
+        self.message = '/%s: %d matches in %d pads' % (pattern, total, len([ n for n in counts if n ]))
+        self.gfl.log('WindowHandler', 'search %r: %d matches', 2, pattern, total)
+        self._refresh_all()
+        self.mutex.release()
+        if total:
+            self.jump_match(1)
 
-    def join_worker_threads(self):
-        if not hasattr(self, 'thrd_pool'):
+    # Moves the cursor to the next (direction 1) or previous (-1) match.
+    def jump_match(self, direction):
+        self.mutex.acquire()
+        target = None
+        if self.search is None:
+            self.message = 'No search, press / to search.'
+        else:
+            subpad = self.subpads[self.cursor_in_subpad]
+            stores = [ subpad.store for subpad in self.subpads ]
+            target = self.search.next(stores, self.cursor_in_subpad, subpad.cursor_pos, direction)
+            if target is None:
+                self.message = 'Pattern not found: %s' % self.search.pattern
+        if target is None:
+            self.show_cursor(True)
+            self.mutex.release()
             return
+        self.mutex.release()
 
-        for t in self.thrd_pool:
-            t.join()
+        slot, line_no = target
+        self.cursor_in_subpad = slot
+        self.subpads[slot].jump_to(line_no)
+        self.maybe_move_viewport()
+
+    def adjust_subpad_height(self, size):
+        self.mutex.acquire()
+        real_adjust_size = self.subpads[self.cursor_in_subpad].adjust_height(size)
+        for i in range(self.cursor_in_subpad + 1, len(self.subpads)):
+            self.subpads[i].shown_pos_offset += real_adjust_size
+        self._refresh_all()
+        self.mutex.release()
+
+    def close(self):
+        super().close()
+        if self.session:
+            self.session.close()
+        for store in self.scrollbacks:
+            store.close()
+        if self.grouper:
+            self.grouper.close()
+        # Leave no empty directories behind
+        for path in (self.spill_dir, os.path.dirname(self.spill_dir)):
+            try:
+                os.rmdir(path)
+            except OSError:
+                break
 
     @staticmethod
     def curses_clean(stdscr):
@@ -227,72 +740,112 @@ class WindowHandler:
         curses.cbreak()
         stdscr.keypad(True)
 
+        renderer = None
         try:
             handler.init_all(stdscr)
+            renderer = Renderer(handler, handler.fps)
+            renderer.start()
             running = True
+            quit_asked = False
             if not handler.start_worker_threads(cmds):
                 running = False
 
             while running:
                 ch = stdscr.getch()
-                handler.gfl.log('CURSES', f'ch={ch}', 5)
+                handler.gfl.log('CURSES', 'ch=%d', 5, ch)
+                if handler.message is not None and ch != curses.KEY_RESIZE:
+                    handler.clear_message()
                 if ch == curses.KEY_RESIZE:
-                    handler.gfl.log('CURSES', f'Window resize.', 2)
+                    handler.gfl.log('CURSES', 'Window resize.', 2)
                     handler._init_size()
                     handler.mutex.acquire()
-                    handler.gfl.log('CURSES', f'Window resize start refresh.', 2)
+                    handler.gfl.log('CURSES', 'Window resize start refresh.', 2)
                     #handler._init_size()
                     handler._refresh_all()
-                    handler.gfl.log('CURSES', f'Window resize refresh end.', 2)
+                    handler.gfl.log('CURSES', 'Window resize refresh end.', 2)
                     handler.mutex.release()
                     continue
 
-                render_height_logical_total = HEADER_LINES + \
-                    sum([(subpad.shown_height+2) for subpad in handler.subpads])
+                render_height_logical_total = handler.logical_height()
 
                 inferior = (render_height_logical_total > handler.height) \
                         and (1 - render_height_logical_total) or 0
                 if ch == ord('e') and handler.user_control_offset > inferior:
                     handler.user_control_offset -= 1
                     handler.maybe_move_cursor()
-                    handler.gfl.log('CURSES', f'Key e pressed. rhlt={render_height_logical_total} uco={handler.user_control_offset}', 2)
+                    handler.gfl.log('CURSES', 'Key e pressed. rhlt=%d uco=%d', 2, render_height_logical_total, handler.user_control_offset)
                     handler.refresh_all()
                 elif ch == ord('y') and handler.user_control_offset < 0:
                     handler.user_control_offset += 1
                     handler.maybe_move_cursor()
-                    handler.gfl.log('CURSES', f'Key y pressed. rhlt={render_height_logical_total} uco={handler.user_control_offset}', 2)
+                    handler.gfl.log('CURSES', 'Key y pressed. rhlt=%d uco=%d', 2, render_height_logical_total, handler.user_control_offset)
                     handler.refresh_all()
                 elif ch == curses.KEY_DOWN and handler.cursor_in_subpad < len(handler.subpads) - 1:
                     handler.cursor_in_subpad += 1
                     handler.maybe_move_viewport()
-                    handler.gfl.log('CURSES', f'Key DOWN pressed. cp={handler.cursor_in_subpad},cip={handler.subpads[handler.cursor_in_subpad].cursor_pos}', 2)
+                    handler.gfl.log('CURSES', 'Key DOWN pressed. cp=%d,cip=%d', 2, handler.cursor_in_subpad, handler.subpads[handler.cursor_in_subpad].cursor_pos)
                 elif ch == curses.KEY_UP:
                     if handler.cursor_in_subpad > 0:
                         handler.cursor_in_subpad -= 1
                         handler.maybe_move_viewport()
-                        handler.gfl.log('CURSES', f'Key UP pressed. cp={handler.cursor_in_subpad},cip={handler.subpads[handler.cursor_in_subpad].cursor_pos}', 2)
+                        handler.gfl.log('CURSES', 'Key UP pressed. cp=%d,cip=%d', 2, handler.cursor_in_subpad, handler.subpads[handler.cursor_in_subpad].cursor_pos)
                     else:
                         handler.user_control_offset = 0
                         handler.maybe_move_cursor()
-                        handler.gfl.log('CURSES', f'Key UP pressed. cp={handler.cursor_in_subpad},cip={handler.subpads[handler.cursor_in_subpad].cursor_pos}', 2)
+                        handler.gfl.log('CURSES', 'Key UP pressed. cp=%d,cip=%d', 2, handler.cursor_in_subpad, handler.subpads[handler.cursor_in_subpad].cursor_pos)
                         handler.refresh_all()
                 elif ch == ord('j'):
                     handler.move_cursor_in_pad(1)
-                    handler.gfl.log('CURSES', f'Key j pressed. cp={handler.cursor_in_subpad},cip={handler.subpads[handler.cursor_in_subpad].cursor_pos}', 2)
+                    handler.gfl.log('CURSES', 'Key j pressed. cp=%d,cip=%d', 2, handler.cursor_in_subpad, handler.subpads[handler.cursor_in_subpad].cursor_pos)
                 elif ch == ord('k'):
                     handler.move_cursor_in_pad(-1)
-                    handler.gfl.log('CURSES', f'Key k pressed. cp={handler.cursor_in_subpad},cip={handler.subpads[handler.cursor_in_subpad].cursor_pos}', 2)
+                    handler.gfl.log('CURSES', 'Key k pressed. cp=%d,cip=%d', 2, handler.cursor_in_subpad, handler.subpads[handler.cursor_in_subpad].cursor_pos)
                 elif ch == ord('+'):
                     handler.adjust_subpad_height(1)
-                    handler.gfl.log('CURSES', f'Key + pressed. cp={handler.cursor_in_subpad}', 2)
+                    handler.gfl.log('CURSES', 'Key + pressed. cp=%d', 2, handler.cursor_in_subpad)
                 elif ch == ord('-'):
                     handler.adjust_subpad_height(-1)
-                    handler.gfl.log('CURSES', f'Key - pressed. cp={handler.cursor_in_subpad}', 2)
+                    handler.gfl.log('CURSES', 'Key - pressed. cp=%d', 2, handler.cursor_in_subpad)
+                elif ch == ord('/'):
+                    pattern = handler.read_prompt('/')
+                    if pattern:
+                        handler.start_search(pattern)
+                    handler.gfl.log('CURSES', 'Key / pressed. pattern=%r', 2, pattern)
+                elif ch == ord('n'):
+                    handler.jump_match(1)
+                    handler.gfl.log('CURSES', 'Key n pressed. cp=%d', 2, handler.cursor_in_subpad)
+                elif ch == ord('N'):
+                    handler.jump_match(-1)
+                    handler.gfl.log('CURSES', 'Key N pressed. cp=%d', 2, handler.cursor_in_subpad)
+                elif ch == 12:
+                    handler.redraw()
+                    handler.gfl.log('CURSES', 'Key Ctrl-L pressed.', 2)
+                elif ch == ord('s'):
+                    handler.toggle_stats()
+                    handler.gfl.log('CURSES', 'Key s pressed. stats_shown=%s', 2, handler.stats_shown)
+                elif ch == ord('d') and handler.session:
+                    # The session goes on without this viewer
+                    running = False
+                    handler.gfl.log('CURSES', 'Key d pressed, detached.', 2)
                 elif ch == ord('q'):
-                    if not True in handler.tasks_running_status:
+                    unfinished = handler.tasks_running_status.count(True)
+                    if not unfinished or handler.session_over:
+                        running = False
+                    elif quit_asked:
+                        handler.kill_all()
                         running = False
+                    elif handler.session:
+                        handler.show_message('%d tasks are not finished, press q again to kill them and quit, or d to detach.' % unfinished)
+                    else:
+                        handler.show_message('%d tasks are not finished, press q again to kill them and quit.' % unfinished)
+                quit_asked = ch == ord('q')
         except KeyboardInterrupt:
-            pass
+            # Only detaches from a session
+            if not handler.session:
+                handler.kill_all()
+        finally:
+            if renderer:
+                renderer.stop()
 
         WindowHandler.curses_clean(stdscr)
 
@@ -306,5 +859,6 @@ class WindowHandler:
             WindowHandler.curses_clean(stdscr)
 
         window_handler.join_worker_threads()
+        window_handler.close()
 
         return ret